@@ -4,6 +4,8 @@ import os
 # Base dir for optional local log file (used only when DEBUG=true)
 BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 USE_FILE = os.getenv("DEBUG", "False").lower() == "true"
+# Level for the messaging app's loggers (hot-path debug lines are off in production)
+MESSAGING_LOG_LEVEL = os.getenv("MESSAGING_LOG_LEVEL", "DEBUG" if USE_FILE else "INFO").upper()
 
 handlers = {
     "console": {"class": "logging.StreamHandler", "formatter": "verbose"},
@@ -25,6 +27,6 @@ LOGGING = {
     "loggers": {
         "django": {"handlers": list(handlers.keys()), "level": "INFO"},
         "django.channels": {"handlers": list(handlers.keys()), "level": "DEBUG"},
-        "messaging": {"handlers": list(handlers.keys()), "level": "DEBUG"},
+        "messaging": {"handlers": list(handlers.keys()), "level": MESSAGING_LOG_LEVEL},
     },
 }
@@ -22,6 +22,55 @@ CELERY_RESULT_BACKEND = os.getenv("REDIS_URL", "redis://127.0.0.1:6379/0")
 CELERY_TASK_ALWAYS_EAGER = False
 CELERY_TASK_TIME_LIMIT = 60
 CELERY_TASK_SOFT_TIME_LIMIT = 50
+# Seen-message expiry: deadlines are swept by a beat job in buckets of this width
+MESSAGE_EXPIRY_BUCKET_SECONDS = int(os.getenv("MESSAGE_EXPIRY_BUCKET_SECONDS", "60"))
+MESSAGE_EXPIRY_BATCH_SIZE = int(os.getenv("MESSAGE_EXPIRY_BATCH_SIZE", "500"))
+MESSAGE_EXPIRY_MAX_BATCHES = int(os.getenv("MESSAGE_EXPIRY_MAX_BATCHES", "200"))  # per sweep run
+CELERY_BEAT_SCHEDULE = {
+    "messaging-expiry-sweep": {
+        "task": "messaging.tasks.delete_overdue_messages_task",
+        "schedule": float(MESSAGE_EXPIRY_BUCKET_SECONDS),
+        # a late sweep is superseded by the next one; don't let them pile up
+        "options": {"expires": float(MESSAGE_EXPIRY_BUCKET_SECONDS)},
+    },
+}
+
+# Crypto: derived per-thread keys are cached in-process (LRU + TTL)
+CRYPTO_KEY_CACHE_SIZE = int(os.getenv("CRYPTO_KEY_CACHE_SIZE", "1024"))
+CRYPTO_KEY_CACHE_TTL = int(os.getenv("CRYPTO_KEY_CACHE_TTL", "300"))  # seconds
+# Threads encrypting WebSocket sends off the event loop and DB executor
+CRYPTO_ASYNC_WORKERS = int(os.getenv("CRYPTO_ASYNC_WORKERS", "4"))
+# In-memory replay of recent messages on thread open (per process, never persisted; 0 disables)
+RECENT_MESSAGES_PER_THREAD = int(os.getenv("RECENT_MESSAGES_PER_THREAD", "50"))
+RECENT_MESSAGES_MAX_THREADS = int(os.getenv("RECENT_MESSAGES_MAX_THREADS", "1000"))
+RECENT_MESSAGES_TTL_SECONDS = int(os.getenv("RECENT_MESSAGES_TTL_SECONDS", "600"))
+# Opt-in zlib compression of message bodies before encryption (old rows still decrypt).
+# Trade-off: AES-GCM hides content but not length, and a compressed length reveals how
+# repetitive the plaintext is. If an attacker can get chosen text into the same body as
+# a secret (CRIME/BREACH style) and observe stored or transmitted ciphertext sizes, they
+# can guess the secret byte by byte. Leave this off unless that threat doesn't apply.
+MESSAGE_COMPRESSION = os.getenv("MESSAGE_COMPRESSION", "False").lower() == "true"
+MESSAGE_COMPRESSION_MIN_BYTES = int(os.getenv("MESSAGE_COMPRESSION_MIN_BYTES", "256"))
+# Fraction of new messages decrypted and compared before insert (0 = off, 1 = all)
+MESSAGE_VERIFY_SAMPLE_RATE = float(os.getenv("MESSAGE_VERIFY_SAMPLE_RATE", "0"))
+# Write-behind batching of WebSocket sends (one bulk_create per window/batch)
+MESSAGE_WRITE_BUFFER = os.getenv("MESSAGE_WRITE_BUFFER", "False").lower() == "true"
+MESSAGE_WRITE_BUFFER_MAX_BATCH = int(os.getenv("MESSAGE_WRITE_BUFFER_MAX_BATCH", "100"))
+MESSAGE_WRITE_BUFFER_MAX_DELAY_MS = float(os.getenv("MESSAGE_WRITE_BUFFER_MAX_DELAY_MS", "5"))
+# "durable" (normal commit) or "relaxed" (PostgreSQL synchronous_commit=off per batch)
+MESSAGE_WRITE_BUFFER_DURABILITY = os.getenv("MESSAGE_WRITE_BUFFER_DURABILITY", "durable")
+# Per-user token bucket on WebSocket sends ("memory" per node, "redis" shared); 0 disables
+MESSAGE_RATE_LIMIT_BACKEND = os.getenv("MESSAGE_RATE_LIMIT_BACKEND", "memory")
+MESSAGE_RATE_LIMIT_PER_SECOND = float(os.getenv("MESSAGE_RATE_LIMIT_PER_SECOND", "5"))
+MESSAGE_RATE_LIMIT_BURST = int(os.getenv("MESSAGE_RATE_LIMIT_BURST", "20"))
+# Frames a WebSocket client may have unacknowledged ({"action": "ack", "count": n}) before
+# the overflow policy kicks in ("drop" or "close")
+WS_OUTBOUND_WINDOW = int(os.getenv("WS_OUTBOUND_WINDOW", "256"))
+WS_OUTBOUND_OVERFLOW = os.getenv("WS_OUTBOUND_OVERFLOW", "drop")
+# Bearer token required by /metrics (Prometheus); without one it is served only when DEBUG
+METRICS_TOKEN = os.getenv("METRICS_TOKEN", "")
+# Rows fetched and decrypted per batch by the streaming NDJSON export
+MESSAGE_EXPORT_CHUNK_SIZE = int(os.getenv("MESSAGE_EXPORT_CHUNK_SIZE", "500"))
 
 # Core Django settings
 SECRET_KEY = os.getenv(
@@ -18,10 +18,13 @@ from django.contrib import admin
 from django.urls import path,include
 from django.views.generic import TemplateView
 
+from messaging.views import metrics
+
 urlpatterns = [
     path('admin/', admin.site.urls),
     path('', TemplateView.as_view(template_name="core/home.html"), name='home'),
     path("users/", include("users.urls")),
     path("posts/", include("posts.urls")),
     path("msg/", include("messaging.urls")),
+    path("metrics", metrics, name="metrics"),
 ]
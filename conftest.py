@@ -1,4 +1,5 @@
 import pytest
+from channels.db import database_sync_to_async
 from django.contrib.auth import get_user_model
 
 @pytest.fixture
@@ -8,3 +9,23 @@ def user(db):
     """
     User = get_user_model()
     return User.objects.create_user(username="alice", password="Secret123!")
+
+
+@pytest.fixture
+async def thread_pair(transactional_db):
+    """
+    Two users sharing a new thread, as (alice, bob, thread), for async
+    WebSocket tests.
+    """
+    from messaging.models import MessageThread
+
+    @database_sync_to_async
+    def create():
+        User = get_user_model()
+        alice = User.objects.create_user(username="alice_pair", password="x")
+        bob = User.objects.create_user(username="bob_pair", password="x")
+        thread = MessageThread.objects.create()
+        thread.participants.add(alice, bob)
+        return alice, bob, thread
+
+    return await create()
@@ -1,28 +1,97 @@
 import os
 import base64
-from typing import Optional
+from typing import Iterable, List, Optional, Sequence, Tuple, Union
 from cryptography.hazmat.primitives.ciphers.aead import AESGCM
 
+from .codec import decode_plaintext, encode_plaintext
+
 NONCE_LEN = 12  # 96-bit nonce recommended for AES-GCM
 
-def encrypt_aes_gcm(plaintext: str, key: bytes, aad: Optional[bytes] = None) -> str:
+def encrypt_aes_gcm_raw(
+    plaintext: str, key: bytes, aad: Optional[bytes] = None, compress_min: Optional[int] = None
+) -> bytes:
     """
-    Encrypt UTF-8 text with AES-256-GCM. Returns base64(nonce || ciphertext+tag).
+    Encrypt UTF-8 text with AES-256-GCM. Returns raw nonce || ciphertext+tag.
+    With compress_min set, plaintexts at least that many bytes are zlib'd first
+    (see crypto_core.codec); decryption handles both forms.
     """
     if not isinstance(plaintext, str):
         raise TypeError("plaintext must be str")
     aes = AESGCM(key)
     nonce = os.urandom(NONCE_LEN)
-    ct = aes.encrypt(nonce, plaintext.encode("utf-8"), aad)
-    blob = nonce + ct
-    return base64.b64encode(blob).decode("utf-8")
+    return nonce + aes.encrypt(nonce, encode_plaintext(plaintext, compress_min), aad)
+
+def decrypt_aes_gcm_raw(blob: bytes, key: bytes, aad: Optional[bytes] = None) -> str:
+    """
+    Decrypt raw nonce || ciphertext+tag and return UTF-8 text.
+    """
+    data = bytes(blob)  # BinaryField may hand back a memoryview
+    aes = AESGCM(key)
+    return decode_plaintext(aes.decrypt(data[:NONCE_LEN], data[NONCE_LEN:], aad))
+
+def encrypt_aes_gcm(plaintext: str, key: bytes, aad: Optional[bytes] = None) -> str:
+    """
+    Encrypt UTF-8 text with AES-256-GCM. Returns base64(nonce || ciphertext+tag).
+    """
+    return base64.b64encode(encrypt_aes_gcm_raw(plaintext, key, aad)).decode("utf-8")
 
 def decrypt_aes_gcm(blob_b64: str, key: bytes, aad: Optional[bytes] = None) -> str:
     """
     Decrypt base64(nonce || ciphertext+tag) and return UTF-8 text.
     """
-    data = base64.b64decode(blob_b64)
-    nonce, ct = data[:NONCE_LEN], data[NONCE_LEN:]
+    return decrypt_aes_gcm_raw(base64.b64decode(blob_b64), key, aad)
+
+def _as_raw(blob: Union[bytes, memoryview, str]) -> bytes:
+    """Accept raw ciphertext or the legacy base64 text form."""
+    if isinstance(blob, str):
+        return base64.b64decode(blob)
+    return bytes(blob)
+
+# ---- Batch helpers: one key, one cipher context, many blobs ----
+
+def encrypt_many(
+    items: Iterable[Tuple[str, Optional[bytes]]], key: bytes, compress_min: Optional[int] = None
+) -> List[bytes]:
+    """
+    Encrypt (plaintext, aad) pairs that share a key. Returns raw
+    nonce || ciphertext+tag blobs; the AESGCM context is built once for the batch.
+    compress_min works as in encrypt_aes_gcm_raw.
+    """
+    aes = AESGCM(key)
+    out = []
+    for plaintext, aad in items:
+        if not isinstance(plaintext, str):
+            raise TypeError("plaintext must be str")
+        nonce = os.urandom(NONCE_LEN)
+        out.append(nonce + aes.encrypt(nonce, encode_plaintext(plaintext, compress_min), aad))
+    return out
+
+def decrypt_many(
+    items: Iterable[Tuple[Union[bytes, memoryview, str], Optional[bytes]]], key: bytes, strict: bool = True
+) -> List[Optional[str]]:
+    """
+    Decrypt (blob, aad) pairs that share a key, reusing one AESGCM context.
+    Blobs may be raw bytes or legacy base64 text.
+    With strict=False a blob that fails to decrypt yields None instead of raising,
+    so one bad row doesn't sink a whole history fetch.
+    """
     aes = AESGCM(key)
-    pt = aes.decrypt(nonce, ct, aad)
-    return pt.decode("utf-8")
+    out: List[Optional[str]] = []
+    for blob, aad in items:
+        try:
+            data = _as_raw(blob)
+            out.append(decode_plaintext(aes.decrypt(data[:NONCE_LEN], data[NONCE_LEN:], aad)))
+        except Exception:
+            if strict:
+                raise
+            out.append(None)
+    return out
+
+def decrypt_jobs(
+    jobs: Sequence[Tuple[bytes, list]], strict: bool = True
+) -> List[List[Optional[str]]]:
+    """
+    Decrypt several (key, [(blob, aad), ...]) jobs, one decrypt_many per
+    key, and return one result list per job, in order.
+    """
+    return [decrypt_many(items, key, strict=strict) for key, items in jobs]
@@ -0,0 +1,29 @@
+import zlib
+from typing import Optional
+
+# Compressing before encrypting leaks compressibility through ciphertext
+# length (CRIME/BREACH): only pass compress_min for payloads an attacker
+# can't mix chosen text into. See MESSAGE_COMPRESSION in config/settings.py.
+#
+# Format header for compressed plaintexts. 0xF5 can never start valid UTF-8,
+# so plaintexts without it (including every row written before compression
+# existed) are read as plain UTF-8.
+ZLIB_HEADER = b"\xf5"
+ZLIB_LEVEL = 6
+
+def encode_plaintext(text: str, compress_min: Optional[int] = None) -> bytes:
+    """
+    UTF-8 encode text, zlib-compressing it when compress_min is set, the
+    encoded size is at least compress_min bytes, and compression actually helps.
+    """
+    data = text.encode("utf-8")
+    if compress_min is not None and len(data) >= compress_min:
+        packed = ZLIB_HEADER + zlib.compress(data, ZLIB_LEVEL)
+        if len(packed) < len(data):
+            return packed
+    return data
+
+def decode_plaintext(data: bytes) -> str:
+    if data[:1] == ZLIB_HEADER:
+        data = zlib.decompress(data[1:])
+    return data.decode("utf-8")
@@ -0,0 +1,35 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+
+# Default; overridable via Django settings (see config/settings.py)
+DEFAULT_ASYNC_WORKERS = 4
+
+_lock = threading.Lock()
+_executor: Optional[ThreadPoolExecutor] = None
+_workers: Optional[int] = None
+
+
+def _setting(name: str, default):
+    try:
+        from django.conf import settings
+        return getattr(settings, name, default)
+    except Exception:
+        return default
+
+
+def get_async_crypto_executor() -> ThreadPoolExecutor:
+    """
+    Threads for per-request crypto on async paths (e.g. encrypting a
+    WebSocket send), so it runs off both the event loop and asgiref's
+    single thread-sensitive executor that Django DB calls share.
+    """
+    global _executor, _workers
+    workers = int(_setting("CRYPTO_ASYNC_WORKERS", DEFAULT_ASYNC_WORKERS))
+    with _lock:
+        if _executor is None or _workers != workers:
+            if _executor is not None:
+                _executor.shutdown(wait=False)
+            _executor = ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="crypto")
+            _workers = workers
+        return _executor
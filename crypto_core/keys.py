@@ -1,31 +1,69 @@
 import base64
 import os
-from typing import Optional
+import threading
+import time
+from collections import OrderedDict
+from functools import lru_cache
+from typing import Dict, Optional, Tuple
 
 from cryptography.hazmat.primitives.kdf.hkdf import HKDF
 from cryptography.hazmat.primitives import hashes
 
-def _get_master_key() -> bytes:
-    """
-    Read base64-encoded 32-byte key from CRYPTO_MASTER_KEY.
-    """
-    raw = os.getenv("CRYPTO_MASTER_KEY")
-    if not raw:
-        raise RuntimeError("CRYPTO_MASTER_KEY not set in environment (.env).")
+# Defaults for the derived-key cache; overridable via Django settings.
+DEFAULT_KEY_CACHE_SIZE = 1024
+DEFAULT_KEY_CACHE_TTL = 300  # seconds
+
+
+def _decode_master_key(raw: str, name: str) -> bytes:
     try:
         key = base64.b64decode(raw)
     except Exception as e:
-        raise RuntimeError("CRYPTO_MASTER_KEY must be base64-encoded 32 bytes.") from e
+        raise RuntimeError(f"{name} must be base64-encoded 32 bytes.") from e
     if len(key) != 32:
-        raise RuntimeError("CRYPTO_MASTER_KEY must decode to 32 bytes.")
+        raise RuntimeError(f"{name} must decode to 32 bytes.")
     return key
 
-def derive_message_key(thread_id: int) -> bytes:
+
+@lru_cache(maxsize=1)
+def _get_master_keys() -> Dict[int, bytes]:
     """
-    Derive a per-thread AES-256 key from the master key using HKDF(SHA-256).
-    This avoids storing a unique key per thread while giving isolation.
+    Read the versioned master keys, once per process:
+      CRYPTO_MASTER_KEY          current key (base64, 32 bytes)
+      CRYPTO_MASTER_KEY_VERSION  its version number (default 1)
+      CRYPTO_RETIRED_MASTER_KEYS older keys still needed for reads,
+                                 as "version:base64,version:base64"
+    Call invalidate_message_keys(master=True) after changing the environment.
     """
-    master = _get_master_key()
+    raw = os.getenv("CRYPTO_MASTER_KEY")
+    if not raw:
+        raise RuntimeError("CRYPTO_MASTER_KEY not set in environment (.env).")
+    keys = {current_key_version(): _decode_master_key(raw, "CRYPTO_MASTER_KEY")}
+
+    for entry in filter(None, (os.getenv("CRYPTO_RETIRED_MASTER_KEYS") or "").split(",")):
+        version, _, b64 = entry.strip().partition(":")
+        if not version.isdigit() or not b64:
+            raise RuntimeError("CRYPTO_RETIRED_MASTER_KEYS entries must look like 'version:base64key'.")
+        keys.setdefault(int(version), _decode_master_key(b64, f"Retired master key v{version}"))
+    return keys
+
+
+@lru_cache(maxsize=1)
+def current_key_version() -> int:
+    """Version that new ciphertexts are written under."""
+    return int(os.getenv("CRYPTO_MASTER_KEY_VERSION", "1"))
+
+
+def _get_master_key(version: Optional[int] = None) -> bytes:
+    keys = _get_master_keys()
+    if version is None:
+        version = current_key_version()
+    try:
+        return keys[version]
+    except KeyError:
+        raise RuntimeError(f"No master key configured for key version {version}.") from None
+
+
+def _hkdf_thread_key(master: bytes, thread_id: int) -> bytes:
     info = f"cloakpost.thread.{thread_id}".encode("utf-8")
     hkdf = HKDF(
         algorithm=hashes.SHA256(),
@@ -34,3 +72,118 @@ def derive_message_key(thread_id: int) -> bytes:
         info=info,
     )
     return hkdf.derive(master)
+
+
+class KeyCache:
+    """
+    Thread-safe LRU of derived thread keys with a per-entry TTL.
+    Keeps hit/miss counters so callers can check the cache is doing its job.
+    """
+
+    def __init__(self, maxsize: int = DEFAULT_KEY_CACHE_SIZE, ttl: float = DEFAULT_KEY_CACHE_TTL):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data: "OrderedDict[Tuple[int, int], tuple[bytes, float]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, version: int, thread_id: int) -> Optional[bytes]:
+        now = time.monotonic()
+        slot = (version, thread_id)
+        with self._lock:
+            entry = self._data.get(slot)
+            if entry is not None:
+                key, expires = entry
+                if expires > now:
+                    self._data.move_to_end(slot)
+                    self.hits += 1
+                    return key
+                del self._data[slot]
+            self.misses += 1
+            return None
+
+    def put(self, version: int, thread_id: int, key: bytes):
+        if self.maxsize <= 0:
+            return
+        slot = (version, thread_id)
+        with self._lock:
+            self._data[slot] = (key, time.monotonic() + self.ttl)
+            self._data.move_to_end(slot)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def invalidate(self, thread_id: Optional[int] = None):
+        with self._lock:
+            if thread_id is None:
+                self._data.clear()
+            else:
+                for slot in [s for s in self._data if s[1] == thread_id]:
+                    del self._data[slot]
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "size": len(self._data),
+                "maxsize": self.maxsize,
+                "ttl": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+            }
+
+
+def _build_cache() -> KeyCache:
+    try:
+        from django.conf import settings
+        size = getattr(settings, "CRYPTO_KEY_CACHE_SIZE", DEFAULT_KEY_CACHE_SIZE)
+        ttl = getattr(settings, "CRYPTO_KEY_CACHE_TTL", DEFAULT_KEY_CACHE_TTL)
+    except Exception:
+        # Settings not configured (plain scripts); fall back to defaults
+        size, ttl = DEFAULT_KEY_CACHE_SIZE, DEFAULT_KEY_CACHE_TTL
+    return KeyCache(maxsize=int(size), ttl=float(ttl))
+
+
+_key_cache: Optional[KeyCache] = None
+_key_cache_lock = threading.Lock()
+
+
+def get_key_cache() -> KeyCache:
+    global _key_cache
+    if _key_cache is None:
+        with _key_cache_lock:
+            if _key_cache is None:
+                _key_cache = _build_cache()
+    return _key_cache
+
+
+def derive_message_key(thread_id: int, version: Optional[int] = None) -> bytes:
+    """
+    Derive a per-thread AES-256 key from the master key using HKDF(SHA-256).
+    This avoids storing a unique key per thread while giving isolation.
+    `version` selects the master key (default: current); results are
+    memoized in a bounded LRU (see KeyCache).
+    """
+    if version is None:
+        version = current_key_version()
+    cache = get_key_cache()
+    key = cache.get(version, thread_id)
+    if key is None:
+        key = _hkdf_thread_key(_get_master_key(version), thread_id)
+        cache.put(version, thread_id, key)
+    return key
+
+
+def invalidate_message_keys(thread_id: Optional[int] = None, master: bool = False):
+    """
+    Drop cached thread keys (one thread, or all when thread_id is None).
+    With master=True the master keys are re-read from the environment on next use.
+    """
+    if master:
+        _get_master_keys.cache_clear()
+        current_key_version.cache_clear()
+        thread_id = None
+    get_key_cache().invalidate(thread_id)
+
+
+def key_cache_stats() -> dict:
+    return get_key_cache().stats()
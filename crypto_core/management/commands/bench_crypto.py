@@ -0,0 +1,125 @@
+import base64
+import random
+import time
+
+from django.core.management.base import BaseCommand
+
+from crypto_core.aes import decrypt_aes_gcm, decrypt_many, encrypt_many
+from crypto_core.keys import _get_master_key, _hkdf_thread_key, derive_message_key, invalidate_message_keys
+
+
+def _corpus(n: int):
+    """Synthetic chat bodies: mostly short lines, some long paragraphs."""
+    words = ("hey", "ok", "see", "you", "at", "the", "station", "tomorrow", "lol", "sure", "thanks")
+    out = []
+    for i in range(n):
+        length = 400 if i % 20 == 0 else 4 + (i % 12)
+        out.append(" ".join(words[(i + j) % len(words)] for j in range(length)))
+    return out
+
+
+_VOCAB = (
+    "the be to of and a in that have i it for not on with he as you do at this but his by from they we say her "
+    "she or an will my one all would there their what so up out if about who get which go me when make can like "
+    "time no just him know take people into year your good some could them see other than then now look only come "
+    "its over think also back after use two how our work first well way even new want because any these give day "
+    "most us meeting tomorrow tonight dinner train late sorry thanks sure okay send photo address call later home "
+    "weekend plan project deadline doc review merge deploy ticket coffee lunch office remote sounds great"
+).split()
+
+
+def _realistic_corpus(n: int, seed: int = 42):
+    """
+    Seeded chat-like corpus: ~70% one-liners, ~25% short paragraphs,
+    ~5% long pastes (capped at the 5000-char body limit).
+    """
+    rng = random.Random(seed)
+    out = []
+    for _ in range(n):
+        roll = rng.random()
+        words = rng.randint(3, 20) if roll < 0.70 else rng.randint(30, 120) if roll < 0.95 else rng.randint(300, 800)
+        text = []
+        for i in range(words):
+            w = rng.choice(_VOCAB)
+            text.append(w.capitalize() if i == 0 or text[-1].endswith(".") else w)
+            if rng.random() < 0.08:
+                text[-1] += rng.choice((".", ",", "?", "!"))
+        out.append(" ".join(text)[:5000])
+    return out
+
+
+def _best_of(repeat: int, fn):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+class Command(BaseCommand):
+    help = 'Benchmark per-message decrypt cost for thread histories (no DB needed)'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--rows',
+            type=int,
+            nargs='+',
+            default=[200, 5000],
+            help='History sizes to benchmark (default: 200 5000)',
+        )
+        parser.add_argument('--repeat', type=int, default=5, help='Runs per case; best is reported')
+        parser.add_argument(
+            '--compression',
+            action='store_true',
+            help='Instead: storage saved vs CPU cost of compressing bodies before encryption',
+        )
+
+    def handle(self, *args, **options):
+        thread_id, sender_id = 1, 1
+        aad = f"sender:{sender_id}|thread:{thread_id}".encode("utf-8")
+        master = _get_master_key()
+
+        if options['compression']:
+            return self._bench_compression(options, master, thread_id, aad)
+
+        for rows in options['rows']:
+            key = _hkdf_thread_key(master, thread_id)
+            blobs = encrypt_many([(body, aad) for body in _corpus(rows)], key)
+            legacy = [base64.b64encode(blob).decode("utf-8") for blob in blobs]
+
+            def per_row():
+                # Old path: base64 text, HKDF + fresh AESGCM for every row
+                for blob in legacy:
+                    decrypt_aes_gcm(blob, _hkdf_thread_key(master, thread_id), aad=aad)
+
+            def batched():
+                invalidate_message_keys(thread_id)
+                decrypt_many([(blob, aad) for blob in blobs], derive_message_key(thread_id))
+
+            for label, fn in (("per-row", per_row), ("batched", batched)):
+                elapsed = _best_of(options['repeat'], fn)
+                self.stdout.write(
+                    f"{rows:>6} rows  {label:<8} total {elapsed * 1000:8.2f} ms  "
+                    f"per message {elapsed / rows * 1e6:7.2f} us"
+                )
+
+
+    def _bench_compression(self, options, master, thread_id, aad):
+        key = _hkdf_thread_key(master, thread_id)
+        for rows in options['rows']:
+            corpus = _realistic_corpus(rows)
+            plain_bytes = sum(len(body.encode("utf-8")) for body in corpus)
+            self.stdout.write(f"{rows} messages, {plain_bytes} bytes of UTF-8 plaintext")
+
+            for compress_min in (None, 512, 256, 128):
+                items = [(body, aad) for body in corpus]
+                blobs = encrypt_many(items, key, compress_min)
+                stored = sum(len(b) for b in blobs)
+                enc = _best_of(options['repeat'], lambda: encrypt_many(items, key, compress_min))
+                dec = _best_of(options['repeat'], lambda: decrypt_many([(b, aad) for b in blobs], key))
+                label = "off" if compress_min is None else f">={compress_min}B"
+                self.stdout.write(
+                    f"  compression {label:<7} stored {stored:>9} bytes ({stored / plain_bytes:6.1%} of plaintext)  "
+                    f"encrypt {enc / rows * 1e6:6.2f} us/msg  decrypt {dec / rows * 1e6:6.2f} us/msg"
+                )
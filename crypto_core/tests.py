@@ -1,3 +1,86 @@
-from django.test import TestCase
+import time
 
-# Create your tests here.
+from crypto_core.aes import decrypt_jobs, decrypt_many, encrypt_many
+from crypto_core.codec import ZLIB_HEADER, decode_plaintext, encode_plaintext
+from crypto_core.utils import (
+    decrypt_for_user,
+    decrypt_many_for_user,
+    encrypt_many_for_user,
+    fernet_from_user_key,
+    generate_user_data_key,
+)
+from crypto_core.keys import KeyCache, derive_message_key, invalidate_message_keys, key_cache_stats
+
+
+def test_derive_message_key_is_cached_per_thread():
+    invalidate_message_keys()
+    before = key_cache_stats()
+
+    k1 = derive_message_key(101)
+    k2 = derive_message_key(101)
+    k3 = derive_message_key(102)
+
+    stats = key_cache_stats()
+    assert k1 == k2 and k1 != k3
+    assert stats["misses"] - before["misses"] == 2
+    assert stats["hits"] - before["hits"] == 1
+
+
+def test_key_cache_evicts_lru_and_expires():
+    cache = KeyCache(maxsize=2, ttl=0.05)
+    cache.put(1, 1, b"a")
+    cache.put(1, 2, b"b")
+    assert cache.get(1, 1) == b"a"   # thread 1 is now most recent
+    cache.put(1, 3, b"c")            # evicts thread 2
+    assert cache.get(1, 2) is None
+    assert cache.get(1, 3) == b"c"
+
+    time.sleep(0.06)
+    assert cache.get(1, 1) is None
+
+
+def test_invalidate_forces_rederive():
+    k1 = derive_message_key(7)
+    invalidate_message_keys(7)
+    misses = key_cache_stats()["misses"]
+    assert derive_message_key(7) == k1
+    assert key_cache_stats()["misses"] == misses + 1
+
+
+def test_decrypt_many_round_trip_and_non_strict():
+    key = derive_message_key(55)
+    blobs = encrypt_many([("one", b"a"), ("two", b"b")], key)
+    assert decrypt_many(list(zip(blobs, [b"a", b"b"])), key) == ["one", "two"]
+    # wrong AAD on the second blob -> None instead of raising
+    assert decrypt_many(list(zip(blobs, [b"a", b"x"])), key, strict=False) == ["one", None]
+
+
+def test_decrypt_jobs_keeps_job_order():
+    k1, k2 = derive_message_key(1), derive_message_key(2)
+    texts = [f"msg {i}" for i in range(40)]
+    job1 = list(zip(encrypt_many([(t, b"x") for t in texts], k1), [b"x"] * 40))
+    job2 = list(zip(encrypt_many([("solo", b"y")], k2), [b"y"]))
+
+    assert decrypt_jobs([(k1, job1), (k2, job2)]) == [texts, ["solo"]]
+
+
+def test_user_fernet_is_cached_and_bulk_helpers_round_trip():
+    key = generate_user_data_key()
+    assert fernet_from_user_key(key) is fernet_from_user_key(key.decode())
+
+    tokens = encrypt_many_for_user(key, ["bio", None, "city"])
+    assert tokens[1] is None
+    assert decrypt_many_for_user(key, tokens) == ["bio", None, "city"]
+    assert decrypt_for_user(key, tokens[0]) == "bio"
+
+
+def test_codec_compresses_only_large_bodies_and_reads_plain_utf8():
+    long_text = "see you at the station tomorrow " * 40
+    packed = encode_plaintext(long_text, compress_min=256)
+    assert packed[:1] == ZLIB_HEADER and len(packed) < len(long_text)
+    assert decode_plaintext(packed) == long_text
+
+    assert encode_plaintext("hi", compress_min=256) == b"hi"
+    assert encode_plaintext(long_text) == long_text.encode("utf-8")
+    # rows written before compression existed are plain UTF-8
+    assert decode_plaintext("héllo".encode("utf-8")) == "héllo"
@@ -1,14 +1,29 @@
+from functools import lru_cache
+from typing import Iterable, List, Optional, Union
+
 from cryptography.fernet import Fernet
 
+# Fernet() parses the key and sets up its HMAC/AES keys; keep recent ones around
+FERNET_CACHE_SIZE = 256
+
 def generate_user_data_key() -> bytes:
     """
     Return a new random 32-byte Fernet key (base64 urlsafe).
     """
     return Fernet.generate_key()
 
-def fernet_from_user_key(user_key: bytes) -> Fernet:
+@lru_cache(maxsize=FERNET_CACHE_SIZE)
+def _cached_fernet(user_key: bytes) -> Fernet:
     return Fernet(user_key)
 
+def fernet_from_user_key(user_key: Union[bytes, str]) -> Fernet:
+    if isinstance(user_key, str):
+        user_key = user_key.encode("utf-8")
+    return _cached_fernet(bytes(user_key))
+
+def clear_fernet_cache():
+    _cached_fernet.cache_clear()
+
 def encrypt_for_user(user_key: bytes, plaintext: str) -> str:
     if plaintext is None:
         return None
@@ -18,3 +33,19 @@ def decrypt_for_user(user_key: bytes, ciphertext: str) -> str:
     if ciphertext is None:
         return None
     return fernet_from_user_key(user_key).decrypt(ciphertext.encode("utf-8")).decode("utf-8")
+
+def encrypt_many_for_user(user_key: bytes, plaintexts: Iterable[Optional[str]]) -> List[Optional[str]]:
+    """
+    Encrypt several fields/records for one user with a single Fernet instance.
+    None passes through as None, matching encrypt_for_user.
+    """
+    f = fernet_from_user_key(user_key)
+    return [None if p is None else f.encrypt(p.encode("utf-8")).decode("utf-8") for p in plaintexts]
+
+def decrypt_many_for_user(user_key: bytes, ciphertexts: Iterable[Optional[str]]) -> List[Optional[str]]:
+    """
+    Decrypt several fields/records for one user with a single Fernet instance.
+    None passes through as None; a bad token raises InvalidToken like decrypt_for_user.
+    """
+    f = fernet_from_user_key(user_key)
+    return [None if c is None else f.decrypt(c.encode("utf-8")).decode("utf-8") for c in ciphertexts]
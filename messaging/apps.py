@@ -4,3 +4,6 @@ from django.apps import AppConfig
 class MessagingConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'messaging'
+
+    def ready(self):
+        from . import expiry  # noqa: F401  registers the expiry gauges' /metrics hook
@@ -1,11 +1,26 @@
 # messaging/consumers.py
+import asyncio
+import time
+
 from channels.generic.websocket import AsyncJsonWebsocketConsumer
-from channels.db import database_sync_to_async
 from django.contrib.auth.models import AnonymousUser
-from django.utils import timezone
 from django.contrib.auth import get_user_model
 
-from .models import Message, MessageThread
+from .flow_control import SLOW_CONSUMER_CLOSE_CODE, check_send_rate, outbound_window_for
+from .metrics import OPEN_CONNECTIONS, stage_timer
+from .models import ThreadMembership
+from .recent import get_recent_messages
+from .services import (
+    acreate_message,
+    amark_seen,
+    athread_member_ids,
+    new_message_events,
+    seen_event,
+    thread_group,
+    user_group,
+)
+from .wire import MSGPACK_SUBPROTOCOL, decode_frame, encode_frame, negotiate
+from .write_buffer import flush_write_buffer, get_write_buffer, write_buffer_enabled
 
 User = get_user_model()
 
@@ -13,205 +28,495 @@ User = get_user_model()
 import logging
 logger = logging.getLogger(__name__)
 
-class ThreadConsumer(AsyncJsonWebsocketConsumer):
+# Individual "seen" frames arriving within this window are acked as one batch
+SEEN_DEBOUNCE_SECONDS = 0.25
+# How long a socket reuses a thread's member list for inbox fan-out. Only
+# cached while the socket is in the thread's group, where membership.added /
+# membership.revoked clear it; the TTL only bounds changes made outside
+# messaging.services.
+MEMBER_CACHE_SECONDS = 30.0
+
+
+class MessagingConsumer(AsyncJsonWebsocketConsumer):
     """
-    WebSocket for a single thread.
-    Expects URL pattern: ws/threads/<int:thread_id>/ or ws/msg/thread/<int:thread_id>/
+    Send / seen handling shared by the per-thread and per-user sockets.
+    Subclasses decide which threads a connection may act on (can_post).
+
+    Frames are JSON unless the client offers the MessagePack subprotocol
+    (see messaging.wire). Clients ack what they have received with
+    {"action": "ack", "count": n} (see flow_control.OutboundWindow).
     """
 
-    async def connect(self):
-        logger.debug(f"WebSocket connection attempt from {self.scope.get('client')}")
+    subprotocol = None
+
+    def _init_state(self):
+        self._pending_seen = {}  # thread_id -> {message ids}
+        self._seen_flush = None  # debounce timer
+        self._seen_task = None  # flush started by the timer
+        self._members = {}  # thread_id -> (member ids, expires)
+        self._recent = get_recent_messages()
+        self._tracked = set()  # threads registered with the recent-message buffer
+
+    async def can_post(self, thread_id: int) -> bool:
+        """Whether this connection may send or ack in thread_id; denies unless a subclass allows."""
+        return False
+
+    async def _authenticate(self) -> bool:
+        logger.debug("WebSocket connection attempt from %s", self.scope.get("client"))
         self.user = self.scope.get("user")
         if not self.user or isinstance(self.user, AnonymousUser) or not self.user.is_authenticated:
-            logger.warning(f"Unauthorized WebSocket connection attempt")
+            logger.warning("Unauthorized WebSocket connection attempt from %s", self.scope.get("client"))
             await self.close(code=4003)  # unauthorized
-            return
+            return False
+        return True
 
-        try:
-            self.thread_id = int(self.scope["url_route"]["kwargs"]["thread_id"])
-        except Exception:
-            await self.close(code=4002)  # bad path
-            return
+    async def _accept(self):
+        self._init_state()
+        self.subprotocol = negotiate(self.scope.get("subprotocols"))
+        await self.accept(subprotocol=self.subprotocol)
+        OPEN_CONNECTIONS.inc()
+        # From here on frames count against the client's ack window (see flow_control)
+        self._outbox = outbound_window_for(self._send_now, self._close_slow)
 
-        # Membership check
-        is_member = await self._is_participant(self.thread_id, self.user.id)
-        if not is_member:
-            await self.close(code=4001)  # not a participant
-            return
+    async def _close_down(self):
+        OPEN_CONNECTIONS.dec()
+        self._outbox.stop()
+        for thread_id in list(self._tracked):
+            self._untrack(thread_id)
+        if self._seen_task is not None:
+            await self._seen_task  # a timer flush in flight finishes before we close
+        await self._flush_seen()
+        if write_buffer_enabled():
+            await flush_write_buffer()
 
-        self.group = f"thread.{self.thread_id}"
-        await self.channel_layer.group_add(self.group, self.channel_name)
-        await self.accept()
-        await self.send_json({"type": "ready", "thread": self.thread_id, "user": self.user.username})
+    async def send_json(self, content, close=False):
+        outbox = getattr(self, "_outbox", None)
+        if outbox is None or close:
+            await self._send_now(content, close=close)
+        else:
+            await outbox.send(content)
 
-    async def disconnect(self, code):
-        if hasattr(self, "group"):
-            await self.channel_layer.group_discard(self.group, self.channel_name)
+    async def _send_now(self, content, close=False):
+        if self.binary:
+            await self.send(bytes_data=encode_frame(content), close=close)
+        else:
+            await super().send_json(content, close=close)
 
-    async def receive_json(self, content, **kwargs):
-        action = (content.get("action") or "").lower()
+    @property
+    def binary(self) -> bool:
+        return self.subprotocol == MSGPACK_SUBPROTOCOL
 
-        if action == "send":
-            body = (content.get("body") or "").strip()
-            if not body or len(body) > 5000:
-                await self.send_json({
-                    "type": "error", 
-                    "detail": "Message must be between 1 and 5000 characters"
-                })
+    async def receive(self, text_data=None, bytes_data=None, **kwargs):
+        if bytes_data is not None and self.binary:
+            try:
+                content = decode_frame(bytes_data)
+            except ValueError:
+                await self.send_json({"type": "error", "detail": "malformed frame"})
                 return
+            await self.receive_json(content, **kwargs)
+        else:
+            await super().receive(text_data=text_data, bytes_data=bytes_data, **kwargs)
 
-            try:
-                # First verify thread membership
-                is_member = await self._is_participant(self.thread_id, self.user.id)
-                if not is_member:
-                    await self.send_json({
-                        "type": "error",
-                        "detail": "You are not a member of this thread"
-                    })
-                    return
-
-                # Create and encrypt the message
-                msg_id, created_iso = await self._create_message(self.thread_id, self.user.id, body)
-                logger.info(f"Created message {msg_id} in thread {self.thread_id}")
-                
-                # Send confirmation back to sender first
+    async def _close_slow(self):
+        logger.warning("Closing slow WebSocket consumer for user %s", self.user.id)
+        await self.close(code=SLOW_CONSUMER_CLOSE_CODE)
+
+    # ---------- actions ----------
+
+    async def _send_message(self, thread_id: int, body, ref=None):
+        body = (body or "").strip()
+        if not body or len(body) > 5000:
+            await self.send_json({
+                "type": "error",
+                "thread": thread_id,
+                "detail": "Message must be between 1 and 5000 characters"
+            })
+            return
+
+        allowed, retry_after = await check_send_rate(self.user.id)
+        if not allowed:
+            await self.send_json({
+                "type": "error",
+                "thread": thread_id,
+                "detail": "Rate limit exceeded",
+                "retry_after": round(retry_after, 2),
+            })
+            return
+
+        if not await self.can_post(thread_id):
+            await self.send_json({
+                "type": "error",
+                "thread": thread_id,
+                "detail": "You are not a member of this thread"
+            })
+            return
+
+        try:
+            # Create and encrypt the message
+            msg_id, created_iso = await self._create_message(thread_id, self.user.id, body)
+            logger.debug("Created message %s in thread %s", msg_id, thread_id)
+
+            # Send confirmation back to sender first; binary clients get an
+            # id-only ack since they already have the body
+            if self.binary:
+                confirmation = {"type": "message_sent", "id": msg_id, "thread": thread_id}
+            else:
                 confirmation = {
                     "type": "message_sent",
                     "id": msg_id,
-                    "thread": self.thread_id,
+                    "thread": thread_id,
                     "body": body,
                     "created_at": created_iso,
                     "sender": self.user.username
                 }
-                await self.send_json(confirmation)
-                print(f"Sent confirmation to sender for message {msg_id}")  # Debug log
+            if ref is not None:
+                confirmation["ref"] = ref  # client's correlation token, echoed as-is
+            await self.send_json(confirmation)
 
-                # Then broadcast to all participants
-                broadcast = {
-                    "type": "chat.message",
-                    "event": "message_new",
-                    "id": msg_id,
-                    "thread": self.thread_id,
-                    "sender": self.user.username,
-                    "body": body,
-                    "created_at": created_iso,
-                }
-                await self.channel_layer.group_send(self.group, broadcast)
-                print(f"Broadcast message {msg_id} to group {self.group}")  # Debug log
-                
-            except Exception as e:
-                error_msg = str(e)
-                print(f"Message send error in thread {self.thread_id}: {error_msg}")
-                await self.send_json({
-                    "type": "error",
-                    "detail": "Failed to send message. Please try again."
-                })
-            return
+            # Then broadcast to the thread, plus an inbox update to every member
+            events = new_message_events(
+                thread_id, msg_id, self.user.username, body, created_iso, await self._member_ids(thread_id)
+            )
+            with stage_timer("group_send"):
+                for group, event in events:
+                    await self.channel_layer.group_send(group, event)
 
-        elif action == "seen":
-            message_id = content.get("message_id")
-            if message_id:
-                try:
-                    # Mark message as seen and schedule deletion
-                    await self._mark_message_seen(int(message_id))
-                    
-                    # Notify other participants
-                    await self.channel_layer.group_send(
-                        self.group,
-                        {
-                            "type": "chat.message",
-                            "event": "message_seen",
-                            "id": int(message_id),
-                            "seen_by": self.user.username,
-                            "seen_at": timezone.now().isoformat(),
-                        },
-                    )
-                except Exception as e:
-                    print(f"Error marking message {message_id} as seen: {e}")
+        except Exception:
+            logger.exception("Message send failed in thread %s for user %s", thread_id, self.user.id)
+            await self.send_json({
+                "type": "error",
+                "thread": thread_id,
+                "detail": "Failed to send message. Please try again."
+            })
+
+    def _queue_seen(self, thread_id: int, message_id: int):
+        # Individual acks are debounced and flushed as one batch per thread
+        self._pending_seen.setdefault(thread_id, set()).add(message_id)
+        if self._seen_flush is None:
+            self._seen_flush = asyncio.get_running_loop().call_later(SEEN_DEBOUNCE_SECONDS, self._start_seen_flush)
+
+    def _start_seen_flush(self):
+        self._seen_flush = None
+        self._seen_task = asyncio.ensure_future(self._flush_seen())
+
+    async def _seen_up_to(self, thread_id: int, up_to_id):
+        try:
+            up_to_id = int(up_to_id)
+        except (TypeError, ValueError):
+            await self.send_json({"type": "error", "thread": thread_id, "detail": "message_id required"})
             return
+        try:
+            await self._ack_seen(thread_id, up_to_id=up_to_id)
+        except Exception:
+            logger.exception("Could not mark thread %s seen up to %s", thread_id, up_to_id)
 
-        else:
-            await self.send_json({"type": "error", "detail": "unknown action"})
+    # ---------- channel-layer events ----------
 
     async def chat_message(self, event):
         """Handle incoming chat messages from the channel layer"""
+        if self._recent is not None and event.get("thread") in self._tracked:
+            if event.get("event") == "message_new":
+                self._recent.add(event["thread"], {
+                    "id": event["id"],
+                    "sender": event["sender"],
+                    "body": event["body"],
+                    "created_at": event["created_at"],
+                })
+            elif event.get("event") == "messages_seen" and event.get("delete_after"):
+                self._recent.expire(
+                    event["thread"], event["delete_after"], event["seen_by"],
+                    ids=event.get("ids"), up_to_id=event["up_to_id"],
+                )
+
         # Skip if this is a new message and we're the sender (who already got confirmation)
         if event.get("event") == "message_new" and event.get("sender") == self.user.username:
             return
-            
+
         # For all other cases, relay the message to the WebSocket
         try:
-            await self.send_json(event)
-        except Exception as e:
-            print(f"Failed to send message to websocket for user {self.user.username}: {e}")
+            with stage_timer("fanout_send"):
+                await self.send_json(event)
+        except Exception:
+            logger.exception("Failed to relay %s to user %s", event.get("event"), self.user.id)
+
+    async def membership_added(self, event):
+        self._members.pop(event["thread"], None)
+
+    async def messages_deleted(self, event):
+        if self._recent is not None:
+            self._recent.discard(event["thread"], event["ids"])
+        await self.send_json({"type": "messages_deleted", "thread": event["thread"], "ids": event["ids"]})
 
     # ---------- helpers ----------
 
-    @database_sync_to_async
-    def _is_participant(self, thread_id: int, user_id: int) -> bool:
-        return MessageThread.objects.filter(id=thread_id, participants__id=user_id).exists()
+    def _track(self, thread_id: int):
+        """Call once this socket is in the thread's group."""
+        if self._recent is not None and thread_id not in self._tracked:
+            self._recent.subscribe(thread_id)
+            self._tracked.add(thread_id)
+
+    def _untrack(self, thread_id: int):
+        if thread_id in self._tracked:
+            self._tracked.discard(thread_id)
+            self._recent.unsubscribe(thread_id)
+
+    def _replay(self, thread_id: int) -> dict:
+        """Fields adding recent history to a ready/subscribed frame, when this process has it."""
+        snapshot = self._recent.snapshot(thread_id) if self._recent is not None else None
+        if snapshot is None:
+            return {}
+        messages, next_cursor = snapshot
+        return {"recent": messages, "next_cursor": next_cursor}
+
+    async def _is_participant(self, thread_id: int, user_id: int) -> bool:
+        return await ThreadMembership.objects.ais_member(thread_id, user_id)
+
+    def _in_thread_group(self, thread_id: int) -> bool:
+        return False
+
+    async def _member_ids(self, thread_id: int):
+        cached = self._members.get(thread_id)
+        if cached is None or cached[1] < time.monotonic():
+            ids = await athread_member_ids(thread_id)
+            if not self._in_thread_group(thread_id):
+                return ids  # would never hear a revocation to invalidate it
+            cached = self._members[thread_id] = (ids, time.monotonic() + MEMBER_CACHE_SECONDS)
+        return cached[0]
 
-    @database_sync_to_async
-    def _create_message(self, thread_id: int, sender_id: int, body: str):
-        from django.db import transaction
-        
+    async def _create_message(self, thread_id: int, sender_id: int, body: str):
         try:
-            with transaction.atomic():
-                # Create message with encryption
-                msg = Message.objects.create(
-                    thread_id=thread_id,
-                    sender_id=sender_id,
-                    enc_body=''  # Will be set by set_plain_body
-                )
-                
-                # Encrypt the message body
-                msg.set_plain_body(body)
-                msg.save()
-                
-                # Verify encryption worked by trying to decrypt
-                try:
-                    decrypted = msg.get_plain_body()
-                    if not decrypted or decrypted != body:
-                        raise ValueError("Message verification failed")
-                except Exception as e:
-                    print(f"Message verification error: {e}")
-                    raise
-                
-                print(f"Message created and verified: {msg.id}")  # Debug log
-                return msg.id, msg.created_at.isoformat()
-                
+            if write_buffer_enabled():
+                msg = await get_write_buffer().submit(thread_id, sender_id, body)
+            else:
+                msg = await acreate_message(thread_id, sender_id, body)
         except Exception as e:
-                print(f"Error in message creation: {str(e)}")
-                # The transaction will roll back automatically
-                raise ValueError(f"Failed to create message: {str(e)}")
-
-    @database_sync_to_async
-    def _mark_message_seen(self, message_id: int):
-        """Mark a message as seen and schedule deletion"""
-        from django.utils import timezone
-        from datetime import timedelta
-        from .tasks import delete_message_task
-        
-        try:
-            # Get message and verify thread membership
-            message = Message.objects.select_related('thread').get(
-                id=message_id,
-                thread__participants=self.user
-            )
-            
-            # Set seen timestamp and deletion timer
-            now = timezone.now()
-            message.seen_at = now
-            message.delete_after = now + timedelta(minutes=5)
-            message.save(update_fields=['seen_at', 'delete_after'])
-            
-            # Schedule deletion task
-            delete_message_task.apply_async(
-                args=[message_id],
-                eta=message.delete_after
+            logger.warning("Message creation failed in thread %s: %s", thread_id, e)
+            raise ValueError(f"Failed to create message: {str(e)}")
+        created_iso = msg.created_at.isoformat()
+        if self._recent is not None and thread_id in self._tracked:
+            self._recent.add(thread_id, {"id": msg.id, "sender": self.user.username, "body": body, "created_at": created_iso})
+        return msg.id, created_iso
+
+    async def _flush_seen(self):
+        if self._seen_flush is not None:
+            self._seen_flush.cancel()
+            self._seen_flush = None
+        pending, self._pending_seen = self._pending_seen, {}
+        for thread_id, ids in pending.items():
+            try:
+                await self._ack_seen(thread_id, message_ids=ids)
+            except Exception:
+                logger.exception("Could not mark %s messages seen in thread %s", len(ids), thread_id)
+
+    async def _ack_seen(self, thread_id: int, message_ids=None, up_to_id=None):
+        """One UPDATE + one broadcast for the whole batch."""
+        if not await self.can_post(thread_id):
+            return
+        result = await amark_seen(thread_id, self.user, message_ids=message_ids, up_to_id=up_to_id)
+        if result and result["count"]:
+            await self.channel_layer.group_send(
+                thread_group(thread_id), seen_event(thread_id, self.user.username, result)
             )
-            
-        except Message.DoesNotExist:
-            raise ValueError(f"Message {message_id} not found or access denied")
-        except Exception as e:
-            raise ValueError(f"Error marking message as seen: {e}")
\ No newline at end of file
+
+
+class ThreadConsumer(MessagingConsumer):
+    """
+    WebSocket for a single thread.
+    Expects URL pattern: ws/threads/<int:thread_id>/ or ws/msg/thread/<int:thread_id>/
+    """
+
+    async def connect(self):
+        with stage_timer("connect"):
+            await self._connect()
+
+    async def _connect(self):
+        if not await self._authenticate():
+            return
+
+        try:
+            self.thread_id = int(self.scope["url_route"]["kwargs"]["thread_id"])
+        except Exception:
+            await self.close(code=4002)  # bad path
+            return
+
+        # Membership check; held for the connection's lifetime and dropped by a
+        # membership.revoked / thread.deleted event (see services.notify_*)
+        with stage_timer("membership_check"):
+            self.is_member = await self._is_participant(self.thread_id, self.user.id)
+        if not self.is_member:
+            logger.info("WebSocket rejected: user %s is not in thread %s", self.user.id, self.thread_id)
+            await self.close(code=4001)  # not a participant
+            return
+
+        self.group = thread_group(self.thread_id)
+        await self.channel_layer.group_add(self.group, self.channel_name)
+        await self._accept()
+        self._track(self.thread_id)
+        await self.send_json({
+            "type": "ready", "thread": self.thread_id, "user": self.user.username, **self._replay(self.thread_id)
+        })
+
+    async def disconnect(self, code):
+        if hasattr(self, "group"):
+            await self._close_down()
+            await self.channel_layer.group_discard(self.group, self.channel_name)
+
+    async def can_post(self, thread_id: int) -> bool:
+        return thread_id == self.thread_id and self.is_member
+
+    def _in_thread_group(self, thread_id: int) -> bool:
+        return thread_id == self.thread_id
+
+    async def receive_json(self, content, **kwargs):
+        action = (content.get("action") or "").lower()
+
+        if action == "ack":
+            await self._outbox.ack(content.get("count"))
+
+        elif action == "send":
+            await self._send_message(self.thread_id, content.get("body"), content.get("ref"))
+
+        elif action == "seen":
+            try:
+                message_id = int(content.get("message_id"))
+            except (TypeError, ValueError):
+                return
+            self._queue_seen(self.thread_id, message_id)
+
+        elif action == "seen_up_to":
+            await self._seen_up_to(self.thread_id, content.get("message_id"))
+
+        else:
+            await self.send_json({"type": "error", "detail": "unknown action"})
+
+    async def membership_revoked(self, event):
+        """A participant was removed; if it's us, stop serving this thread."""
+        self._members.pop(self.thread_id, None)  # stop fanning inbox updates out to them
+        if event.get("user_id") != self.user.id:
+            return
+        self.is_member = False
+        await self.send_json({"type": "membership_revoked", "thread": self.thread_id})
+        await self.close(code=4001)
+
+    async def thread_deleted(self, event):
+        self.is_member = False
+        await self.send_json({"type": "thread_deleted", "thread": self.thread_id})
+        await self.close(code=4004)
+
+
+class UserConsumer(MessagingConsumer):
+    """
+    One multiplexed WebSocket per user (ws/user/), replacing a socket per
+    open thread. The connection always joins user.<id> for inbox updates
+    and joins a thread's group on {"action": "subscribe", "thread": id}.
+    Every frame in either direction names its thread.
+
+    Membership is checked once per thread and cached for the connection;
+    membership.revoked and thread.deleted also arrive on the user group, so
+    they still apply to threads the socket posts to without subscribing.
+    """
+
+    async def connect(self):
+        with stage_timer("connect"):
+            if not await self._authenticate():
+                return
+            self.group = user_group(self.user.id)
+            self.member_of = set()    # membership verified
+            self.deleted = set()      # threads already reported deleted
+            self.subscribed = set()   # thread groups joined
+            await self.channel_layer.group_add(self.group, self.channel_name)
+            await self._accept()
+            await self.send_json({"type": "ready", "user": self.user.username})
+
+    async def disconnect(self, code):
+        if hasattr(self, "group"):
+            await self._close_down()
+            for thread_id in self.subscribed:
+                await self.channel_layer.group_discard(thread_group(thread_id), self.channel_name)
+            await self.channel_layer.group_discard(self.group, self.channel_name)
+
+    async def can_post(self, thread_id: int) -> bool:
+        if thread_id not in self.member_of:
+            with stage_timer("membership_check"):
+                if not await self._is_participant(thread_id, self.user.id):
+                    return False
+            self.member_of.add(thread_id)
+        return True
+
+    def _in_thread_group(self, thread_id: int) -> bool:
+        return thread_id in self.subscribed
+
+    async def receive_json(self, content, **kwargs):
+        action = (content.get("action") or "").lower()
+        if action == "ack":
+            await self._outbox.ack(content.get("count"))
+            return
+        try:
+            thread_id = int(content.get("thread"))
+        except (TypeError, ValueError):
+            await self.send_json({"type": "error", "detail": "thread required"})
+            return
+
+        if action == "subscribe":
+            if not await self.can_post(thread_id):
+                await self.send_json({"type": "error", "thread": thread_id, "detail": "You are not a member of this thread"})
+                return
+            if thread_id not in self.subscribed:
+                await self.channel_layer.group_add(thread_group(thread_id), self.channel_name)
+                self.subscribed.add(thread_id)
+                self._track(thread_id)
+            await self.send_json({"type": "subscribed", "thread": thread_id, **self._replay(thread_id)})
+
+        elif action == "unsubscribe":
+            await self._leave(thread_id)
+            await self.send_json({"type": "unsubscribed", "thread": thread_id})
+
+        elif action == "send":
+            await self._send_message(thread_id, content.get("body"), content.get("ref"))
+
+        elif action == "seen":
+            try:
+                message_id = int(content.get("message_id"))
+            except (TypeError, ValueError):
+                return
+            self._queue_seen(thread_id, message_id)
+
+        elif action == "seen_up_to":
+            await self._seen_up_to(thread_id, content.get("message_id"))
+
+        else:
+            await self.send_json({"type": "error", "thread": thread_id, "detail": "unknown action"})
+
+    async def inbox_update(self, event):
+        with stage_timer("fanout_send"):
+            await self.send_json({**event, "type": "inbox_update"})
+
+    async def membership_revoked(self, event):
+        # Sent to both the thread and user groups, so this may arrive twice
+        thread_id = event["thread"]
+        self._members.pop(thread_id, None)  # stop fanning inbox updates out to them
+        if event.get("user_id") != self.user.id:
+            return
+        was_known = thread_id in self.member_of or thread_id in self.subscribed
+        self.member_of.discard(thread_id)
+        await self._leave(thread_id)
+        if was_known:
+            await self.send_json({"type": "membership_revoked", "thread": thread_id})
+
+    async def thread_deleted(self, event):
+        # Sent to both the thread and user groups, so this may arrive twice
+        thread_id = event["thread"]
+        if thread_id in self.deleted:
+            return
+        self.deleted.add(thread_id)
+        self.member_of.discard(thread_id)
+        await self._leave(thread_id)
+        await self.send_json({"type": "thread_deleted", "thread": thread_id})
+
+    async def _leave(self, thread_id: int):
+        self._pending_seen.pop(thread_id, None)
+        self._members.pop(thread_id, None)
+        if thread_id in self.subscribed:
+            self.subscribed.discard(thread_id)
+            self._untrack(thread_id)
+            await self.channel_layer.group_discard(thread_group(thread_id), self.channel_name)
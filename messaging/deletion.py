@@ -0,0 +1,82 @@
+# messaging/deletion.py
+"""
+Batched deletes for cleanups that may touch millions of rows.
+
+QuerySet.delete() collects every object and its cascade into memory and
+removes them in one transaction. batched_delete() instead walks the
+queryset in primary-key order, one short transaction per batch:
+
+  * the batch's rows are locked and the queryset's filter is applied again
+    inside the transaction, so a row that stopped matching since it was
+    picked (e.g. an "empty" thread that just received a message) is
+    skipped rather than deleted along with its new children;
+  * each batch goes through QuerySet.delete(). With a bounded batch the
+    collector stays small, and Django still deletes without loading rows
+    when nothing observes or depends on them (no delete signals, no
+    cascades), e.g. expired messages;
+  * the last primary key handled is returned as a checkpoint, so an
+    interrupted run resumes with after_id.
+"""
+import time
+
+from django.db import transaction
+
+DEFAULT_BATCH_SIZE = 1000
+
+
+def batched_delete(
+    queryset,
+    batch_size: int = DEFAULT_BATCH_SIZE,
+    sleep: float = 0.0,
+    after_id=0,
+    max_batches=None,
+    before_batch=None,
+    progress=None,
+) -> dict:
+    """
+    Delete every row of `queryset` in batches of `batch_size`, pausing
+    `sleep` seconds between batches.
+
+    `before_batch(pks)` runs inside each batch's transaction just before
+    the DELETE, with the rows that still match; `progress(stats)` is called
+    after each batch. Stops after `max_batches` if given. Returns
+    {"deleted", "cascaded", "skipped", "batches", "last_id", "complete"};
+    pass last_id back as `after_id` to resume.
+    """
+    model, using = queryset.model, queryset.db
+    label = model._meta.label
+    stats = {"deleted": 0, "cascaded": 0, "skipped": 0, "batches": 0, "last_id": after_id, "complete": False}
+
+    while max_batches is None or stats["batches"] < max_batches:
+        picked = list(
+            queryset.filter(pk__gt=stats["last_id"]).order_by("pk").values_list("pk", flat=True)[:batch_size]
+        )
+        if not picked:
+            stats["complete"] = True
+            break
+
+        with transaction.atomic(using=using):
+            # Lock first (an insert referencing a locked row waits for us), then
+            # re-check the caller's filter; it may not allow FOR UPDATE itself
+            locked = list(
+                model._base_manager.using(using).filter(pk__in=picked).select_for_update().values_list("pk", flat=True)
+            )
+            pks = list(queryset.filter(pk__in=locked).values_list("pk", flat=True))
+            stats["skipped"] += len(picked) - len(pks)
+            if pks:
+                if before_batch is not None:
+                    before_batch(pks)
+                total, per_model = model._base_manager.using(using).filter(pk__in=pks).delete()
+                stats["deleted"] += per_model.get(label, 0)
+                stats["cascaded"] += total - per_model.get(label, 0)
+
+        stats["batches"] += 1
+        stats["last_id"] = picked[-1]
+        if progress is not None:
+            progress(stats)
+        if len(picked) < batch_size:
+            stats["complete"] = True
+            break
+        if sleep:
+            time.sleep(sleep)
+    return stats
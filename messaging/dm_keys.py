@@ -0,0 +1,140 @@
+# messaging/dm_keys.py
+"""
+Backfill of MessageThread.dm_key for threads created before the column
+existed, merging duplicate 1:1 threads into one canonical thread.
+
+Message ciphertexts are bound to their thread (per-thread key and AAD),
+so moving a message means decrypting it under the old thread and
+re-encrypting it under the new one. Each chunk of a merge is its own
+transaction and only touches rows still in the source thread, so an
+interrupted run is simply picked up again on the next pass.
+"""
+import logging
+
+from django.db import IntegrityError, transaction
+from django.db.models import Count
+
+from crypto_core.aes import encrypt_many
+from crypto_core.keys import current_key_version, derive_message_key
+
+from .models import (
+    Message,
+    MessageThread,
+    ThreadMembership,
+    dm_key_for,
+    message_aad,
+    message_compress_min,
+)
+from .services import notify_threads_deleted
+
+logger = logging.getLogger(__name__)
+
+
+def unkeyed_dm_threads():
+    """Threads without a dm_key that have exactly two members."""
+    return (
+        MessageThread.objects.filter(dm_key__isnull=True)
+        .annotate(member_count=Count("memberships"))
+        .filter(member_count=2)
+    )
+
+
+def _move_messages(source_id: int, target_id: int, batch_size: int) -> int:
+    """Re-encrypt and re-home the source thread's messages; returns how many could not be decrypted."""
+    version = current_key_version()
+    key = derive_message_key(target_id, version)
+    compress_min = message_compress_min()
+    after_id, failed = 0, 0
+    while True:
+        with transaction.atomic():
+            rows = list(
+                Message.objects.filter(thread_id=source_id, id__gt=after_id)
+                .order_by("id")
+                .select_for_update()
+                .only("id", "thread_id", "sender_id", "enc_blob", "enc_body", "key_version")[:batch_size]
+            )
+            if not rows:
+                return failed
+            bodies = Message.objects.decrypt_bodies(rows)
+            movable = [m for m in rows if bodies.get(m.id) is not None]
+            failed += len(rows) - len(movable)
+            blobs = encrypt_many(
+                [(bodies[m.id], message_aad(m.sender_id, target_id)) for m in movable], key, compress_min
+            )
+            for m, blob in zip(movable, blobs):
+                m.thread_id, m.enc_blob, m.enc_body, m.key_version = target_id, blob, "", version
+            Message.objects.bulk_update(movable, ["thread", "enc_blob", "enc_body", "key_version"])
+        after_id = rows[-1].id
+
+
+def _refresh_inbox(thread_id: int):
+    """Point the thread's denormalized last_* columns at its newest message."""
+    thread = MessageThread.objects.get(id=thread_id)
+    latest = Message.objects.filter(thread_id=thread_id).order_by("-id").first()
+    if latest is None or latest.id == thread.last_message_id:
+        return
+    preview, version = thread.encrypt_preview(latest.get_plain_body())
+    MessageThread.objects.filter(id=thread_id).update(
+        last_message_id=latest.id,
+        last_activity_at=latest.created_at,
+        last_preview=preview,
+        last_preview_key_version=version,
+    )
+
+
+def merge_thread_into(source_id: int, target_id: int, batch_size: int = 500) -> bool:
+    """
+    Move everything from a duplicate DM thread into the canonical one and
+    delete the duplicate. Returns False (leaving the source in place) if
+    some messages could not be decrypted and so could not be moved.
+    """
+    failed = _move_messages(source_id, target_id, batch_size)
+    with transaction.atomic():
+        for user_id, last_read in ThreadMembership.objects.filter(thread_id=source_id).values_list(
+            "user_id", "last_read_message_id"
+        ):
+            ThreadMembership.objects.mark_read(target_id, user_id, last_read)
+        if not failed:
+            notify_threads_deleted([source_id])
+            MessageThread.objects.filter(id=source_id).delete()
+    _refresh_inbox(target_id)
+    if failed:
+        logger.warning("DM merge %s -> %s: %s messages could not be decrypted; source kept", source_id, target_id, failed)
+    return not failed
+
+
+def backfill_dm_keys_batch(after_id: int = 0, batch_size: int = 500):
+    """
+    Key or merge the next batch of unkeyed two-member threads with id > after_id.
+    The lowest-id thread of a pair becomes canonical unless a keyed thread
+    already exists. Returns (keyed, merged, kept, last_id); last_id is None
+    when nothing is left.
+    """
+    threads = list(
+        unkeyed_dm_threads().filter(id__gt=after_id).order_by("id").values_list("id", flat=True)[:batch_size]
+    )
+    if not threads:
+        return 0, 0, 0, None
+
+    members = {}
+    for thread_id, user_id in ThreadMembership.objects.filter(thread_id__in=threads).values_list("thread_id", "user_id"):
+        members.setdefault(thread_id, []).append(user_id)
+
+    keyed = merged = kept = 0
+    for thread_id in threads:
+        key = dm_key_for(*members[thread_id])
+        canonical = MessageThread.objects.filter(dm_key=key).values_list("id", flat=True).first()
+        if canonical is None:
+            try:
+                with transaction.atomic():
+                    MessageThread.objects.filter(id=thread_id).update(dm_key=key)
+                keyed += 1
+                continue
+            except IntegrityError:
+                # A live request created the keyed thread meanwhile; merge into it
+                canonical = MessageThread.objects.get(dm_key=key).id
+        if merge_thread_into(thread_id, canonical, batch_size):
+            merged += 1
+        else:
+            kept += 1
+    return keyed, merged, kept, threads[-1]
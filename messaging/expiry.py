@@ -0,0 +1,117 @@
+# messaging/expiry.py
+"""
+Self-destruct sweep for seen messages.
+
+Instead of one ETA task per message (which Redis-backed workers hold in
+memory until due), deadlines stay in the indexed Message.delete_after
+column and a periodic beat job sweeps them. Due deadlines are grouped into
+fixed-width time buckets and each bucket is drained oldest-first in
+bounded batches (messaging.deletion), so every query is a short range
+scan on the index and a worker never holds more than one batch of ids.
+"""
+import logging
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.utils import timezone
+
+from .deletion import batched_delete
+from .metrics import EXPIRY_DUE, EXPIRY_LAG_SECONDS, on_scrape
+from .models import Message
+from .services import before_messages_deleted
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BUCKET_SECONDS = 60
+DEFAULT_BATCH_SIZE = 500
+DEFAULT_MAX_BATCHES = 200
+
+
+def bucket_seconds() -> int:
+    return max(1, int(getattr(settings, "MESSAGE_EXPIRY_BUCKET_SECONDS", DEFAULT_BUCKET_SECONDS)))
+
+
+def bucket_start(dt):
+    """Floor a deadline to the start of its bucket."""
+    width = bucket_seconds()
+    ts = dt.timestamp()
+    return dt - timedelta(seconds=ts % width)
+
+
+def pending_expiry():
+    return Message.objects.filter(delete_after__isnull=False)
+
+
+def expiry_lag(now=None) -> dict:
+    """
+    How far behind the sweep is: number of overdue messages and how long
+    the oldest has been overdue (0 when nothing is due).
+    """
+    now = now or timezone.now()
+    due = pending_expiry().filter(delete_after__lte=now)
+    oldest = due.order_by("delete_after").values_list("delete_after", flat=True).first()
+    lag = {
+        "due": due.count(),
+        "oldest_due": oldest,
+        "lag_seconds": (now - oldest).total_seconds() if oldest else 0.0,
+    }
+    EXPIRY_DUE.set(lag["due"])
+    EXPIRY_LAG_SECONDS.set(lag["lag_seconds"])
+    return lag
+
+
+@on_scrape
+def _refresh_expiry_gauges():
+    # The sweep runs on a Celery worker; read the backlog from the database so
+    # whichever process serves /metrics reports it.
+    expiry_lag()
+
+
+def sweep_expired(now=None, batch_size=None, max_batches=None) -> dict:
+    """
+    Delete messages whose deadline has passed, one due bucket at a time.
+
+    Stops after `max_batches` so a backlog is worked off across several
+    beat runs instead of one unbounded job. Returns counters plus the
+    remaining lag for monitoring.
+    """
+    now = now or timezone.now()
+    batch_size = batch_size or int(getattr(settings, "MESSAGE_EXPIRY_BATCH_SIZE", DEFAULT_BATCH_SIZE))
+    max_batches = max_batches or int(getattr(settings, "MESSAGE_EXPIRY_MAX_BATCHES", DEFAULT_MAX_BATCHES))
+    width = timedelta(seconds=bucket_seconds())
+    started = time.monotonic()
+
+    deleted = batches = buckets = 0
+    due = pending_expiry().filter(delete_after__lte=now)
+    while batches < max_batches:
+        oldest = due.order_by("delete_after").values_list("delete_after", flat=True).first()
+        if oldest is None:
+            break
+        # Everything up to the end of the oldest bucket (capped at now)
+        bucket_end = min(bucket_start(oldest) + width, now)
+        buckets += 1
+        result = batched_delete(
+            due.filter(delete_after__lte=bucket_end),
+            batch_size=batch_size,
+            max_batches=max_batches - batches,
+            before_batch=before_messages_deleted,
+        )
+        deleted += result["deleted"]
+        batches += result["batches"]
+
+    stats = {
+        "deleted": deleted,
+        "batches": batches,
+        "buckets": buckets,
+        "duration_seconds": round(time.monotonic() - started, 3),
+        **expiry_lag(now),
+    }
+    if stats["lag_seconds"] > 2 * width.total_seconds():
+        logger.warning(
+            "Message expiry is behind: %(due)s due, oldest %(lag_seconds).0fs overdue "
+            "(deleted %(deleted)s in %(batches)s batches)", stats,
+        )
+    else:
+        logger.info("Message expiry swept %(deleted)s in %(batches)s batches over %(buckets)s buckets", stats)
+    return stats
@@ -0,0 +1,234 @@
+# messaging/flow_control.py
+"""
+Flow control for messaging WebSockets.
+
+  * A per-user token bucket on "send" frames (each costs a transaction and
+    a group_send). The "memory" backend is per process, enough for one
+    node; "redis" keeps the bucket in Redis so every node shares it.
+  * OutboundWindow, a per-connection credit window: the client acks the
+    frames it has processed, and one that falls more than the window
+    behind either has frames dropped (it is told how many, so it can
+    resync over REST) or is disconnected, per the configured policy.
+"""
+import asyncio
+import logging
+import threading
+import time
+
+from django.conf import settings
+
+from .metrics import OUTBOUND_DROPPED, RATE_LIMITED, SLOW_CONSUMERS_CLOSED
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_RATE = 5.0    # sends per second, sustained
+DEFAULT_BURST = 20
+DEFAULT_WINDOW = 256  # frames sent but not yet acked by the client
+SLOW_CONSUMER_CLOSE_CODE = 4008
+
+
+class MemoryTokenBucket:
+    def __init__(self, rate: float, burst: int):
+        self.rate, self.burst = float(rate), float(burst)
+        self._buckets = {}  # key -> (tokens, last refill)
+        self._lock = threading.Lock()
+
+    async def allow(self, key):
+        """Take one token; returns (allowed, retry_after_seconds)."""
+        now = time.monotonic()
+        with self._lock:
+            tokens, last = self._buckets.get(key, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - last) * self.rate)
+            allowed = tokens >= 1
+            if allowed:
+                tokens -= 1
+            self._buckets[key] = (tokens, now)
+            if len(self._buckets) > 10000:
+                # forget buckets that have refilled completely
+                full = now - self.burst / self.rate
+                self._buckets = {k: v for k, v in self._buckets.items() if v[1] > full}
+        return allowed, 0.0 if allowed else (1 - tokens) / self.rate
+
+
+# Refill and take atomically on the Redis server, using its clock
+_TOKEN_BUCKET_LUA = """
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local t = redis.call('TIME')
+local now = tonumber(t[1]) + tonumber(t[2]) / 1000000
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(state[1]) or burst
+local ts = tonumber(state[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - ts) * rate)
+local allowed = 0
+if tokens >= 1 then
+  tokens = tokens - 1
+  allowed = 1
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'ts', tostring(now))
+redis.call('EXPIRE', KEYS[1], math.ceil(burst / rate) + 1)
+return {allowed, tostring(tokens)}
+"""
+
+
+class RedisTokenBucket:
+    """
+    Token bucket shared by every node; fails open if Redis is unreachable.
+    An outage is logged once when it starts (then at most every
+    OUTAGE_LOG_INTERVAL seconds while it lasts) and once when it ends.
+    """
+
+    OUTAGE_LOG_INTERVAL = 60.0  # seconds
+
+    def __init__(self, rate: float, burst: int, url: str, prefix: str = "cloakpost:ratelimit:send:"):
+        self.rate, self.burst = float(rate), float(burst)
+        self.url, self.prefix = url, prefix
+        self._client = None
+        self._loop = None
+        self._failures = 0  # checks failed open since the outage began
+        self._last_logged = None
+
+    def _script(self):
+        import redis.asyncio as aioredis
+
+        loop = asyncio.get_running_loop()
+        if self._client is None or self._loop is not loop:
+            # redis.asyncio connections belong to the loop that opened them
+            self._client = aioredis.from_url(self.url)
+            self._loop = loop
+            self._lua = self._client.register_script(_TOKEN_BUCKET_LUA)
+        return self._lua
+
+    async def allow(self, key):
+        try:
+            allowed, tokens = await self._script()(keys=[f"{self.prefix}{key}"], args=[self.rate, self.burst])
+        except Exception as e:
+            self._failed(e)
+            return True, 0.0
+        if self._failures:
+            logger.warning("Rate limit Redis is back after %s sends were allowed unchecked", self._failures)
+            self._failures, self._last_logged = 0, None
+        if allowed:
+            return True, 0.0
+        return False, (1 - float(tokens)) / self.rate
+
+    def _failed(self, error):
+        self._failures += 1
+        now = time.monotonic()
+        if self._last_logged is None:
+            logger.exception("Rate limit check failed; allowing sends until Redis is back")
+        elif now - self._last_logged >= self.OUTAGE_LOG_INTERVAL:
+            logger.warning("Rate limit Redis still unreachable (%s); %s sends allowed unchecked", error, self._failures)
+        else:
+            return
+        self._last_logged = now
+
+
+_limiter = None
+_limiter_config = None
+
+
+def get_send_limiter():
+    """The configured per-user send limiter, or None when limiting is off."""
+    global _limiter, _limiter_config
+    rate = float(getattr(settings, "MESSAGE_RATE_LIMIT_PER_SECOND", DEFAULT_RATE))
+    burst = int(getattr(settings, "MESSAGE_RATE_LIMIT_BURST", DEFAULT_BURST))
+    backend = getattr(settings, "MESSAGE_RATE_LIMIT_BACKEND", "memory")
+    if rate <= 0:
+        return None
+    config = (backend, rate, burst)
+    if _limiter is None or _limiter_config != config:
+        if backend == "redis":
+            _limiter = RedisTokenBucket(rate, burst, getattr(settings, "REDIS_URL", "redis://127.0.0.1:6379/0"))
+        elif backend == "memory":
+            _limiter = MemoryTokenBucket(rate, burst)
+        else:
+            raise ValueError(f"MESSAGE_RATE_LIMIT_BACKEND must be 'memory' or 'redis', not {backend!r}")
+        _limiter_config = config
+    return _limiter
+
+
+async def check_send_rate(user_id: int):
+    """(allowed, retry_after) for one send by user_id; always allowed when limiting is off."""
+    limiter = get_send_limiter()
+    if limiter is None:
+        return True, 0.0
+    allowed, retry_after = await limiter.allow(user_id)
+    if not allowed:
+        RATE_LIMITED.inc()
+    return allowed, retry_after
+
+
+class OutboundWindow:
+    """
+    Credit-based flow control for one connection. The client reports how
+    many frames it has processed with {"action": "ack", "count": n}
+    (cumulative, so acks may be batched or lost); at most `size` frames may
+    be unacknowledged at once.
+
+    ASGI gives no view of the server's write buffer, so the client's acks
+    are the only signal that it is keeping up. A reader that stops acking
+    hits the window: policy "drop" discards further frames and, once it
+    acks again, tells it {"type": "frames_dropped", "count": n} so it can
+    resync over REST; policy "close" calls `on_close` to disconnect it.
+    Frames are handed straight to `send`; nothing is queued in the app.
+    """
+
+    def __init__(self, send, on_close, size: int = DEFAULT_WINDOW, policy: str = "drop"):
+        if policy not in ("drop", "close"):
+            raise ValueError(f"WS_OUTBOUND_OVERFLOW must be 'drop' or 'close', not {policy!r}")
+        self._send, self._on_close = send, on_close
+        self.size = max(1, int(size))
+        self.policy = policy
+        self.sent = 0
+        self.acked = 0
+        self.dropped = 0
+        self._closing = False
+
+    @property
+    def unacked(self) -> int:
+        return self.sent - self.acked
+
+    @property
+    def closing(self) -> bool:
+        return self._closing
+
+    async def send(self, frame) -> bool:
+        """Send `frame` if the window has room; False if it was dropped."""
+        if self._closing:
+            return False
+        if self.unacked < self.size:
+            self.sent += 1
+            await self._send(frame)
+            return True
+        OUTBOUND_DROPPED.inc()
+        if self.policy == "close":
+            self._closing = True
+            SLOW_CONSUMERS_CLOSED.inc()
+            await self._on_close()
+        else:
+            self.dropped += 1
+        return False
+
+    async def ack(self, count):
+        """Record the client's cumulative count of frames received."""
+        try:
+            count = int(count)
+        except (TypeError, ValueError):
+            return
+        self.acked = max(self.acked, min(count, self.sent))
+        if self.dropped and self.unacked < self.size:
+            dropped, self.dropped = self.dropped, 0
+            await self.send({"type": "frames_dropped", "count": dropped})
+
+    def stop(self):
+        self._closing = True
+
+
+def outbound_window_for(send, on_close) -> OutboundWindow:
+    return OutboundWindow(
+        send,
+        on_close,
+        size=getattr(settings, "WS_OUTBOUND_WINDOW", DEFAULT_WINDOW),
+        policy=getattr(settings, "WS_OUTBOUND_OVERFLOW", "drop"),
+    )
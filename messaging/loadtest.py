@@ -0,0 +1,253 @@
+# messaging/loadtest.py
+"""
+In-process load generator for the chat stack (see the loadtest_ws command).
+
+N users are spread over M threads and each opens a thread WebSocket
+against config.asgi.application through channels' WebsocketCommunicator,
+so the real consumer, channel layer (in-memory or Redis) and database are
+exercised without a network hop. Every user sends `messages` frames with
+Poisson arrivals at `rate` per second and acks a share of what it
+receives with "seen".
+
+Runs are repeatable: send schedules come from per-user RNGs derived from
+`seed`, and whether a delivery is acked depends only on (seed, user,
+message), not on arrival order.
+"""
+import asyncio
+import math
+import random
+import secrets
+import threading
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+
+from channels.db import database_sync_to_async
+from channels.testing import WebsocketCommunicator
+from django.contrib.auth import get_user_model
+from django.db import connections
+
+from .deletion import batched_delete
+from .models import MessageThread
+
+User = get_user_model()
+
+BODY_PREFIX = "loadtest:"
+ACK_EVERY = 16  # frames between flow-control acks
+
+
+def percentile(values, pct: float):
+    """Nearest-rank percentile of `values` (None when empty)."""
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = max(1, math.ceil(pct / 100.0 * len(ordered)))
+    return ordered[rank - 1]
+
+
+class QueryCounter:
+    """Counts SQL statements on the connections it is installed on."""
+
+    def __init__(self):
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def __call__(self, execute, sql, params, many, context):
+        with self._lock:
+            self.count += 1
+        return execute(sql, params, many, context)
+
+    def install(self):
+        for conn in connections.all():
+            conn.execute_wrappers.append(self)
+
+    def uninstall(self):
+        for conn in connections.all():
+            if self in conn.execute_wrappers:
+                conn.execute_wrappers.remove(self)
+
+
+@dataclass
+class LoadTestResult:
+    users: int
+    threads: int
+    sent: int = 0
+    confirmed: int = 0
+    errors: int = 0
+    expected_deliveries: int = 0
+    delivery_latencies: list = field(default_factory=list)  # seconds
+    confirm_latencies: list = field(default_factory=list)
+    seen_acks: int = 0
+    queries: int = 0
+    elapsed: float = 0.0
+
+    @property
+    def delivered(self) -> int:
+        return len(self.delivery_latencies)
+
+    @property
+    def messages_per_second(self) -> float:
+        return self.confirmed / self.elapsed if self.elapsed else 0.0
+
+    @property
+    def queries_per_message(self) -> float:
+        return self.queries / self.confirmed if self.confirmed else 0.0
+
+    def summary(self) -> dict:
+        def ms(values, pct):
+            value = percentile(values, pct)
+            return None if value is None else round(value * 1000, 2)
+
+        return {
+            "users": self.users,
+            "threads": self.threads,
+            "sent": self.sent,
+            "confirmed": self.confirmed,
+            "errors": self.errors,
+            "delivered": self.delivered,
+            "expected_deliveries": self.expected_deliveries,
+            "seen_acks": self.seen_acks,
+            "elapsed_s": round(self.elapsed, 3),
+            "messages_per_s": round(self.messages_per_second, 1),
+            "queries": self.queries,
+            "queries_per_message": round(self.queries_per_message, 2),
+            "delivery_ms": {f"p{p}": ms(self.delivery_latencies, p) for p in (50, 95, 99)},
+            "confirm_ms": {f"p{p}": ms(self.confirm_latencies, p) for p in (50, 95, 99)},
+        }
+
+
+def create_fixtures(users: int, threads: int):
+    """Users and threads for one run; user i joins thread i % threads."""
+    tag = secrets.token_hex(4)
+    created = [User.objects.create_user(username=f"loadtest_{tag}_{i}") for i in range(users)]
+    thread_objs = [MessageThread.objects.create() for _ in range(threads)]
+    for i, user in enumerate(created):
+        thread_objs[i % threads].participants.add(user)
+    return created, thread_objs
+
+
+def delete_fixtures(users, threads):
+    batched_delete(MessageThread.objects.filter(id__in=[t.id for t in threads]))
+    User.objects.filter(id__in=[u.id for u in users]).delete()
+
+
+class _Client:
+    def __init__(self, index, user, thread_id, members, seed, seen_ratio):
+        self.index, self.user, self.thread_id = index, user, thread_id
+        self.members = members  # sockets on the thread, including this one
+        self.seed, self.seen_ratio = seed, seen_ratio
+        self.comm = None
+        self.received = 0  # frames read, reported back in acks
+
+    def acks(self, seq: str) -> bool:
+        return random.Random(f"{self.seed}:{self.index}:{seq}").random() < self.seen_ratio
+
+
+class LoadTest:
+    def __init__(self, users, threads, messages: int = 20, rate: float = 1.0,
+                 seen_ratio: float = 0.5, seed: int = 1, drain_timeout: float = 10.0):
+        if len(users) < 2 * len(threads):
+            raise ValueError("Need at least two users per thread")
+        self.users, self.threads = users, threads
+        self.messages, self.rate = int(messages), float(rate)
+        self.seen_ratio, self.seed = float(seen_ratio), int(seed)
+        self.drain_timeout = float(drain_timeout)
+        self.result = LoadTestResult(users=len(users), threads=len(threads))
+        self._sent_at = {}  # seq -> send time
+        self._done = asyncio.Event()
+
+    async def run(self, application) -> LoadTestResult:
+        members = {}
+        for i in range(len(self.users)):
+            thread_id = self.threads[i % len(self.threads)].id
+            members[thread_id] = members.get(thread_id, 0) + 1
+        clients = []
+        for i, user in enumerate(self.users):
+            thread_id = self.threads[i % len(self.threads)].id
+            clients.append(_Client(i, user, thread_id, members[thread_id], self.seed, self.seen_ratio))
+        for client in clients:
+            client.comm = WebsocketCommunicator(application, f"/ws/threads/{client.thread_id}/")
+            client.comm.scope["user"] = client.user
+            connected, _ = await client.comm.connect()
+            if not connected:
+                raise RuntimeError(f"User {client.index} could not connect to thread {client.thread_id}")
+            await client.comm.receive_json_from()  # ready
+            client.received = 1
+
+        counter = QueryCounter()
+        # Django runs every sync DB call on asgiref's thread-sensitive executor
+        await database_sync_to_async(counter.install)()
+        readers = [asyncio.ensure_future(self._read(client)) for client in clients]
+        start = time.perf_counter()
+        try:
+            await asyncio.gather(*(self._send(client) for client in clients))
+            self._check_done()
+            try:
+                await asyncio.wait_for(self._done.wait(), self.drain_timeout)
+            except asyncio.TimeoutError:
+                pass
+            self.result.elapsed = time.perf_counter() - start
+            # let debounced seen acks flush before the count is read
+            await asyncio.sleep(0.3)
+        finally:
+            for reader in readers:
+                reader.cancel()
+            await asyncio.gather(*readers, return_exceptions=True)
+            await database_sync_to_async(counter.uninstall)()
+            self.result.queries = counter.count
+            for client in clients:
+                await client.comm.disconnect()
+        return self.result
+
+    async def _send(self, client):
+        rng = random.Random(f"{self.seed}:send:{client.index}")
+        for n in range(self.messages):
+            if self.rate > 0:
+                await asyncio.sleep(rng.expovariate(self.rate))
+            seq = f"{client.index}.{n}"
+            self._sent_at[seq] = time.perf_counter()
+            self.result.sent += 1
+            await client.comm.send_json_to({"action": "send", "body": f"{BODY_PREFIX}{seq}"})
+
+    async def _read(self, client):
+        while True:
+            frame = await client.comm.receive_json_from(timeout=3600)
+            now = time.perf_counter()
+            client.received += 1
+            if client.received % ACK_EVERY == 0:
+                await client.comm.send_json_to({"action": "ack", "count": client.received})
+            kind = frame.get("type")
+            body = frame.get("body") or ""
+            seq = body[len(BODY_PREFIX):] if body.startswith(BODY_PREFIX) else None
+            if kind == "message_sent" and seq in self._sent_at:
+                self.result.confirmed += 1
+                self.result.expected_deliveries += client.members - 1
+                self.result.confirm_latencies.append(now - self._sent_at[seq])
+            elif kind == "chat.message" and frame.get("event") == "message_new" and seq in self._sent_at:
+                self.result.delivery_latencies.append(now - self._sent_at[seq])
+                if client.acks(seq):
+                    self.result.seen_acks += 1
+                    await client.comm.send_json_to({"action": "seen", "message_id": frame["id"]})
+            elif kind == "error":
+                self.result.errors += 1
+            self._check_done()
+
+    def _check_done(self):
+        r = self.result
+        if r.confirmed + r.errors >= self.messages * len(self.users) and r.delivered >= r.expected_deliveries:
+            self._done.set()
+
+
+@contextmanager
+def channel_layer(layer: str, redis_url: str = None):
+    """Point CHANNEL_LAYERS at the in-memory layer or a Redis server for the run."""
+    from django.test import override_settings
+
+    if layer == "memory":
+        config = {"default": {"BACKEND": "channels.layers.InMemoryChannelLayer"}}
+    elif layer == "redis":
+        config = {"default": {"BACKEND": "channels_redis.core.RedisChannelLayer", "CONFIG": {"hosts": [redis_url]}}}
+    else:
+        raise ValueError(f"layer must be 'memory' or 'redis', not {layer!r}")
+    with override_settings(CHANNEL_LAYERS=config):
+        yield
@@ -0,0 +1,66 @@
+import base64
+import binascii
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from messaging.models import Message
+
+class Command(BaseCommand):
+    help = 'Convert legacy base64 enc_body text into the binary enc_blob column, in small batches'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000, help='Rows per transaction')
+        parser.add_argument(
+            '--sleep',
+            type=float,
+            default=0.05,
+            help='Seconds to pause between batches (keeps lock time and I/O bursts short)',
+        )
+        parser.add_argument(
+            '--dry-run',
+            action='store_true',
+            help='Only count rows that still need converting',
+        )
+
+    def handle(self, *args, **options):
+        pending = Message.objects.filter(enc_blob__isnull=True).exclude(enc_body="")
+
+        if options['dry_run']:
+            self.stdout.write(self.style.WARNING(f'{pending.count()} messages still stored as base64 (dry run)'))
+            return
+
+        batch_size = options['batch_size']
+        last_id = 0
+        converted = skipped = 0
+        while True:
+            # Keyset walk on id: each batch is an index range scan, and a rerun
+            # naturally resumes because converted rows drop out of `pending`.
+            with transaction.atomic():
+                rows = list(
+                    pending.filter(id__gt=last_id)
+                    .order_by("id")
+                    .only("id", "enc_body")[:batch_size]
+                )
+                if not rows:
+                    break
+                to_update = []
+                for m in rows:
+                    try:
+                        m.enc_blob = base64.b64decode(m.enc_body, validate=True)
+                    except (binascii.Error, ValueError):
+                        skipped += 1
+                        continue
+                    m.enc_body = ""
+                    to_update.append(m)
+                Message.objects.bulk_update(to_update, ["enc_blob", "enc_body"])
+
+            converted += len(to_update)
+            last_id = rows[-1].id
+            self.stdout.write(f'Converted {converted} messages (last id {last_id})')
+            if options['sleep']:
+                time.sleep(options['sleep'])
+
+        self.stdout.write(
+            self.style.SUCCESS(f'Backfill complete: {converted} converted, {skipped} unreadable rows left as-is')
+        )
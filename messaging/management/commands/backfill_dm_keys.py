@@ -0,0 +1,36 @@
+import time
+
+from django.core.management.base import BaseCommand
+from messaging.dm_keys import backfill_dm_keys_batch, unkeyed_dm_threads
+
+class Command(BaseCommand):
+    help = 'Set dm_key on existing 1:1 threads and merge duplicate DM threads, in batches'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500, help='Threads per batch (and messages per re-encryption chunk)')
+        parser.add_argument('--sleep', type=float, default=0.05, help='Seconds to pause between batches')
+        parser.add_argument('--after-id', type=int, default=0, help='Resume after this thread id')
+
+    def handle(self, *args, **options):
+        remaining = unkeyed_dm_threads().filter(id__gt=options['after_id']).count()
+        self.stdout.write(f'{remaining} two-member threads without a dm_key')
+
+        last_id = options['after_id']
+        keyed = merged = kept = 0
+        while True:
+            k, m, bad, batch_last = backfill_dm_keys_batch(last_id, options['batch_size'])
+            if batch_last is None:
+                break
+            keyed += k
+            merged += m
+            kept += bad
+            last_id = batch_last
+            self.stdout.write(f'{keyed} keyed, {merged} merged (checkpoint --after-id {last_id})')
+            if options['sleep']:
+                time.sleep(options['sleep'])
+
+        msg = f'DM key backfill complete: {keyed} keyed, {merged} duplicates merged'
+        if kept:
+            self.stdout.write(self.style.WARNING(f'{msg}, {kept} duplicates kept (undecryptable messages)'))
+        else:
+            self.stdout.write(self.style.SUCCESS(msg))
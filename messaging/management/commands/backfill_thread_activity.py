@@ -0,0 +1,56 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Max
+from messaging.models import Message, MessageThread
+
+class Command(BaseCommand):
+    help = 'Fill last_message_id / last_activity_at / preview on existing threads, in batches'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500, help='Threads per transaction')
+        parser.add_argument('--sleep', type=float, default=0.05, help='Seconds to pause between batches')
+        parser.add_argument('--after-id', type=int, default=0, help='Resume after this thread id')
+
+    def handle(self, *args, **options):
+        last_id = options['after_id']
+        done = 0
+        while True:
+            with transaction.atomic():
+                threads = list(
+                    MessageThread.objects.filter(id__gt=last_id)
+                    .order_by("id")
+                    .only("id", "created_at")[:options['batch_size']]
+                )
+                if not threads:
+                    break
+                latest_ids = (
+                    Message.objects.filter(thread_id__in=[t.id for t in threads])
+                    .values("thread_id")
+                    .annotate(last_id=Max("id"))
+                    .values_list("last_id", flat=True)
+                )
+                latest = {m.thread_id: m for m in Message.objects.filter(id__in=list(latest_ids))}
+                bodies = Message.objects.decrypt_bodies(latest.values())
+
+                for t in threads:
+                    m = latest.get(t.id)
+                    t.last_message_id = m.id if m else None
+                    t.last_activity_at = m.created_at if m else t.created_at
+                    t.last_preview = None
+                    body = bodies.get(m.id) if m else None
+                    if body is not None:
+                        t.last_preview, t.last_preview_key_version = t.encrypt_preview(body)
+                MessageThread.objects.bulk_update(
+                    threads,
+                    ["last_message_id", "last_activity_at", "last_preview", "last_preview_key_version"],
+                )
+
+            done += len(threads)
+            last_id = threads[-1].id
+            self.stdout.write(f'Backfilled {done} threads (checkpoint --after-id {last_id})')
+            if options['sleep']:
+                time.sleep(options['sleep'])
+
+        self.stdout.write(self.style.SUCCESS(f'Backfill complete: {done} threads updated'))
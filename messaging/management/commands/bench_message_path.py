@@ -0,0 +1,80 @@
+import asyncio
+import secrets
+import time
+
+from channels.db import database_sync_to_async
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from messaging.deletion import batched_delete
+from messaging.models import MessageThread, ThreadMembership
+from messaging.services import acreate_message, amark_seen, create_message, mark_seen
+
+User = get_user_model()
+
+
+async def _sync_hop(thread_id, sender, reader):
+    """What the consumer did before: every step through database_sync_to_async."""
+    await database_sync_to_async(ThreadMembership.objects.is_member)(thread_id, sender.id)
+    msg = await database_sync_to_async(create_message)(thread_id, sender.id, "benchmark message")
+    await database_sync_to_async(mark_seen)(thread_id, reader, message_ids=[msg.id])
+
+
+async def _async_orm(thread_id, sender, reader):
+    """The current consumer path: async ORM, crypto on its own executor."""
+    await ThreadMembership.objects.ais_member(thread_id, sender.id)
+    msg = await acreate_message(thread_id, sender.id, "benchmark message")
+    await amark_seen(thread_id, reader, message_ids=[msg.id])
+
+
+PATHS = {"sync": _sync_hop, "async": _async_orm}
+
+
+async def _run(path, thread_id, sender, reader, messages, concurrency):
+    """Send `messages` through `concurrency` simulated connections; returns seconds taken."""
+    per_conn, extra = divmod(messages, concurrency)
+
+    async def connection(count):
+        for _ in range(count):
+            await path(thread_id, sender, reader)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(connection(per_conn + (i < extra)) for i in range(concurrency)))
+    return time.perf_counter() - start
+
+
+class Command(BaseCommand):
+    help = 'Messages/sec of one worker on the WebSocket send + seen path: sync hops vs the async ORM path'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--messages', type=int, default=1000, help='Messages per path')
+        parser.add_argument('--concurrency', type=int, default=20, help='Simulated connections sending at once')
+        parser.add_argument('--path', choices=['both', *PATHS], default='both')
+
+    def handle(self, *args, **options):
+        if options['messages'] < 1 or options['concurrency'] < 1:
+            raise CommandError('--messages and --concurrency must be positive')
+
+        tag = secrets.token_hex(4)
+        sender = User.objects.create_user(username=f'bench_{tag}_a')
+        reader = User.objects.create_user(username=f'bench_{tag}_b')
+        thread = MessageThread.objects.create()
+        thread.participants.add(sender, reader)
+        self.stdout.write(f'Benchmark thread {thread.id}: {options["messages"]} messages, {options["concurrency"]} connections')
+
+        names = list(PATHS) if options['path'] == 'both' else [options['path']]
+        rates = {}
+        try:
+            # Warm up key derivation and connections so the first path isn't penalised
+            asyncio.run(_run(PATHS[names[0]], thread.id, sender, reader, options['concurrency'], options['concurrency']))
+            for name in names:
+                elapsed = asyncio.run(
+                    _run(PATHS[name], thread.id, sender, reader, options['messages'], options['concurrency'])
+                )
+                rates[name] = options['messages'] / elapsed
+                self.stdout.write(f'{name:>5}: {rates[name]:8.1f} msgs/sec ({elapsed:.2f}s)')
+        finally:
+            batched_delete(MessageThread.objects.filter(id=thread.id))
+            User.objects.filter(id__in=[sender.id, reader.id]).delete()
+
+        if len(rates) == 2:
+            self.stdout.write(self.style.SUCCESS(f'async/sync: {rates["async"] / rates["sync"]:.2f}x'))
@@ -1,5 +1,7 @@
 from django.core.management.base import BaseCommand
+from messaging.deletion import DEFAULT_BATCH_SIZE, batched_delete
 from messaging.models import MessageThread
+from messaging.services import notify_threads_deleted
 from django.db.models import Count
 
 class Command(BaseCommand):
@@ -11,6 +13,9 @@ class Command(BaseCommand):
             action='store_true',
             help='Show what would be deleted without actually deleting',
         )
+        parser.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE, help='Threads per transaction')
+        parser.add_argument('--sleep', type=float, default=0.05, help='Seconds to pause between batches')
+        parser.add_argument('--after-id', type=int, default=0, help='Resume after this thread id')
 
     def handle(self, *args, **options):
         # Find threads with no messages
@@ -18,24 +23,32 @@ class Command(BaseCommand):
             message_count=Count('messages')
         ).filter(message_count=0)
         
-        count = empty_threads.count()
-        
         if options['dry_run']:
+            count = empty_threads.count()
             self.stdout.write(
                 self.style.WARNING(
                     f'Would delete {count} empty message threads (dry run)'
                 )
             )
-            for thread in empty_threads:
+            for thread in empty_threads.prefetch_related('participants').iterator(chunk_size=500):
                 participants = ", ".join([user.username for user in thread.participants.all()])
                 self.stdout.write(f"Thread {thread.id} (participants: {participants})")
             return
 
-        if count > 0:
-            empty_threads.delete()
+        result = batched_delete(
+            empty_threads,
+            batch_size=options['batch_size'],
+            sleep=options['sleep'],
+            after_id=options['after_id'],
+            before_batch=notify_threads_deleted,
+            progress=lambda s: self.stdout.write(
+                f"Deleted {s['deleted']} threads (checkpoint --after-id {s['last_id']})"
+            ),
+        )
+        if result['deleted']:
             self.stdout.write(
                 self.style.SUCCESS(
-                    f'Successfully deleted {count} empty message threads'
+                    f"Successfully deleted {result['deleted']} empty message threads"
                 )
             )
         else:
@@ -43,4 +56,4 @@ class Command(BaseCommand):
                 self.style.SUCCESS(
                     'No empty message threads found'
                 )
-            )
\ No newline at end of file
+            )
@@ -1,19 +1,34 @@
 from django.core.management.base import BaseCommand
+from messaging.deletion import DEFAULT_BATCH_SIZE, batched_delete
 from messaging.models import MessageThread
+from messaging.services import notify_threads_deleted
 from django.db.models import Count
 
 class Command(BaseCommand):
     help = 'Clean up empty message threads'
 
-    def handle(self, *args, **kwargs):
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE, help='Threads per transaction')
+        parser.add_argument('--sleep', type=float, default=0.05, help='Seconds to pause between batches')
+        parser.add_argument('--after-id', type=int, default=0, help='Resume after this thread id')
+
+    def handle(self, *args, **options):
         # Find threads with no messages
         empty_threads = MessageThread.objects.annotate(
             message_count=Count('messages')
         ).filter(message_count=0)
         
-        count = empty_threads.count()
-        empty_threads.delete()
+        result = batched_delete(
+            empty_threads,
+            batch_size=options['batch_size'],
+            sleep=options['sleep'],
+            after_id=options['after_id'],
+            before_batch=notify_threads_deleted,
+            progress=lambda s: self.stdout.write(
+                f"Deleted {s['deleted']} threads (checkpoint --after-id {s['last_id']})"
+            ),
+        )
         
         self.stdout.write(
-            self.style.SUCCESS(f'Successfully deleted {count} empty threads')
-        )
\ No newline at end of file
+            self.style.SUCCESS(f"Successfully deleted {result['deleted']} empty threads")
+        )
@@ -1,5 +1,7 @@
 from django.core.management.base import BaseCommand
+from messaging.deletion import DEFAULT_BATCH_SIZE, batched_delete
 from messaging.models import MessageThread
+from messaging.services import notify_threads_deleted
 
 class Command(BaseCommand):
     help = 'Delete all message threads (development only)'
@@ -10,9 +12,12 @@ class Command(BaseCommand):
             action='store_true',
             help='Force deletion without confirmation',
         )
+        parser.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE, help='Rows per transaction')
+        parser.add_argument('--sleep', type=float, default=0.0, help='Seconds to pause between batches')
+        parser.add_argument('--after-id', type=int, default=0, help='Resume after this thread id')
 
     def handle(self, *args, **options):
-        thread_count = MessageThread.objects.count()
+        thread_count = MessageThread.objects.filter(id__gt=options['after_id']).count()
         
         if thread_count == 0:
             self.stdout.write(self.style.SUCCESS('No threads to delete.'))
@@ -24,6 +29,18 @@ class Command(BaseCommand):
                 self.stdout.write(self.style.WARNING('Cancelled.'))
                 return
 
-        # Delete all threads (will cascade to messages due to foreign key)
-        MessageThread.objects.all().delete()
-        self.stdout.write(self.style.SUCCESS(f'Successfully deleted {thread_count} threads and their messages.'))
\ No newline at end of file
+        # Messages and memberships go with each batch of threads, one transaction per batch
+        result = batched_delete(
+            MessageThread.objects.all(),
+            batch_size=options['batch_size'],
+            sleep=options['sleep'],
+            after_id=options['after_id'],
+            before_batch=notify_threads_deleted,
+            progress=lambda s: self.stdout.write(
+                f"Deleted {s['deleted']} threads, {s['cascaded']} related rows "
+                f"(checkpoint --after-id {s['last_id']})"
+            ),
+        )
+        self.stdout.write(self.style.SUCCESS(
+            f"Successfully deleted {result['deleted']} threads and {result['cascaded']} messages/memberships."
+        ))
@@ -0,0 +1,69 @@
+import asyncio
+import json
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.test import override_settings
+from messaging.loadtest import LoadTest, channel_layer, create_fixtures, delete_fixtures
+
+
+class Command(BaseCommand):
+    help = 'Simulate N users across M threads over WebSockets and report delivery latency, throughput and DB queries'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=20, help='Simulated users (one socket each)')
+        parser.add_argument('--threads', type=int, default=5, help='Threads the users are spread over')
+        parser.add_argument('--messages', type=int, default=20, help='Messages each user sends')
+        parser.add_argument('--rate', type=float, default=1.0, help='Sends per second per user (Poisson); 0 = as fast as possible')
+        parser.add_argument('--seen-ratio', type=float, default=0.5, help='Share of delivered messages acked with "seen"')
+        parser.add_argument('--seed', type=int, default=1, help='Seed for send schedules and seen acks')
+        parser.add_argument('--layer', choices=['memory', 'redis'], default='memory', help='Channel layer to run against')
+        parser.add_argument('--redis-url', default=None, help='Redis for --layer redis (default REDIS_URL)')
+        parser.add_argument('--drain-timeout', type=float, default=10.0, help='Seconds to wait for outstanding deliveries')
+        parser.add_argument('--no-rate-limit', action='store_true', help='Disable the per-user send limit for the run')
+        parser.add_argument('--json', action='store_true', help='Print the summary as JSON')
+
+    def handle(self, *args, **options):
+        if options['threads'] < 1 or options['users'] < 2 * options['threads']:
+            raise CommandError('Need at least one thread and two users per thread')
+
+        from config.asgi import application
+
+        users, threads = create_fixtures(options['users'], options['threads'])
+        try:
+            test = LoadTest(
+                users, threads,
+                messages=options['messages'],
+                rate=options['rate'],
+                seen_ratio=options['seen_ratio'],
+                seed=options['seed'],
+                drain_timeout=options['drain_timeout'],
+            )
+            overrides = {'MESSAGE_RATE_LIMIT_PER_SECOND': 0} if options['no_rate_limit'] else {}
+            with channel_layer(options['layer'], options['redis_url'] or settings.REDIS_URL), override_settings(**overrides):
+                result = asyncio.run(test.run(application))
+        finally:
+            delete_fixtures(users, threads)
+
+        summary = result.summary()
+        if options['json']:
+            self.stdout.write(json.dumps(summary, indent=2))
+            return
+
+        self.stdout.write(
+            f"{summary['users']} users / {summary['threads']} threads on the {options['layer']} layer, seed {options['seed']}"
+        )
+        self.stdout.write(
+            f"sent {summary['sent']}, confirmed {summary['confirmed']}, errors {summary['errors']}, "
+            f"delivered {summary['delivered']}/{summary['expected_deliveries']}, seen acks {summary['seen_acks']}"
+        )
+        for name in ('delivery_ms', 'confirm_ms'):
+            p = summary[name]
+            self.stdout.write(f"{name[:-3]:>8} latency ms: p50 {p['p50']}  p95 {p['p95']}  p99 {p['p99']}")
+        self.stdout.write(
+            f"{summary['messages_per_s']} msgs/sec over {summary['elapsed_s']}s, "
+            f"{summary['queries_per_message']} DB queries per message ({summary['queries']} total)"
+        )
+        if summary['delivered'] < summary['expected_deliveries'] or summary['errors']:
+            self.stdout.write(self.style.WARNING('Some messages were not delivered or were rejected'))
+
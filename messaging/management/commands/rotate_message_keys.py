@@ -0,0 +1,70 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from crypto_core.keys import current_key_version
+from messaging.rotation import pending_rotation, reencrypt_batch, rotate_previews
+
+class Command(BaseCommand):
+    help = 'Re-encrypt messages under the current master key version, in throttled batches'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500, help='Messages per transaction')
+        parser.add_argument('--sleep', type=float, default=0.1, help='Seconds to pause between batches')
+        parser.add_argument(
+            '--after-id',
+            type=int,
+            default=0,
+            help='Resume after this message id (printed as the checkpoint of a previous run)',
+        )
+        parser.add_argument(
+            '--max-batches',
+            type=int,
+            default=0,
+            help='Stop after this many batches (0 = run to completion)',
+        )
+        parser.add_argument(
+            '--passes',
+            type=int,
+            default=3,
+            help='Full passes to make while rows remain (rows locked by live requests are skipped and retried)',
+        )
+
+    def handle(self, *args, **options):
+        target = current_key_version()
+        remaining = pending_rotation(target).filter(id__gt=options['after_id']).count()
+        self.stdout.write(f'Rotating {remaining} messages to key version {target}')
+
+        last_id = options['after_id']
+        rotated = batches = 0
+        for pass_no in range(1, max(1, options['passes']) + 1):
+            failed = 0
+            while True:
+                n, bad, batch_last = reencrypt_batch(last_id, options['batch_size'], target)
+                if batch_last is None:
+                    break
+                rotated += n
+                failed += bad
+                batches += 1
+                last_id = batch_last
+                self.stdout.write(f'{rotated}/{remaining} rotated, checkpoint --after-id {last_id}')
+                if options['max_batches'] and batches >= options['max_batches']:
+                    self.stdout.write(self.style.WARNING(f'Stopped after {batches} batches; resume with --after-id {last_id}'))
+                    return
+                if options['sleep']:
+                    time.sleep(options['sleep'])
+
+            # skip_locked passes over rows a live request held; they are now behind the cursor
+            left = pending_rotation(target).count()
+            if not left or left == failed:
+                break
+            self.stdout.write(f'Pass {pass_no}: {left} messages still pending, starting again from the first id')
+            last_id = 0
+
+        previews, bad_previews = rotate_previews(target, options['batch_size'])
+        self.stdout.write(f'{previews} inbox previews re-encrypted')
+        if left or bad_previews:
+            raise CommandError(
+                f'{left} messages and {bad_previews} inbox previews are still not under key version {target} '
+                f'({failed} messages could not be decrypted); do not retire the old master key yet'
+            )
+        self.stdout.write(self.style.SUCCESS(f'Rotation complete: {rotated} re-encrypted'))
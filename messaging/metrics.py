@@ -0,0 +1,136 @@
+# messaging/metrics.py
+"""
+In-process latency histograms and gauges for the messaging hot path,
+rendered in the Prometheus text exposition format by the /metrics view.
+
+Deliberately tiny (no client library): each process keeps its own
+numbers, which is what Prometheus expects when it scrapes every worker.
+Values that live in the database rather than in a process (e.g. the
+expiry backlog) are refreshed by on_scrape() hooks just before rendering.
+"""
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+# Seconds; tuned for sub-millisecond crypto up to slow DB writes
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+logger = logging.getLogger(__name__)
+
+_registry = []
+_scrape_hooks = []
+
+
+def _labels(names, values) -> str:
+    if not names:
+        return ""
+    return "{" + ",".join(f'{n}="{v}"' for n, v in zip(names, values)) + "}"
+
+
+class Histogram:
+    def __init__(self, name: str, doc: str, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name, self.doc = name, doc
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._series = {}  # label values -> [bucket counts..., count, sum]
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def observe(self, value: float, **labels):
+        key = tuple(str(labels[n]) for n in self.labelnames)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[i] += 1
+            series[-2] += 1
+            series[-1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.doc}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            series = {k: list(v) for k, v in self._series.items()}
+        for key, values in sorted(series.items()):
+            for bound, count in zip(self.buckets, values):
+                le = _labels(self.labelnames + ("le",), key + (repr(bound),))
+                lines.append(f"{self.name}_bucket{le} {count}")
+            lines.append(f"{self.name}_bucket{_labels(self.labelnames + ('le',), key + ('+Inf',))} {values[-2]}")
+            lines.append(f"{self.name}_count{_labels(self.labelnames, key)} {values[-2]}")
+            lines.append(f"{self.name}_sum{_labels(self.labelnames, key)} {values[-1]}")
+        return lines
+
+
+class Gauge:
+    def __init__(self, name: str, doc: str):
+        self.name, self.doc = name, doc
+        self.value = 0
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def dec(self, amount=1):
+        self.inc(-amount)
+
+    def set(self, value):
+        with self._lock:
+            self.value = value
+
+    def render(self):
+        return [f"# HELP {self.name} {self.doc}", f"# TYPE {self.name} gauge", f"{self.name} {self.value}"]
+
+
+class Counter(Gauge):
+    """Monotonic count (only inc)."""
+
+    def render(self):
+        return [f"# HELP {self.name} {self.doc}", f"# TYPE {self.name} counter", f"{self.name} {self.value}"]
+
+
+def on_scrape(fn):
+    """Register fn() to run before every render, to refresh gauges that aren't updated in-process."""
+    _scrape_hooks.append(fn)
+    return fn
+
+
+def render_metrics() -> str:
+    for hook in _scrape_hooks:
+        try:
+            hook()
+        except Exception:
+            logger.exception("Metrics hook %s failed", getattr(hook, "__name__", hook))
+    lines = []
+    for metric in _registry:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+STAGE_SECONDS = Histogram(
+    "cloakpost_messaging_stage_seconds",
+    "Time spent in each messaging hot-path stage.",
+    labelnames=("stage",),
+)
+OPEN_CONNECTIONS = Gauge("cloakpost_ws_open_connections", "Open messaging WebSocket connections in this process.")
+RATE_LIMITED = Counter("cloakpost_ws_rate_limited_total", "Send frames rejected by the per-user rate limit.")
+OUTBOUND_DROPPED = Counter("cloakpost_ws_outbound_dropped_total", "Outbound frames dropped because a client fell a full ack window behind.")
+EXPIRY_DUE = Gauge("cloakpost_message_expiry_due", "Seen messages past their delete_after that the sweep hasn't removed yet.")
+EXPIRY_LAG_SECONDS = Gauge("cloakpost_message_expiry_lag_seconds", "How long the oldest overdue message has been past its delete_after.")
+SLOW_CONSUMERS_CLOSED = Counter("cloakpost_ws_slow_consumers_closed_total", "Connections closed because they fell a full ack window behind.")
+
+
+def stage_timer(stage: str):
+    """Context manager recording the block's wall time under `stage`."""
+    return STAGE_SECONDS.time(stage=stage)
@@ -0,0 +1,23 @@
+# Generated by Django 5.2.7 on 2026-10-18 12:16
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('messaging', '0003_auto_20251017'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='message',
+            name='enc_blob',
+            field=models.BinaryField(null=True),
+        ),
+        migrations.AlterField(
+            model_name='message',
+            name='enc_body',
+            field=models.TextField(blank=True, default=''),
+        ),
+    ]
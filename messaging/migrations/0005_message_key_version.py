@@ -0,0 +1,18 @@
+# Generated by Django 5.2.7 on 2026-10-18 12:18
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('messaging', '0004_message_enc_blob'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='message',
+            name='key_version',
+            field=models.PositiveSmallIntegerField(default=1),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 5.2.7 on 2026-10-18 12:21
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('messaging', '0005_message_key_version'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['thread', 'id'], name='messaging_m_thread__e0df52_idx'),
+        ),
+    ]
@@ -0,0 +1,40 @@
+# Generated by Django 5.2.7 on 2026-10-18 12:22
+
+import django.utils.timezone
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('messaging', '0006_message_thread_id_index'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='messagethread',
+            name='last_activity_at',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+        migrations.AddField(
+            model_name='messagethread',
+            name='last_message_id',
+            field=models.BigIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='messagethread',
+            name='last_preview',
+            field=models.BinaryField(null=True),
+        ),
+        migrations.AddField(
+            model_name='messagethread',
+            name='last_preview_key_version',
+            field=models.PositiveSmallIntegerField(default=1),
+        ),
+        migrations.AddIndex(
+            model_name='messagethread',
+            index=models.Index(fields=['-last_activity_at', '-id'], name='messaging_m_last_ac_fdfab4_idx'),
+        ),
+    ]
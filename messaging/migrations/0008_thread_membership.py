@@ -0,0 +1,57 @@
+# Generated by Django 5.2.7 on 2026-10-18 12:24
+#
+# Promote the auto-created participants M2M table to an explicit through
+# model. The table, its columns and its unique (thread, user) index already
+# exist, so that part is state-only; the new columns and index are real DDL.
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('messaging', '0007_thread_last_activity'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.SeparateDatabaseAndState(
+            state_operations=[
+                migrations.CreateModel(
+                    name='ThreadMembership',
+                    fields=[
+                        ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                        ('thread', models.ForeignKey(db_column='messagethread_id', on_delete=django.db.models.deletion.CASCADE, related_name='memberships', to='messaging.messagethread')),
+                        ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='thread_memberships', to=settings.AUTH_USER_MODEL)),
+                    ],
+                    options={
+                        'db_table': 'messaging_messagethread_participants',
+                        'unique_together': {('thread', 'user')},
+                    },
+                ),
+                migrations.AlterField(
+                    model_name='messagethread',
+                    name='participants',
+                    field=models.ManyToManyField(related_name='message_threads', through='messaging.ThreadMembership', to=settings.AUTH_USER_MODEL),
+                ),
+            ],
+            database_operations=[],
+        ),
+        migrations.AddField(
+            model_name='threadmembership',
+            name='last_read_message_id',
+            field=models.BigIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='threadmembership',
+            name='joined_at',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+        migrations.AddIndex(
+            model_name='threadmembership',
+            index=models.Index(fields=['user', 'thread'], name='messaging_m_user_id_bdf5c7_idx'),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 5.2.7 on 2026-10-18 12:28
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('messaging', '0008_thread_membership'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['delete_after'], name='messaging_m_delete__b4dd08_idx'),
+        ),
+    ]
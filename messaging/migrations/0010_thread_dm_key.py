@@ -0,0 +1,18 @@
+# Generated by Django 5.2.7 on 2026-10-18 12:31
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('messaging', '0009_message_delete_after_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='messagethread',
+            name='dm_key',
+            field=models.CharField(blank=True, max_length=41, null=True, unique=True),
+        ),
+    ]
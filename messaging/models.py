@@ -1,60 +1,236 @@
-from django.db import models
+import base64
+
+from django.conf import settings
+from django.db import IntegrityError, models, transaction
+from django.db.models import Count, F, Q
 from django.contrib.auth import get_user_model
 from django.utils import timezone
 from datetime import timedelta
 
-from crypto_core.keys import derive_message_key
-from crypto_core.aes import encrypt_aes_gcm, decrypt_aes_gcm
+from crypto_core.keys import current_key_version, derive_message_key
+from crypto_core.aes import decrypt_aes_gcm_raw, decrypt_jobs, encrypt_aes_gcm_raw
+
+from .metrics import stage_timer
 
 User = get_user_model()
 
+# Characters of the last message kept (encrypted) on the thread for the inbox
+PREVIEW_CHARS = 120
+
+
+def message_aad(sender_id: int, thread_id: int) -> bytes:
+    """AAD binding a ciphertext to its sender+thread (prevents cross-context swaps)."""
+    return f"sender:{sender_id}|thread:{thread_id}".encode("utf-8")
+
+def dm_key_for(user1_id: int, user2_id: int) -> str:
+    """Canonical key of the 1:1 thread between two users (order-independent)."""
+    low, high = sorted((int(user1_id), int(user2_id)))
+    return f"{low}:{high}"
+
+def message_compress_min():
+    """
+    Byte threshold for compressing bodies before encryption, or None when
+    disabled. Off by default: compressed ciphertext length leaks how
+    compressible the body is (see MESSAGE_COMPRESSION in settings).
+    """
+    if not getattr(settings, "MESSAGE_COMPRESSION", False):
+        return None
+    return getattr(settings, "MESSAGE_COMPRESSION_MIN_BYTES", 256)
+
 class MessageThreadManager(models.Manager):
     def get_thread_for_participants(self, user1, user2):
-        """Get or create 1:1 thread between two users"""
-        # Get all threads that both users are in
-        threads = self.filter(participants=user1).filter(participants=user2)
-        
-        # Check each thread to find a valid 1:1 thread
-        for thread in threads:
-            participants = thread.participants.all()
-            if participants.count() == 2:
-                participant_ids = {p.id for p in participants}
-                if participant_ids == {user1.id, user2.id}:
-                    return thread, False  # Found existing thread
-                    
-        # No valid thread found, create new one
-        thread = self.create()
-        thread.participants.add(user1, user2)
-        return thread, True  # Created new thread
+        """
+        Get or create the 1:1 thread between two users via the unique dm_key:
+        one indexed lookup, and a concurrent create loses cleanly to the
+        unique constraint instead of producing a duplicate thread.
+        """
+        key = dm_key_for(user1.id, user2.id)
+        thread = self.filter(dm_key=key).first()
+        if thread is not None:
+            return thread, False
+        try:
+            with transaction.atomic():
+                thread = self.create(dm_key=key)
+                thread.participants.add(user1, user2)
+        except IntegrityError:
+            # Another request created it between our lookup and insert
+            return self.get(dm_key=key), False
+        return thread, True
+
+    def decrypt_previews(self, threads):
+        """Decrypt last-message previews for many threads; returns {thread_id: text or None}."""
+        with_preview = [t for t in threads if t.last_preview is not None]
+        jobs = [
+            (derive_message_key(t.id, t.last_preview_key_version), [(t.last_preview, t.preview_aad())])
+            for t in with_preview
+        ]
+        results = decrypt_jobs(jobs, strict=False)
+        out = {t.id: None for t in threads}
+        for t, (body,) in zip(with_preview, results):
+            out[t.id] = body
+        return out
 
 class MessageThread(models.Model):
-    participants = models.ManyToManyField(User, related_name="message_threads")
+    participants = models.ManyToManyField(User, related_name="message_threads", through="ThreadMembership")
     created_at = models.DateTimeField(auto_now_add=True)
+    # Denormalized inbox state, updated in the same transaction as each new message
+    last_message_id = models.BigIntegerField(null=True, blank=True)
+    last_activity_at = models.DateTimeField(default=timezone.now)
+    # Encrypted (thread key) prefix of the last message; None once that message is gone
+    last_preview = models.BinaryField(null=True)
+    last_preview_key_version = models.PositiveSmallIntegerField(default=1)
+    # "low_user_id:high_user_id" for 1:1 threads (see dm_key_for); NULL for groups
+    dm_key = models.CharField(max_length=41, null=True, blank=True, unique=True)
     
     objects = MessageThreadManager()
 
+    class Meta:
+        indexes = [
+            # inbox ordering / keyset pagination by recency
+            models.Index(fields=["-last_activity_at", "-id"]),
+        ]
+
+    def preview_aad(self) -> bytes:
+        return f"thread:{self.id}|preview".encode("utf-8")
+
+    def encrypt_preview(self, plaintext: str):
+        """Return (blob, key_version) for a preview of plaintext (not saved)."""
+        version = current_key_version()
+        key = derive_message_key(self.id, version)
+        return encrypt_aes_gcm_raw(plaintext[:PREVIEW_CHARS], key, aad=self.preview_aad()), version
+
+class ThreadMembershipManager(models.Manager):
+    def is_member(self, thread_id: int, user_id: int) -> bool:
+        return self.filter(thread_id=thread_id, user_id=user_id).exists()
+
+    async def ais_member(self, thread_id: int, user_id: int) -> bool:
+        return await self.filter(thread_id=thread_id, user_id=user_id).aexists()
+
+    def mark_read(self, thread_id: int, user_id: int, message_id: int) -> int:
+        """Advance the user's read cursor to message_id (never moves backwards)."""
+        return self.filter(
+            thread_id=thread_id, user_id=user_id, last_read_message_id__lt=message_id
+        ).update(last_read_message_id=message_id)
+
+    async def amark_read(self, thread_id: int, user_id: int, message_id: int) -> int:
+        return await self.filter(
+            thread_id=thread_id, user_id=user_id, last_read_message_id__lt=message_id
+        ).aupdate(last_read_message_id=message_id)
+
+    def unread_counts(self, user, thread_ids=None) -> dict:
+        """
+        {thread_id: unread} for the user's threads in one aggregate query:
+        messages from others newer than the user's read cursor.
+        """
+        qs = self.filter(user=user)
+        if thread_ids is not None:
+            qs = qs.filter(thread_id__in=thread_ids)
+        rows = qs.annotate(
+            unread=Count(
+                "thread__messages",
+                filter=Q(thread__messages__id__gt=F("last_read_message_id"))
+                & ~Q(thread__messages__sender=user),
+            )
+        ).values_list("thread_id", "unread")
+        return dict(rows)
+
+class ThreadMembership(models.Model):
+    """
+    Explicit participants row (reuses the original auto M2M table) with
+    per-user read state.
+    """
+    thread = models.ForeignKey(
+        MessageThread, on_delete=models.CASCADE, related_name="memberships", db_column="messagethread_id"
+    )
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name="thread_memberships")
+    # Highest message id this user has read in the thread (0 = nothing yet)
+    last_read_message_id = models.BigIntegerField(default=0)
+    joined_at = models.DateTimeField(default=timezone.now)
+
+    objects = ThreadMembershipManager()
+
+    class Meta:
+        db_table = "messaging_messagethread_participants"
+        unique_together = ("thread", "user")
+        indexes = [
+            # inbox-wide lookups (unread counts, thread list) start from the user
+            models.Index(fields=["user", "thread"]),
+        ]
+
+class MessageManager(models.Manager):
+    def decrypt_bodies(self, messages):
+        """
+        Decrypt many messages at once. Rows are grouped by (thread, key version)
+        so each key is derived once and one cipher context handles each chunk.
+        Accepts a queryset or any iterable of Message objects; returns
+        {message_id: plaintext}, with None for rows that fail to decrypt.
+        """
+        by_key = {}
+        for m in messages:
+            by_key.setdefault((m.thread_id, m.key_version), []).append(m)
+
+        jobs = [
+            (
+                derive_message_key(thread_id, version),
+                [(m.stored_ciphertext, message_aad(m.sender_id, thread_id)) for m in group],
+            )
+            for (thread_id, version), group in by_key.items()
+        ]
+        results = decrypt_jobs(jobs, strict=False)
+
+        out = {}
+        for group, bodies in zip(by_key.values(), results):
+            for m, body in zip(group, bodies):
+                out[m.id] = body
+        return out
+
 class Message(models.Model):
     thread = models.ForeignKey(MessageThread, on_delete=models.CASCADE, related_name="messages")
     sender = models.ForeignKey(User, on_delete=models.CASCADE)
-    # Encrypted ciphertext blob (base64 of nonce||ciphertext+tag)
-    enc_body = models.TextField()
+    # Encrypted ciphertext: raw nonce||ciphertext+tag
+    enc_blob = models.BinaryField(null=True)
+    # Legacy base64 text form of the same blob; emptied by backfill_binary_bodies
+    enc_body = models.TextField(blank=True, default="")
+    # Master key version the ciphertext was written under (see crypto_core.keys)
+    key_version = models.PositiveSmallIntegerField(default=1)
     created_at = models.DateTimeField(auto_now_add=True)
     seen_at = models.DateTimeField(null=True, blank=True)
     delete_after = models.DateTimeField(null=True, blank=True)
 
+    objects = MessageManager()
+
+    class Meta:
+        indexes = [
+            # keyset pagination of a thread's history (list_messages, export)
+            models.Index(fields=["thread", "id"]),
+            # expiry sweep range scans (messaging.expiry)
+            models.Index(fields=["delete_after"]),
+        ]
+
     # ---- Encryption helpers ----
+    @property
+    def stored_ciphertext(self):
+        """Raw blob if present, else the legacy base64 text (rows not yet backfilled)."""
+        if self.enc_blob is not None:
+            return self.enc_blob
+        return base64.b64decode(self.enc_body)
+
     def set_plain_body(self, plaintext: str):
         if not self.thread_id:
             raise ValueError("thread must be set before encrypting")
-        key = derive_message_key(self.thread_id)
+        self.key_version = current_key_version()
+        with stage_timer("key_derivation"):
+            key = derive_message_key(self.thread_id, self.key_version)
         # Bind AAD to sender+thread to prevent cross-context swaps (optional but good)
-        aad = f"sender:{self.sender_id}|thread:{self.thread_id}".encode("utf-8")
-        self.enc_body = encrypt_aes_gcm(plaintext, key, aad=aad)
+        with stage_timer("encrypt"):
+            self.enc_blob = encrypt_aes_gcm_raw(
+                plaintext, key, aad=message_aad(self.sender_id, self.thread_id), compress_min=message_compress_min()
+            )
+        self.enc_body = ""
 
     def get_plain_body(self) -> str:
-        key = derive_message_key(self.thread_id)
-        aad = f"sender:{self.sender_id}|thread:{self.thread_id}".encode("utf-8")
-        return decrypt_aes_gcm(self.enc_body, key, aad=aad)
+        key = derive_message_key(self.thread_id, self.key_version)
+        return decrypt_aes_gcm_raw(self.stored_ciphertext, key, aad=message_aad(self.sender_id, self.thread_id))
 
     # Convenience: mark seen and set delete_after = seen + 5min
     def mark_seen_and_schedule_delete(self, minutes: int = 5):
@@ -0,0 +1,208 @@
+# messaging/recent.py
+"""
+Per-process ring buffer of the newest messages of hot threads, so a
+socket opening a thread can be handed recent history in its ready frame
+without a query or a decrypt.
+
+A thread is only tracked while a socket in this process is in its group:
+that is what guarantees every new message (local or from another node)
+passes through here. The buffer becomes usable ("warm") once it has been
+seeded with the thread's newest page by list_messages; it then follows
+new messages, drops entries whose delete_after passes (seen messages) or
+that are deleted, and forgets everything when the last local socket
+leaves. At most RECENT_MESSAGES_MAX_THREADS threads are kept warm, least
+recently opened first out. Entries also expire RECENT_MESSAGES_TTL_SECONDS after creation so
+plaintext doesn't linger in memory.
+
+The buffer holds plaintext and is deliberately unpicklable: it must
+never be written to a cache, the database or disk.
+"""
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
+
+from django.conf import settings
+
+DEFAULT_PER_THREAD = 50
+DEFAULT_MAX_THREADS = 1000
+DEFAULT_TTL = 600  # seconds
+
+
+def _timestamp(value):
+    if value is None:
+        return None
+    if isinstance(value, datetime):
+        return value.timestamp()
+    return datetime.fromisoformat(value).timestamp()
+
+
+class _ThreadBuffer:
+    __slots__ = ("entries", "has_older", "warm", "subscribers")
+
+    def __init__(self):
+        # [(id, message dict, expires_at, expires by TTL rather than delete_after)], ascending id
+        self.entries = []
+        self.has_older = False
+        self.warm = False
+        self.subscribers = 0
+
+    def reset(self):
+        self.entries, self.has_older, self.warm = [], False, False
+
+
+class RecentMessages:
+    def __init__(self, per_thread: int = DEFAULT_PER_THREAD, max_threads: int = DEFAULT_MAX_THREADS,
+                 ttl: float = DEFAULT_TTL):
+        self.per_thread = max(1, int(per_thread))
+        self.max_threads = max(1, int(max_threads))
+        self.ttl = float(ttl)
+        self._buffers = OrderedDict()  # tracked thread_id -> _ThreadBuffer, least recently used first
+        self._lock = threading.Lock()
+
+    def __reduce__(self):
+        raise TypeError("RecentMessages holds plaintext and must not be serialized")
+
+    # ---------- tracking ----------
+
+    def subscribe(self, thread_id: int):
+        with self._lock:
+            buf = self._buffers.get(thread_id)
+            if buf is None:
+                buf = self._buffers[thread_id] = _ThreadBuffer()
+            buf.subscribers += 1
+
+    def unsubscribe(self, thread_id: int):
+        with self._lock:
+            buf = self._buffers.get(thread_id)
+            if buf is None:
+                return
+            buf.subscribers -= 1
+            if buf.subscribers <= 0:
+                # Nobody here would see the next message; the buffer can't stay complete
+                del self._buffers[thread_id]
+
+    # ---------- filling ----------
+
+    def seed(self, thread_id: int, messages, has_older: bool):
+        """
+        Warm a tracked thread from its newest page: `messages` oldest-first as
+        (message dict, delete_after). Messages that arrived since the thread
+        became tracked are kept. Ignored for untracked or already warm threads.
+        """
+        now = time.time()
+        with self._lock:
+            buf = self._buffers.get(thread_id)
+            if buf is None or buf.warm:
+                return
+            known = {entry[0] for entry in buf.entries}
+            for message, delete_after in messages:
+                entry = self._entry(message, delete_after)
+                if entry[0] not in known and entry[2] > now:
+                    buf.entries.append(entry)
+            buf.entries.sort(key=lambda e: e[0])
+            buf.has_older = buf.has_older or has_older
+            buf.warm = True
+            self._trim(buf)
+            self._buffers.move_to_end(thread_id)
+            warm = [tid for tid, b in self._buffers.items() if b.warm]
+            for tid in warm[:max(0, len(warm) - self.max_threads)]:
+                self._buffers[tid].reset()
+
+    def add(self, thread_id: int, message: dict, delete_after=None):
+        """Record a new message ({id, sender, body, created_at}) in a tracked thread."""
+        with self._lock:
+            buf = self._buffers.get(thread_id)
+            if buf is None:
+                return
+            entries = buf.entries
+            if any(entry[0] == message["id"] for entry in entries):
+                return  # already seen via another socket
+            entries.append(self._entry(message, delete_after))
+            if len(entries) > 1 and entries[-2][0] > entries[-1][0]:
+                entries.sort(key=lambda e: e[0])  # arrived out of order
+            self._trim(buf)
+
+    def _entry(self, message, delete_after):
+        aged = (_timestamp(message.get("created_at")) or time.time()) + self.ttl
+        deadline = _timestamp(delete_after)
+        if deadline is None or aged <= deadline:
+            return message["id"], dict(message), aged, True
+        return message["id"], dict(message), deadline, False
+
+    def _trim(self, buf: _ThreadBuffer):
+        if len(buf.entries) > self.per_thread:
+            del buf.entries[:len(buf.entries) - self.per_thread]
+            buf.has_older = True
+
+    # ---------- eviction ----------
+
+    def expire(self, thread_id: int, delete_after, seen_by: str, ids=None, up_to_id=None):
+        """Apply a seen ack: the covered messages now expire at delete_after."""
+        deadline = _timestamp(delete_after)
+        wanted = set(ids) if ids is not None else None
+        with self._lock:
+            buf = self._buffers.get(thread_id)
+            if buf is None:
+                return
+            for i, (message_id, message, expires, _) in enumerate(buf.entries):
+                if wanted is not None:
+                    covered = message_id in wanted
+                else:
+                    covered = message_id <= up_to_id and message.get("sender") != seen_by
+                if covered and deadline < expires:
+                    buf.entries[i] = (message_id, message, deadline, False)
+
+    def discard(self, thread_id: int, message_ids):
+        gone = set(message_ids)
+        with self._lock:
+            buf = self._buffers.get(thread_id)
+            if buf is not None:
+                buf.entries = [e for e in buf.entries if e[0] not in gone]
+
+    # ---------- reading ----------
+
+    def snapshot(self, thread_id: int):
+        """
+        (messages oldest-first, next_cursor) for a warm thread, or None. As in
+        list_messages, next_cursor is the before_id for older history or None.
+        """
+        now = time.time()
+        with self._lock:
+            buf = self._buffers.get(thread_id)
+            if buf is None or not buf.warm:
+                return None
+            self._buffers.move_to_end(thread_id)
+            live = []
+            for entry in buf.entries:
+                if entry[2] > now:
+                    live.append(entry)
+                elif entry[3]:
+                    buf.has_older = True  # aged out of memory, but the row still exists
+            buf.entries = live
+            if not live and buf.has_older:
+                buf.reset()  # nothing left to replay; the next list_messages re-seeds
+                return None
+            messages = [dict(e[1]) for e in live]
+            return messages, (live[0][0] if buf.has_older else None)
+
+
+_recent = None
+_recent_config = None
+
+
+def get_recent_messages():
+    """The process-wide buffer, or None when RECENT_MESSAGES_PER_THREAD is 0."""
+    global _recent, _recent_config
+    per_thread = int(getattr(settings, "RECENT_MESSAGES_PER_THREAD", DEFAULT_PER_THREAD))
+    if per_thread <= 0:
+        return None
+    config = (
+        per_thread,
+        int(getattr(settings, "RECENT_MESSAGES_MAX_THREADS", DEFAULT_MAX_THREADS)),
+        float(getattr(settings, "RECENT_MESSAGES_TTL_SECONDS", DEFAULT_TTL)),
+    )
+    if _recent is None or _recent_config != config:
+        _recent = RecentMessages(*config)
+        _recent_config = config
+    return _recent
@@ -0,0 +1,120 @@
+# messaging/rotation.py
+"""
+Online re-encryption of messages under the current master key version.
+
+Each batch is a short transaction over an id range, so the live write path
+(which always encrypts under the current version) never waits on rotation.
+Progress is just "last id processed": rows already on the target version
+drop out of the filter, so a restarted run only redoes the current batch.
+The threads' denormalized inbox previews are encrypted with the same
+per-thread keys, so they are rotated too (rotate_previews).
+"""
+import logging
+
+from django.db import transaction
+
+from crypto_core.aes import encrypt_aes_gcm_raw, encrypt_many
+from crypto_core.keys import current_key_version, derive_message_key
+
+from .models import Message, MessageThread, message_aad, message_compress_min
+
+logger = logging.getLogger(__name__)
+
+
+def pending_rotation(target_version=None):
+    """Messages not yet written under target_version (default: current)."""
+    if target_version is None:
+        target_version = current_key_version()
+    return Message.objects.exclude(key_version=target_version)
+
+
+def reencrypt_batch(after_id: int = 0, batch_size: int = 500, target_version=None):
+    """
+    Re-encrypt the next batch of messages with id > after_id.
+    Returns (rotated, failed, last_id); last_id is None when nothing is left.
+    """
+    if target_version is None:
+        target_version = current_key_version()
+
+    with transaction.atomic():
+        # skip_locked: rows a live request is touching are picked up on a later pass
+        rows = list(
+            pending_rotation(target_version)
+            .filter(id__gt=after_id)
+            .order_by("id")
+            .select_for_update(skip_locked=True)
+            .only("id", "thread_id", "sender_id", "enc_blob", "enc_body", "key_version")[:batch_size]
+        )
+        if not rows:
+            return 0, 0, None
+
+        bodies = Message.objects.decrypt_bodies(rows)
+        by_thread = {}
+        failed = 0
+        for m in rows:
+            if bodies.get(m.id) is None:
+                failed += 1
+                continue
+            by_thread.setdefault(m.thread_id, []).append(m)
+
+        updated = []
+        compress_min = message_compress_min()
+        for thread_id, group in by_thread.items():
+            key = derive_message_key(thread_id, target_version)
+            blobs = encrypt_many(
+                [(bodies[m.id], message_aad(m.sender_id, thread_id)) for m in group], key, compress_min
+            )
+            for m, blob in zip(group, blobs):
+                m.enc_blob, m.enc_body, m.key_version = blob, "", target_version
+                updated.append(m)
+        Message.objects.bulk_update(updated, ["enc_blob", "enc_body", "key_version"])
+
+    if failed:
+        logger.warning("Key rotation: %s messages in ids %s..%s could not be decrypted", failed, rows[0].id, rows[-1].id)
+    return len(updated), failed, rows[-1].id
+
+
+def pending_previews(target_version=None):
+    """Threads whose inbox preview is not yet under target_version (default: current)."""
+    if target_version is None:
+        target_version = current_key_version()
+    return MessageThread.objects.filter(last_preview__isnull=False).exclude(last_preview_key_version=target_version)
+
+
+def rotate_previews(target_version=None, batch_size: int = 500):
+    """
+    Re-encrypt every stale inbox preview under target_version, in batches.
+    Returns (rotated, failed). Each update is conditional on the old
+    version, so a preview a new message wrote meanwhile is never clobbered.
+    """
+    if target_version is None:
+        target_version = current_key_version()
+    rotated = failed = 0
+    after_id = 0
+    while True:
+        threads = list(
+            pending_previews(target_version)
+            .filter(id__gt=after_id)
+            .order_by("id")
+            .only("id", "last_preview", "last_preview_key_version")[:batch_size]
+        )
+        if not threads:
+            break
+        previews = MessageThread.objects.decrypt_previews(threads)
+        with transaction.atomic():
+            for t in threads:
+                text = previews.get(t.id)
+                if text is None:
+                    failed += 1
+                    continue
+                key = derive_message_key(t.id, target_version)
+                rotated += MessageThread.objects.filter(
+                    id=t.id, last_preview_key_version=t.last_preview_key_version
+                ).update(
+                    last_preview=encrypt_aes_gcm_raw(text, key, aad=t.preview_aad()),
+                    last_preview_key_version=target_version,
+                )
+        after_id = threads[-1].id
+    if failed:
+        logger.warning("Key rotation: %s inbox previews could not be decrypted", failed)
+    return rotated, failed
@@ -5,4 +5,6 @@ websocket_urlpatterns = [
     path("ws/threads/<int:thread_id>/", consumers.ThreadConsumer.as_asgi()),
     # Add compatibility with old URL pattern
     path("ws/msg/thread/<int:thread_id>/", consumers.ThreadConsumer.as_asgi()),
+    # One multiplexed socket per user: inbox updates + any subscribed threads
+    path("ws/user/", consumers.UserConsumer.as_asgi()),
 ]
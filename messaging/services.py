@@ -0,0 +1,394 @@
+# messaging/services.py
+"""
+Write paths shared by the WebSocket consumer and the REST views.
+"""
+import asyncio
+import logging
+import random
+from datetime import timedelta
+
+from asgiref.sync import async_to_sync
+from channels.db import database_sync_to_async
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import Max, Q
+from django.utils import timezone
+
+from crypto_core.aes import encrypt_many
+from crypto_core.keys import current_key_version, derive_message_key
+from crypto_core.executor import get_async_crypto_executor
+
+from .metrics import stage_timer
+from .models import Message, MessageThread, ThreadMembership, message_aad, message_compress_min
+
+logger = logging.getLogger(__name__)
+
+# Seen messages self-destruct this long after being read
+SEEN_TTL = timedelta(minutes=5)
+
+
+def _should_verify(verify):
+    if verify is not None:
+        return verify
+    rate = getattr(settings, "MESSAGE_VERIFY_SAMPLE_RATE", 0.0)
+    return rate > 0 and random.random() < rate
+
+
+def prepare_message(thread_id: int, sender_id: int, body: str, verify=None):
+    """
+    The crypto half of create_message: an unsaved, encrypted Message plus
+    the thread's encrypted inbox preview, as (msg, preview, preview_version).
+    Touches no database, so it can run on any thread.
+
+    The AAD only binds sender and thread, so the ciphertext can be built
+    before the row exists. `verify` forces (True) or skips (False) a
+    decrypt-and-compare check; None samples MESSAGE_VERIFY_SAMPLE_RATE.
+    """
+    msg = Message(thread_id=thread_id, sender_id=sender_id)
+    msg.set_plain_body(body)
+
+    if _should_verify(verify) and msg.get_plain_body() != body:
+        logger.error("Message verification failed for thread %s", thread_id)
+        raise ValueError("Message verification failed")
+
+    preview, preview_version = MessageThread(id=thread_id).encrypt_preview(body)
+    return msg, preview, preview_version
+
+
+def save_prepared_message(msg: Message, preview, preview_version: int) -> Message:
+    """
+    Insert a prepared message with a single INSERT and bump the thread's
+    denormalized inbox columns in the same transaction.
+    """
+    with stage_timer("db_write"), transaction.atomic():
+        msg.save(force_insert=True)
+        _advance_inbox(msg.thread_id, msg, preview, preview_version)
+    return msg
+
+
+def _advance_inbox(thread_id: int, msg: Message, preview, preview_version: int):
+    """
+    Point the thread's inbox columns at msg, but only forwards: when two
+    sends commit out of order the older one must not replace the newer.
+    """
+    MessageThread.objects.filter(
+        Q(last_message_id__isnull=True) | Q(last_message_id__lt=msg.id), id=thread_id
+    ).update(
+        last_message_id=msg.id,
+        last_activity_at=msg.created_at,
+        last_preview=preview,
+        last_preview_key_version=preview_version,
+    )
+
+
+def create_message(thread_id: int, sender_id: int, body: str, verify=None) -> Message:
+    """Encrypt and store a message (prepare_message + save_prepared_message)."""
+    return save_prepared_message(*prepare_message(thread_id, sender_id, body, verify))
+
+
+async def acreate_message(thread_id: int, sender_id: int, body: str, verify=None) -> Message:
+    """
+    Async create_message. Encryption runs on the crypto executor, so the
+    thread-sensitive executor every Django DB call shares only does the
+    INSERT + UPDATE. Those stay one sync call: Django has no async
+    transactions, and acreate/aupdate would each hop to that same executor
+    anyway, without the atomicity.
+    """
+    loop = asyncio.get_running_loop()
+    prepared = await loop.run_in_executor(
+        get_async_crypto_executor(), prepare_message, thread_id, sender_id, body, verify
+    )
+    return await database_sync_to_async(save_prepared_message)(*prepared)
+
+
+def create_messages(items, verify=None, durable=True) -> list:
+    """
+    Bulk form of create_message for [(thread_id, sender_id, body), ...]:
+    bodies are encrypted per thread with encrypt_many, inserted with one
+    bulk_create and each thread's inbox columns bumped once, all in one
+    transaction. Returns the saved Messages in input order.
+
+    durable=False relaxes the commit on PostgreSQL (synchronous_commit off
+    for this transaction): the batch is visible immediately but a server
+    crash can lose the last few milliseconds of writes. Other backends
+    ignore it.
+    """
+    version = current_key_version()
+    compress_min = message_compress_min()
+    msgs = [Message(thread_id=t, sender_id=s, key_version=version) for t, s, _ in items]
+    by_thread = {}
+    for i, (thread_id, _, _) in enumerate(items):
+        by_thread.setdefault(thread_id, []).append(i)
+
+    previews = {}
+    for thread_id, idxs in by_thread.items():
+        with stage_timer("key_derivation"):
+            key = derive_message_key(thread_id, version)
+        with stage_timer("encrypt"):
+            blobs = encrypt_many([(items[i][2], message_aad(items[i][1], thread_id)) for i in idxs], key, compress_min)
+        for i, blob in zip(idxs, blobs):
+            msgs[i].enc_blob = blob
+        previews[thread_id] = MessageThread(id=thread_id).encrypt_preview(items[idxs[-1]][2])
+
+    for msg, (thread_id, _, body) in zip(msgs, items):
+        if _should_verify(verify) and msg.get_plain_body() != body:
+            logger.error("Message verification failed for thread %s", thread_id)
+            raise ValueError("Message verification failed")
+
+    with stage_timer("db_write"), transaction.atomic():
+        if not durable and connection.vendor == "postgresql":
+            with connection.cursor() as cursor:
+                cursor.execute("SET LOCAL synchronous_commit TO OFF")
+        if connection.features.can_return_rows_from_bulk_insert:
+            Message.objects.bulk_create(msgs)
+        else:
+            # Backends that can't hand back ids from a multi-row INSERT
+            for msg in msgs:
+                msg.save(force_insert=True)
+        for thread_id, idxs in by_thread.items():
+            _advance_inbox(thread_id, msgs[idxs[-1]], *previews[thread_id])
+    return msgs
+
+
+def clear_previews_for(message_ids):
+    """
+    Drop inbox previews that point at messages being deleted, so a
+    self-destructed message doesn't live on in the thread list.
+    `message_ids` may be a list or a values("id") queryset.
+    """
+    return MessageThread.objects.filter(last_message_id__in=message_ids).update(last_preview=None)
+
+
+def before_messages_deleted(message_ids):
+    """
+    before_batch hook for deleting messages: clear their previews and,
+    once the batch commits, send messages.deleted to each affected thread.
+    """
+    by_thread = {}
+    for thread_id, message_id in Message.objects.filter(id__in=message_ids).order_by("id").values_list("thread_id", "id"):
+        by_thread.setdefault(thread_id, []).append(message_id)
+    for thread_id, ids in by_thread.items():
+        notify_messages_deleted(thread_id, ids)
+    return clear_previews_for(message_ids)
+
+
+def mark_seen(thread_id: int, user, message_ids=None, up_to_id=None):
+    """
+    Mark messages in a thread as seen and start their self-destruct timer.
+
+    Either `message_ids` (explicit acks, e.g. a debounced burst of "seen"
+    frames) or `up_to_id` (everything from other senders up to and including
+    that id) is marked with ONE UPDATE and the reader's cursor is advanced.
+    Nothing is queued per message: the periodic sweep in messaging.expiry
+    deletes rows once delete_after passes. Membership must already be
+    checked by the caller.
+
+    Returns None if there was nothing to ack, else a dict describing the
+    acknowledged range for broadcasting.
+    """
+    target = _seen_target(thread_id, user, message_ids, up_to_id)
+    if target is None:
+        return None
+    qs, ids, matched = target
+    high = matched.aggregate(high=Max("id"))["high"]
+    if high is None:
+        return None
+    now = timezone.now()
+    deadline = now + SEEN_TTL
+    with transaction.atomic():
+        count = qs.update(seen_at=now, delete_after=deadline)
+        ThreadMembership.objects.mark_read(thread_id, user.id, high)
+    return _seen_result(count, ids, high, now, deadline)
+
+
+async def amark_seen(thread_id: int, user, message_ids=None, up_to_id=None):
+    """
+    Async mark_seen on the async ORM. The two UPDATEs run as separate
+    statements: both are idempotent and the cursor only moves forward, so
+    a failure in between is repaired by the next ack.
+    """
+    target = _seen_target(thread_id, user, message_ids, up_to_id)
+    if target is None:
+        return None
+    qs, ids, matched = target
+    high = (await matched.aaggregate(high=Max("id")))["high"]
+    if high is None:
+        return None
+    now = timezone.now()
+    deadline = now + SEEN_TTL
+    count = await qs.aupdate(seen_at=now, delete_after=deadline)
+    await ThreadMembership.objects.amark_read(thread_id, user.id, high)
+    return _seen_result(count, ids, high, now, deadline)
+
+
+def _seen_target(thread_id: int, user, message_ids, up_to_id):
+    """
+    (unseen messages the ack covers, ids, matched messages) or None. The
+    read cursor comes from the highest matched message, never straight from
+    the client, so an id beyond the thread can't hide later messages.
+    Acks never start the timer on the reader's own messages.
+    """
+    thread_messages = Message.objects.filter(thread_id=thread_id)
+    if up_to_id is not None:
+        matched = thread_messages.filter(id__lte=int(up_to_id))
+        ids = None
+        covered = matched.exclude(sender_id=user.id)
+    else:
+        ids = sorted({int(i) for i in message_ids or ()})
+        if not ids:
+            return None
+        matched = covered = thread_messages.filter(id__in=ids).exclude(sender_id=user.id)
+    return covered.filter(seen_at__isnull=True), ids, matched
+
+
+def _seen_result(count, ids, high, now, deadline) -> dict:
+    return {
+        "count": count,
+        "ids": ids,
+        "up_to_id": high,
+        "seen_at": now,
+        "delete_after": deadline,
+    }
+
+
+def seen_event(thread_id: int, username: str, result: dict) -> dict:
+    """Channel-layer event announcing one acknowledged batch/range."""
+    event = {
+        "type": "chat.message",
+        "event": "messages_seen",
+        "thread": thread_id,
+        "up_to_id": result["up_to_id"],
+        "seen_by": username,
+        "seen_at": result["seen_at"].isoformat(),
+        "delete_after": result["delete_after"].isoformat(),
+    }
+    if result["ids"] is not None:
+        event["ids"] = result["ids"]
+    return event
+
+
+def broadcast_seen(thread_id: int, username: str, result: dict):
+    """Sync-side broadcast (REST); failures are logged, the ack already committed."""
+    _group_send_all([(thread_group(thread_id), seen_event(thread_id, username, result))])
+
+
+def thread_group(thread_id: int) -> str:
+    """Channel-layer group of everyone connected to a thread."""
+    return f"thread.{thread_id}"
+
+
+def user_group(user_id: int) -> str:
+    """Channel-layer group of a user's multiplexed sockets (UserConsumer)."""
+    return f"user.{user_id}"
+
+
+def thread_member_ids(thread_id: int) -> list:
+    return list(ThreadMembership.objects.filter(thread_id=thread_id).values_list("user_id", flat=True))
+
+
+async def athread_member_ids(thread_id: int) -> list:
+    return [uid async for uid in ThreadMembership.objects.filter(thread_id=thread_id).values_list("user_id", flat=True)]
+
+
+def new_message_events(thread_id: int, message_id: int, username: str, body: str, created_iso: str, member_ids):
+    """
+    (group, event) pairs announcing a new message: sockets on the thread get
+    the message itself, every member's user socket an inbox update.
+    """
+    events = [(thread_group(thread_id), {
+        "type": "chat.message",
+        "event": "message_new",
+        "id": message_id,
+        "thread": thread_id,
+        "sender": username,
+        "body": body,
+        "created_at": created_iso,
+    })]
+    inbox = {
+        "type": "inbox.update",
+        "thread": thread_id,
+        "last_message_id": message_id,
+        "last_activity_at": created_iso,
+        "sender": username,
+    }
+    events.extend((user_group(user_id), inbox) for user_id in member_ids)
+    return events
+
+
+def broadcast_new_message(msg: Message, username: str, body: str):
+    """Sync-side (REST) announcement of a committed message; failures are logged."""
+    _group_send_all(new_message_events(
+        msg.thread_id, msg.id, username, body, msg.created_at.isoformat(), thread_member_ids(msg.thread_id)
+    ))
+
+
+def _group_send_all(events):
+    """Send [(group, event), ...] from sync code; failures are logged, not raised."""
+    layer = get_channel_layer()
+    for group, event in events:
+        try:
+            async_to_sync(layer.group_send)(group, event)
+        except Exception:
+            logger.exception("Could not send %s to %s", event.get("type"), group)
+
+
+def notify_membership_revoked(thread_id: int, user_id: int):
+    """
+    Once the current transaction commits, tell the user's open sockets on
+    the thread that their membership is gone. Consumers cache membership
+    for the life of the connection, so this is what revokes access.
+    """
+    event = {"type": "membership.revoked", "thread": thread_id, "user_id": user_id}
+    transaction.on_commit(
+        lambda: _group_send_all([(thread_group(thread_id), event), (user_group(user_id), event)])
+    )
+
+
+def notify_membership_added(thread_id: int, user_ids):
+    """After commit, tell the thread's sockets to reload the member list they fan inbox updates out to."""
+    event = {"type": "membership.added", "thread": thread_id, "user_ids": [int(u) for u in user_ids]}
+    transaction.on_commit(lambda: _group_send_all([(thread_group(thread_id), event)]))
+
+
+def notify_threads_deleted(thread_ids):
+    """
+    After commit, close every open socket on the given threads. Members'
+    user sockets are told as well, since they may have posted to a thread
+    without subscribing to it. Call before the memberships are deleted.
+    """
+    ids = list(thread_ids)
+    messages = [(thread_group(t), {"type": "thread.deleted", "thread": t}) for t in ids]
+    for thread_id, user_id in ThreadMembership.objects.filter(thread_id__in=ids).values_list("thread_id", "user_id"):
+        messages.append((user_group(user_id), {"type": "thread.deleted", "thread": thread_id}))
+    transaction.on_commit(lambda: _group_send_all(messages))
+
+
+def notify_messages_deleted(thread_id: int, message_ids):
+    """Tell the thread's sockets (and their recent-message buffers) that messages are gone."""
+    ids = [int(i) for i in message_ids]
+    event = {"type": "messages.deleted", "thread": thread_id, "ids": ids}
+    transaction.on_commit(lambda: _group_send_all([(thread_group(thread_id), event)]))
+
+
+def add_participants(thread_id: int, user_ids) -> list:
+    """Add users to a thread; returns the ids that weren't members yet."""
+    wanted = list(dict.fromkeys(int(u) for u in user_ids))
+    with transaction.atomic():
+        existing = set(
+            ThreadMembership.objects.filter(thread_id=thread_id, user_id__in=wanted).values_list("user_id", flat=True)
+        )
+        added = [u for u in wanted if u not in existing]
+        ThreadMembership.objects.bulk_create([ThreadMembership(thread_id=thread_id, user_id=u) for u in added])
+        if added:
+            notify_membership_added(thread_id, added)
+    return added
+
+
+def remove_participant(thread_id: int, user_id: int) -> bool:
+    """Remove a user from a thread and revoke their live connections."""
+    with transaction.atomic():
+        removed, _ = ThreadMembership.objects.filter(thread_id=thread_id, user_id=user_id).delete()
+        if removed:
+            notify_membership_revoked(thread_id, user_id)
+    return bool(removed)
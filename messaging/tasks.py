@@ -1,16 +1,46 @@
+import logging
+
 from celery import shared_task
-from django.utils import timezone
+from django.db import transaction
 from .models import Message
+from .services import before_messages_deleted
+
+logger = logging.getLogger(__name__)
 
 @shared_task
 def delete_message_task(message_id: int):
     # Hard-delete specific message
-    Message.objects.filter(id=message_id).delete()
+    with transaction.atomic():
+        before_messages_deleted([message_id])
+        Message.objects.filter(id=message_id).delete()
 
 @shared_task
 def delete_overdue_messages_task():
-    # Safety sweep: delete any messages past their delete_after deadline
-    Message.objects.filter(
-        delete_after__isnull=False,
-        delete_after__lte=timezone.now()
-    ).delete()
+    # Periodic sweep (CELERY_BEAT_SCHEDULE): delete messages past their deadline, bucket by bucket
+    from .expiry import sweep_expired
+
+    stats = sweep_expired()
+    stats["oldest_due"] = stats["oldest_due"] and stats["oldest_due"].isoformat()
+    return stats
+
+
+@shared_task
+def reencrypt_messages_task(after_id: int = 0, batch_size: int = 500, countdown: float = 1.0, passes: int = 3):
+    # One throttled batch of key rotation; re-queues itself with the new checkpoint
+    from .rotation import pending_rotation, reencrypt_batch, rotate_previews
+
+    _, _, last_id = reencrypt_batch(after_id, batch_size)
+    if last_id is not None:
+        reencrypt_messages_task.apply_async(args=[last_id, batch_size, countdown, passes], countdown=countdown)
+        return
+    # End of a pass: rows skipped while locked are behind the cursor now
+    left = pending_rotation().count()
+    if left and passes > 1:
+        reencrypt_messages_task.apply_async(args=[0, batch_size, countdown, passes - 1], countdown=countdown)
+        return
+    _, bad_previews = rotate_previews(batch_size=batch_size)
+    if left or bad_previews:
+        logger.error(
+            "Key rotation finished with %s messages and %s inbox previews still under an old key version",
+            left, bad_previews,
+        )
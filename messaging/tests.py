@@ -1,3 +1,8 @@
+import base64
+import io
+import json
+import os
+
 import pytest
 from django.test import Client
 from django.contrib.auth import get_user_model
@@ -7,9 +12,14 @@ from django.test import override_settings
 from config.asgi import application
 from channels.testing import WebsocketCommunicator
 from channels.db import database_sync_to_async
+from django.core.management import call_command
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from crypto_core.keys import invalidate_message_keys
 from messaging.tasks import delete_overdue_messages_task
 
-from messaging.models import MessageThread, Message
+from messaging.models import PREVIEW_CHARS, MessageThread, Message, ThreadMembership
+from messaging.services import create_message
 
 User = get_user_model()
 
@@ -27,9 +37,182 @@ def test_message_encrypt_decrypt(user):
 
     m2 = Message.objects.get(pk=msg.pk)
     assert "secret hello" not in m2.enc_body
+    assert b"secret hello" not in bytes(m2.enc_blob)
     assert m2.get_plain_body() == "secret hello"
 
 
+@pytest.mark.django_db
+def test_legacy_base64_rows_read_and_backfill(user):
+    thread = MessageThread.objects.create()
+    msg = Message(thread=thread, sender=user)
+    msg.set_plain_body("old format")
+    msg.save()
+    # simulate a row written before the binary column existed
+    Message.objects.filter(pk=msg.pk).update(enc_blob=None, enc_body=base64.b64encode(msg.enc_blob).decode())
+
+    legacy = Message.objects.get(pk=msg.pk)
+    assert legacy.enc_blob is None
+    assert legacy.get_plain_body() == "old format"
+
+    call_command("backfill_binary_bodies", "--sleep", "0", stdout=io.StringIO())
+    converted = Message.objects.get(pk=msg.pk)
+    assert converted.enc_body == ""
+    assert bytes(converted.enc_blob) == bytes(msg.enc_blob)
+    assert converted.get_plain_body() == "old format"
+
+
+@pytest.mark.django_db
+def test_rotate_message_keys_reencrypts_under_new_version(user, monkeypatch):
+    thread = MessageThread.objects.create()
+    msg = create_message(thread.id, user.id, "rotate me")
+    assert msg.key_version == 1
+
+    old_key = os.environ["CRYPTO_MASTER_KEY"]
+    monkeypatch.setenv("CRYPTO_MASTER_KEY", base64.b64encode(os.urandom(32)).decode())
+    monkeypatch.setenv("CRYPTO_MASTER_KEY_VERSION", "2")
+    monkeypatch.setenv("CRYPTO_RETIRED_MASTER_KEYS", f"1:{old_key}")
+    invalidate_message_keys(master=True)
+    try:
+        # old rows stay readable through the retired key
+        assert Message.objects.get(pk=msg.pk).get_plain_body() == "rotate me"
+
+        call_command("rotate_message_keys", "--sleep", "0", stdout=io.StringIO())
+        rotated = Message.objects.get(pk=msg.pk)
+        assert rotated.key_version == 2
+        assert rotated.get_plain_body() == "rotate me"
+
+        # Retire the old key: bodies and the inbox preview must still decrypt
+        monkeypatch.setenv("CRYPTO_RETIRED_MASTER_KEYS", "")
+        invalidate_message_keys(master=True)
+        assert Message.objects.get(pk=msg.pk).get_plain_body() == "rotate me"
+        thread = MessageThread.objects.get(pk=thread.pk)
+        assert thread.last_preview_key_version == 2
+        assert MessageThread.objects.decrypt_previews([thread]) == {thread.id: "rotate me"}
+    finally:
+        monkeypatch.undo()
+        invalidate_message_keys(master=True)
+
+
+@pytest.mark.django_db
+def test_rotate_message_keys_revisits_skipped_rows_and_fails_on_leftovers(user, monkeypatch):
+    from django.core.management.base import CommandError
+    from messaging.management.commands import rotate_message_keys
+    from messaging.rotation import pending_rotation
+
+    thread = MessageThread.objects.create()
+    first = create_message(thread.id, user.id, "one")
+    create_message(thread.id, user.id, "two")
+
+    old_key = os.environ["CRYPTO_MASTER_KEY"]
+    monkeypatch.setenv("CRYPTO_MASTER_KEY", base64.b64encode(os.urandom(32)).decode())
+    monkeypatch.setenv("CRYPTO_MASTER_KEY_VERSION", "2")
+    monkeypatch.setenv("CRYPTO_RETIRED_MASTER_KEYS", f"1:{old_key}")
+    invalidate_message_keys(master=True)
+    try:
+        # First batch behaves as if `first` were locked by a live request
+        real, calls = rotate_message_keys.reencrypt_batch, []
+
+        def skipping(after_id, *args):
+            calls.append(after_id)
+            return real(max(after_id, first.id) if len(calls) == 1 else after_id, *args)
+
+        monkeypatch.setattr(rotate_message_keys, "reencrypt_batch", skipping)
+        out = io.StringIO()
+        call_command("rotate_message_keys", "--sleep", "0", stdout=out)
+        assert "starting again" in out.getvalue() and "Rotation complete" in out.getvalue()
+        assert not pending_rotation().exists()
+
+        # A row that can't be decrypted is reported, not declared complete
+        broken = create_message(thread.id, user.id, "three")
+        Message.objects.filter(pk=broken.pk).update(key_version=1)
+        with pytest.raises(CommandError, match="1 messages and 0 inbox previews are still not under key version 2"):
+            call_command("rotate_message_keys", "--sleep", "0", stdout=io.StringIO())
+    finally:
+        monkeypatch.undo()
+        invalidate_message_keys(master=True)
+
+
+@pytest.mark.django_db
+def test_compressed_bodies_round_trip(user, settings):
+    settings.MESSAGE_COMPRESSION = True
+    settings.MESSAGE_COMPRESSION_MIN_BYTES = 64
+    thread = MessageThread.objects.create()
+    long_body = "meeting moved to thursday, bring the slides. " * 50
+
+    msg = Message(thread=thread, sender=user)
+    msg.set_plain_body(long_body)
+    msg.save()
+
+    m = Message.objects.get(pk=msg.pk)
+    assert len(m.enc_blob) < len(long_body)
+    assert m.get_plain_body() == long_body
+    assert Message.objects.decrypt_bodies([m]) == {m.id: long_body}
+
+
+@pytest.mark.django_db
+def test_decrypt_bodies_batches_across_threads(user):
+    other = User.objects.create_user(username="dora", password="Secret123!")
+    t1 = MessageThread.objects.create()
+    t2 = MessageThread.objects.create()
+    ids = {}
+    for t, text in ((t1, "first"), (t1, "second"), (t2, "third")):
+        m = Message(thread=t, sender=user)
+        m.set_plain_body(text)
+        m.save()
+        ids[m.id] = text
+
+    bodies = Message.objects.decrypt_bodies(Message.objects.filter(sender=user))
+    assert bodies == ids
+
+
+@pytest.mark.django_db
+def test_create_message_service_is_a_single_insert(user):
+    thread = MessageThread.objects.create()
+    with CaptureQueriesContext(connection) as ctx:
+        msg = create_message(thread.id, user.id, "one write", verify=True)
+    writes = [q["sql"].split()[0:3] for q in ctx.captured_queries if q["sql"].startswith(("INSERT", "UPDATE"))]
+    # one INSERT for the message, one UPDATE of the thread's inbox columns
+    assert writes == [["INSERT", "INTO", '"messaging_message"'], ["UPDATE", '"messaging_messagethread"', "SET"]]
+    assert Message.objects.get(pk=msg.pk).get_plain_body() == "one write"
+
+
+@pytest.mark.django_db
+def test_inbox_sorted_by_activity_with_previews_and_cursor(user):
+    bob = User.objects.create_user(username="bob_inbox", password="x")
+    threads = []
+    for _ in range(3):
+        t = MessageThread.objects.create()
+        t.participants.add(user, bob)
+        threads.append(t)
+    create_message(threads[0].id, bob.id, "oldest thread, newest message")
+    create_message(threads[2].id, bob.id, "x" * 500)
+
+    c = Client()
+    assert c.login(username="alice", password="Secret123!") is True
+    page = c.get("/msg/threads/", {"limit": 2}).json()
+    assert [t["id"] for t in page["threads"]] == [threads[2].id, threads[0].id]
+    assert page["threads"][0]["last_message"] == "x" * PREVIEW_CHARS
+    assert page["threads"][1]["last_message"] == "oldest thread, newest message"
+
+    rest = c.get("/msg/threads/", {"limit": 2, "cursor": page["next_cursor"]}).json()
+    assert [t["id"] for t in rest["threads"]] == [threads[1].id]
+    assert rest["threads"][0]["last_message"] is None and rest["next_cursor"] is None
+
+
+@pytest.mark.django_db
+def test_backfill_thread_activity(user):
+    thread = MessageThread.objects.create()
+    msg = Message(thread=thread, sender=user)
+    msg.set_plain_body("before denormalization")
+    msg.save()
+
+    call_command("backfill_thread_activity", "--sleep", "0", stdout=io.StringIO())
+    thread.refresh_from_db()
+    assert thread.last_message_id == msg.id
+    assert thread.last_activity_at == msg.created_at
+    assert MessageThread.objects.decrypt_previews([thread]) == {thread.id: "before denormalization"}
+
+
 # --- API happy path (create thread, send encrypted message, list returns plaintext) ---
 
 @pytest.mark.django_db
@@ -59,6 +242,97 @@ def test_create_thread_and_message_api(user):
     assert "top secret" in bodies
 
 
+@pytest.mark.django_db
+def test_export_streams_ndjson_with_since_id(user, settings):
+    settings.MESSAGE_EXPORT_CHUNK_SIZE = 2
+    thread = MessageThread.objects.create()
+    thread.participants.add(user)
+    ids = [create_message(thread.id, user.id, f"line {i}").id for i in range(5)]
+
+    c = Client()
+    assert c.login(username="alice", password="Secret123!") is True
+    r = c.get(f"/msg/threads/{thread.id}/export/")
+    assert r.status_code == 200
+    assert r["Content-Type"] == "application/x-ndjson"
+    rows = [json.loads(line) for line in b"".join(r.streaming_content).decode().splitlines()]
+    assert [row["body"] for row in rows] == [f"line {i}" for i in range(5)]
+
+    r2 = c.get(f"/msg/threads/{thread.id}/export/?since_id={ids[2]}")
+    rows = [json.loads(line) for line in b"".join(r2.streaming_content).decode().splitlines()]
+    assert [row["id"] for row in rows] == ids[3:]
+
+
+@pytest.mark.django_db
+def test_list_messages_keyset_pagination(user):
+    thread = MessageThread.objects.create()
+    thread.participants.add(user)
+    ids = [create_message(thread.id, user.id, f"m{i}").id for i in range(7)]
+
+    c = Client()
+    assert c.login(username="alice", password="Secret123!") is True
+    url = f"/msg/threads/{thread.id}/messages/"
+
+    newest = c.get(url, {"limit": 3}).json()
+    assert [m["id"] for m in newest["messages"]] == ids[4:]
+    assert newest["next_cursor"] == ids[4] and newest["prev_cursor"] is None
+
+    older = c.get(url, {"limit": 3, "before_id": newest["next_cursor"]}).json()
+    assert [m["id"] for m in older["messages"]] == ids[1:4]
+    assert older["next_cursor"] == ids[1] and older["prev_cursor"] == ids[3]
+
+    oldest = c.get(url, {"limit": 3, "before_id": older["next_cursor"]}).json()
+    assert [m["id"] for m in oldest["messages"]] == ids[:1]
+    assert oldest["next_cursor"] is None
+
+    newer = c.get(url, {"limit": 3, "after_id": ids[3]}).json()
+    assert [m["id"] for m in newer["messages"]] == ids[4:]
+    assert newer["prev_cursor"] is None and newer["next_cursor"] == ids[4]
+
+
+@pytest.mark.django_db
+def test_unread_counts_follow_read_cursor(user, django_assert_num_queries):
+    bob = User.objects.create_user(username="bob_unread", password="x")
+    t1 = MessageThread.objects.create()
+    t2 = MessageThread.objects.create()
+    t1.participants.add(user, bob)
+    t2.participants.add(user, bob)
+    m1 = create_message(t1.id, bob.id, "one")
+    create_message(t1.id, bob.id, "two")
+    create_message(t1.id, user.id, "mine")  # own messages never count
+    create_message(t2.id, bob.id, "three")
+
+    with django_assert_num_queries(1):
+        assert ThreadMembership.objects.unread_counts(user) == {t1.id: 2, t2.id: 1}
+
+    ThreadMembership.objects.mark_read(t1.id, user.id, m1.id)
+    c = Client()
+    assert c.login(username="alice", password="Secret123!") is True
+    r = c.get("/msg/unread/")
+    assert r.json() == {"total": 2, "threads": {str(t1.id): 1, str(t2.id): 1}}
+
+
+@pytest.mark.django_db
+def test_mark_seen_cursor_is_clamped_to_real_messages(user):
+    from messaging.services import mark_seen
+
+    bob = User.objects.create_user(username="bob_clamp", password="x")
+    t = MessageThread.objects.create()
+    t.participants.add(user, bob)
+    theirs = create_message(t.id, bob.id, "hi")
+    mine = create_message(t.id, user.id, "mine")
+
+    assert mark_seen(t.id, user, message_ids=[10**12]) is None
+    assert mark_seen(t.id, user, message_ids=[mine.id]) is None  # own messages aren't acked
+    assert Message.objects.get(pk=mine.pk).seen_at is None
+    result = mark_seen(t.id, user, up_to_id=10**12)
+    assert result["count"] == 1 and result["up_to_id"] == mine.id
+    assert ThreadMembership.objects.get(thread=t, user=user).last_read_message_id == mine.id
+
+    create_message(t.id, bob.id, "later")
+    assert ThreadMembership.objects.unread_counts(user) == {t.id: 1}
+    assert Message.objects.get(pk=theirs.pk).seen_at is not None
+
+
 # --- Permission checks (non-participant forbidden) ---
 
 @pytest.mark.django_db
@@ -127,6 +401,67 @@ async def test_ws_thread_send_message_encrypted():
     await comm.disconnect()
 
 
+@pytest.mark.asyncio
+@override_settings(
+    CHANNEL_LAYERS={"default": {"BACKEND": "channels.layers.InMemoryChannelLayer"}}
+)
+@pytest.mark.django_db(transaction=True)
+async def test_ws_debounced_seen_is_flushed_on_disconnect(thread_pair):
+    import asyncio
+
+    alice, bob, t = thread_pair
+    first = await database_sync_to_async(create_message)(t.id, alice.id, "one")
+    second = await database_sync_to_async(create_message)(t.id, alice.id, "two")
+
+    comm = WebsocketCommunicator(application, f"/ws/threads/{t.id}/")
+    comm.scope["user"] = bob
+    assert (await comm.connect())[0] is True
+    await comm.receive_json_from()  # ready
+    await comm.send_json_to({"action": "seen", "message_id": first.id})
+    await asyncio.sleep(0.35)  # the debounce timer has started its flush
+    await comm.send_json_to({"action": "seen", "message_id": second.id})
+    await comm.disconnect()  # before the second timer fires
+
+    seen = await database_sync_to_async(
+        lambda: set(Message.objects.filter(seen_at__isnull=False).values_list("id", flat=True))
+    )()
+    assert seen == {first.id, second.id}
+
+
+@pytest.mark.asyncio
+@override_settings(
+    CHANNEL_LAYERS={"default": {"BACKEND": "channels.layers.InMemoryChannelLayer"}}
+)
+@pytest.mark.django_db(transaction=True)
+async def test_ws_seen_up_to_marks_range_in_one_event(thread_pair):
+    alice, bob, t = thread_pair
+
+    @database_sync_to_async
+    def add_messages():
+        ids = [create_message(t.id, bob.id, f"b{i}").id for i in range(3)]
+        own = create_message(t.id, alice.id, "mine").id
+        return ids, own
+
+    ids, own = await add_messages()
+    comm = WebsocketCommunicator(application, f"/ws/threads/{t.id}/")
+    comm.scope["user"] = alice
+    connected, _ = await comm.connect()
+    assert connected is True
+    await comm.receive_json_from()  # ready
+
+    await comm.send_json_to({"action": "seen_up_to", "message_id": own})
+    event = await comm.receive_json_from()
+    assert event["event"] == "messages_seen"
+    assert event["up_to_id"] == own and "ids" not in event
+
+    seen = await database_sync_to_async(
+        lambda: dict(Message.objects.filter(thread=t).values_list("id", "seen_at"))
+    )()
+    assert all(seen[i] is not None for i in ids)
+    assert seen[own] is None  # own messages don't start the timer
+    await comm.disconnect()
+
+
 @pytest.mark.django_db
 def test_seen_endpoint_sets_delete_after_and_not_immediately_deleted(user):
     bob = User.objects.create_user(username="bob_seen", password="x")
@@ -146,8 +481,10 @@ def test_seen_endpoint_sets_delete_after_and_not_immediately_deleted(user):
     assert r_msg.status_code == 201
     msg_id = r_msg.json()["id"]
 
-    # Mark seen -> schedules delete_after ≈ 5min in future
-    r_seen = c.post(f"/msg/messages/{msg_id}/seen/")
+    # Recipient marks it seen -> schedules delete_after ≈ 5min in future
+    c_bob = Client()
+    c_bob.force_login(bob)
+    r_seen = c_bob.post(f"/msg/messages/{msg_id}/seen/")
     assert r_seen.status_code == 200
     payload = r_seen.json()
     assert payload["ok"] is True
@@ -180,4 +517,757 @@ def test_safety_sweep_deletes_past_deadline(user):
     msg.save(update_fields=["seen_at", "delete_after"])
 
     delete_overdue_messages_task()
-    assert not Message.objects.filter(id=msg.id).exists()
\ No newline at end of file
+    assert not Message.objects.filter(id=msg.id).exists()
+
+
+@pytest.mark.django_db
+def test_expiry_sweep_drains_buckets_in_bounded_batches(user, settings):
+    settings.MESSAGE_EXPIRY_BUCKET_SECONDS = 60
+    thread = MessageThread.objects.create()
+    thread.participants.add(user)
+    now = timezone.now()
+    ids = [create_message(thread.id, user.id, f"m{i}").id for i in range(7)]
+    # three buckets' worth of overdue rows, one still pending
+    for i, mid in enumerate(ids[:6]):
+        Message.objects.filter(id=mid).update(delete_after=now - timedelta(minutes=10 - 2 * (i % 3)))
+    Message.objects.filter(id=ids[6]).update(delete_after=now + timedelta(minutes=5))
+
+    from messaging.expiry import expiry_lag, sweep_expired
+
+    lag = expiry_lag(now)
+    assert lag["due"] == 6 and lag["lag_seconds"] >= 600
+
+    stats = sweep_expired(now=now, batch_size=1, max_batches=4)
+    assert stats["deleted"] == 4 and stats["batches"] == 4
+    assert stats["due"] == 2  # backlog left for the next beat run
+
+    stats = sweep_expired(now=now, batch_size=1)
+    assert stats["deleted"] == 2 and stats["due"] == 0 and stats["lag_seconds"] == 0
+    assert list(Message.objects.filter(thread=thread).values_list("id", flat=True)) == [ids[6]]
+    thread.refresh_from_db()
+    assert thread.last_preview is not None  # the surviving message is still the latest
+
+
+@pytest.mark.django_db
+@override_settings(
+    CHANNEL_LAYERS={"default": {"BACKEND": "channels.layers.InMemoryChannelLayer"}}
+)
+def test_expiry_sweep_tells_open_sockets_what_it_deleted(user, django_capture_on_commit_callbacks):
+    from asgiref.sync import async_to_sync
+    from channels.layers import get_channel_layer
+    from messaging.expiry import sweep_expired
+    from messaging.services import thread_group
+
+    thread = MessageThread.objects.create()
+    thread.participants.add(user)
+    now = timezone.now()
+    gone = [create_message(thread.id, user.id, f"m{i}").id for i in range(2)]
+    kept = create_message(thread.id, user.id, "kept").id
+    Message.objects.filter(id__in=gone).update(delete_after=now - timedelta(minutes=1))
+
+    layer = get_channel_layer()
+    async_to_sync(layer.group_add)(thread_group(thread.id), "sweep-listener")
+    with django_capture_on_commit_callbacks(execute=True):
+        assert sweep_expired(now=now)["deleted"] == 2
+
+    event = async_to_sync(layer.receive)("sweep-listener")
+    assert event == {"type": "messages.deleted", "thread": thread.id, "ids": gone}
+    assert list(Message.objects.filter(thread=thread).values_list("id", flat=True)) == [kept]
+
+
+@pytest.mark.django_db
+def test_batched_delete_is_resumable_and_drains_cascade(user):
+    from messaging.deletion import batched_delete
+
+    threads = []
+    for i in range(5):
+        t = MessageThread.objects.create()
+        t.participants.add(user)
+        for j in range(3):
+            create_message(t.id, user.id, f"{i}-{j}")
+        threads.append(t)
+
+    first = batched_delete(MessageThread.objects.all(), batch_size=2, max_batches=1)
+    assert first["deleted"] == 2 and first["complete"] is False
+    assert first["last_id"] == threads[1].id
+    assert first["cascaded"] == 2 * 3 + 2  # messages + memberships
+
+    rest = batched_delete(MessageThread.objects.all(), batch_size=2, after_id=first["last_id"])
+    assert rest["deleted"] == 3 and rest["batches"] == 2 and rest["complete"] is True
+    assert not MessageThread.objects.exists()
+    assert not Message.objects.exists() and not ThreadMembership.objects.exists()
+
+
+@pytest.mark.django_db
+def test_batched_delete_fast_path_skips_loading_rows(user):
+    from django.db.models.signals import pre_delete
+    from messaging.deletion import batched_delete
+
+    t = MessageThread.objects.create()
+    for j in range(4):
+        create_message(t.id, user.id, f"m{j}")
+
+    second_id = Message.objects.filter(thread=t).order_by("id").values_list("id", flat=True)[1]
+    with CaptureQueriesContext(connection) as ctx:
+        batched_delete(Message.objects.filter(thread=t, id__lte=second_id))
+    assert not any("enc_blob" in q["sql"] for q in ctx.captured_queries)
+    assert Message.objects.filter(thread=t).count() == 2
+
+    # With a receiver attached the bounded QuerySet.delete() fallback runs, so it still fires
+    seen = []
+    receiver = lambda sender, instance, **kw: seen.append(instance.id)
+    pre_delete.connect(receiver, sender=Message)
+    try:
+        result = batched_delete(Message.objects.filter(thread=t))
+    finally:
+        pre_delete.disconnect(receiver, sender=Message)
+    assert result["deleted"] == 2 and len(seen) == 2
+
+
+@pytest.mark.django_db
+def test_batched_delete_thread_batch_is_bounded_and_never_loads_messages(user, django_assert_num_queries):
+    from messaging.deletion import batched_delete
+
+    for i in range(3):
+        t = MessageThread.objects.create()
+        t.participants.add(user)
+        for j in range(2):
+            create_message(t.id, user.id, f"{i}-{j}")
+
+    # pick, savepoint, lock, re-check, collect threads, memberships, messages, threads, release
+    with django_assert_num_queries(9) as ctx:
+        result = batched_delete(MessageThread.objects.all())
+    assert result["deleted"] == 3 and result["cascaded"] == 3 + 6
+    assert not any("enc_blob" in q["sql"] for q in ctx.captured_queries)
+    assert not MessageThread.objects.exists() and not Message.objects.exists()
+
+
+@pytest.mark.django_db
+def test_batched_delete_skips_rows_that_stop_matching(user, monkeypatch):
+    from django.db.models import Count
+    from messaging import deletion
+
+    racy, idle = MessageThread.objects.create(), MessageThread.objects.create()
+    racy.participants.add(user)
+    real_atomic, raced = deletion.transaction.atomic, []
+
+    def atomic(*args, **kwargs):
+        if not raced:  # a message lands after the batch was picked, before it is locked
+            raced.append(None)
+            raced[0] = create_message(racy.id, user.id, "just in time")
+        return real_atomic(*args, **kwargs)
+
+    monkeypatch.setattr(deletion.transaction, "atomic", atomic)
+    empty = MessageThread.objects.annotate(n=Count("messages")).filter(n=0)
+    result = deletion.batched_delete(empty)
+
+    assert result["deleted"] == 1 and result["skipped"] == 1
+    assert list(MessageThread.objects.values_list("id", flat=True)) == [racy.id]
+    assert Message.objects.filter(id=raced[0].id).exists()
+    assert ThreadMembership.objects.filter(thread=racy).exists()
+
+
+@pytest.mark.django_db
+def test_cleanup_empty_threads_command_batches(user):
+    keep = MessageThread.objects.create()
+    create_message(keep.id, user.id, "hi")
+    for _ in range(3):
+        MessageThread.objects.create().participants.add(user)
+
+    out = io.StringIO()
+    call_command("cleanup_empty_threads", "--batch-size", "2", "--sleep", "0", stdout=out)
+    assert "Successfully deleted 3 empty message threads" in out.getvalue()
+    assert "checkpoint --after-id" in out.getvalue()
+    assert list(MessageThread.objects.values_list("id", flat=True)) == [keep.id]
+
+
+@pytest.mark.django_db
+def test_dm_lookup_is_one_keyed_query(user):
+    bob = User.objects.create_user(username="bob_dm", password="x")
+    thread, created = MessageThread.objects.get_thread_for_participants(user, bob)
+    assert created is True and thread.dm_key == f"{min(user.id, bob.id)}:{max(user.id, bob.id)}"
+
+    with CaptureQueriesContext(connection) as ctx:
+        again, created = MessageThread.objects.get_thread_for_participants(bob, user)
+    assert (again.id, created) == (thread.id, False)
+    assert len(ctx.captured_queries) == 1
+
+    c = Client()
+    c.force_login(user)
+    r = c.post("/msg/threads/create/", data={"participants": [bob.id]}, content_type="application/json")
+    assert (r.status_code, r.json()["id"]) == (200, thread.id)
+    r = c.post(f"/msg/dm/{bob.id}/")
+    assert (r.status_code, r.json()["id"]) == (200, thread.id)
+
+
+@pytest.mark.django_db
+def test_backfill_dm_keys_merges_duplicates(user):
+    bob = User.objects.create_user(username="bob_dupe", password="x")
+    carol = User.objects.create_user(username="carol_dupe", password="x")
+    dupes = []
+    for i in range(3):
+        t = MessageThread.objects.create()
+        t.participants.add(user, bob)
+        create_message(t.id, bob.id, f"from dupe {i}")
+        dupes.append(t)
+    group = MessageThread.objects.create()
+    group.participants.add(user, bob, carol)
+    ThreadMembership.objects.mark_read(dupes[2].id, user.id, Message.objects.filter(thread=dupes[2]).get().id)
+
+    out = io.StringIO()
+    call_command("backfill_dm_keys", "--batch-size", "2", "--sleep", "0", stdout=out)
+    assert "1 keyed, 2 duplicates merged" in out.getvalue()
+
+    canonical = MessageThread.objects.get(dm_key__isnull=False)
+    assert canonical.id == dupes[0].id
+    assert set(MessageThread.objects.values_list("id", flat=True)) == {canonical.id, group.id}
+    msgs = list(Message.objects.filter(thread=canonical).order_by("id"))
+    assert [m.get_plain_body() for m in msgs] == ["from dupe 0", "from dupe 1", "from dupe 2"]
+    assert canonical.last_message_id == msgs[-1].id
+    assert MessageThread.objects.decrypt_previews([canonical])[canonical.id] == "from dupe 2"
+    # read state carried over from the merged thread
+    assert ThreadMembership.objects.get(thread=canonical, user=user).last_read_message_id == msgs[-1].id
+
+
+@pytest.mark.asyncio
+@override_settings(
+    CHANNEL_LAYERS={"default": {"BACKEND": "channels.layers.InMemoryChannelLayer"}}
+)
+@pytest.mark.django_db(transaction=True)
+async def test_ws_membership_cached_until_revoked(monkeypatch, thread_pair):
+    from messaging.models import ThreadMembershipManager
+    from messaging.services import remove_participant
+
+    checks = []
+    original = ThreadMembershipManager.ais_member
+
+    async def counting(self, *a):
+        checks.append(a)
+        return await original(self, *a)
+
+    monkeypatch.setattr(ThreadMembershipManager, "ais_member", counting)
+
+    alice, bob, t = thread_pair
+    comm = WebsocketCommunicator(application, f"/ws/threads/{t.id}/")
+    comm.scope["user"] = alice
+    assert (await comm.connect())[0] is True
+    await comm.receive_json_from()  # ready
+
+    for i in range(3):
+        await comm.send_json_to({"action": "send", "body": f"hi {i}"})
+        assert (await comm.receive_json_from())["type"] == "message_sent"
+    assert len(checks) == 1  # only the connect-time check
+
+    # removing someone else doesn't affect alice
+    await database_sync_to_async(remove_participant)(t.id, bob.id)
+    await database_sync_to_async(remove_participant)(t.id, alice.id)
+    assert await comm.receive_json_from() == {"type": "membership_revoked", "thread": t.id}
+    assert (await comm.receive_output())["type"] == "websocket.close"
+    await comm.disconnect()
+
+
+@pytest.mark.asyncio
+@override_settings(
+    CHANNEL_LAYERS={"default": {"BACKEND": "channels.layers.InMemoryChannelLayer"}}
+)
+@pytest.mark.django_db(transaction=True)
+async def test_removed_member_drops_out_of_cached_inbox_fanout(thread_pair):
+    import asyncio
+    from channels.layers import get_channel_layer
+    from messaging.services import remove_participant, user_group
+
+    alice, bob, t = thread_pair
+
+    @database_sync_to_async
+    def add_carol():
+        carol = User.objects.create_user(username="carol_fan", password="x")
+        t.participants.add(carol)
+        return carol
+
+    carol = await add_carol()
+    layer = get_channel_layer()
+    await layer.group_add(user_group(bob.id), "bob-inbox")
+    await layer.group_add(user_group(carol.id), "carol-inbox")
+    comm = WebsocketCommunicator(application, f"/ws/threads/{t.id}/")
+    comm.scope["user"] = alice
+    assert (await comm.connect())[0] is True
+    await comm.receive_json_from()  # ready
+
+    await comm.send_json_to({"action": "send", "body": "before"})
+    assert (await comm.receive_json_from())["type"] == "message_sent"
+    assert (await layer.receive("carol-inbox"))["type"] == "inbox.update"
+    assert (await layer.receive("bob-inbox"))["type"] == "inbox.update"
+
+    await database_sync_to_async(remove_participant)(t.id, carol.id)
+    assert (await layer.receive("carol-inbox"))["type"] == "membership.revoked"
+    await asyncio.sleep(0.1)  # let alice's socket handle the revocation
+
+    await comm.send_json_to({"action": "send", "body": "after"})
+    assert (await comm.receive_json_from())["type"] == "message_sent"
+    assert (await layer.receive("bob-inbox"))["type"] == "inbox.update"
+    with pytest.raises(asyncio.TimeoutError):
+        await asyncio.wait_for(layer.receive("carol-inbox"), 0.3)
+    await comm.disconnect()
+
+
+@pytest.mark.asyncio
+@override_settings(
+    CHANNEL_LAYERS={"default": {"BACKEND": "channels.layers.InMemoryChannelLayer"}}
+)
+@pytest.mark.django_db(transaction=True)
+async def test_added_member_joins_cached_inbox_fanout(thread_pair):
+    import asyncio
+    from channels.layers import get_channel_layer
+    from messaging.services import add_participants, user_group
+
+    alice, bob, t = thread_pair
+    carol = await database_sync_to_async(User.objects.create_user)(username="carol_join", password="x")
+    layer = get_channel_layer()
+    await layer.group_add(user_group(carol.id), "carol-inbox")
+    comm = WebsocketCommunicator(application, f"/ws/threads/{t.id}/")
+    comm.scope["user"] = alice
+    assert (await comm.connect())[0] is True
+    await comm.receive_json_from()  # ready
+
+    await comm.send_json_to({"action": "send", "body": "before"})
+    assert (await comm.receive_json_from())["type"] == "message_sent"  # member list now cached
+    assert await database_sync_to_async(add_participants)(t.id, [carol.id, bob.id]) == [carol.id]
+    await asyncio.sleep(0.1)  # let alice's socket handle membership.added
+
+    await comm.send_json_to({"action": "send", "body": "after"})
+    assert (await comm.receive_json_from())["type"] == "message_sent"
+    assert (await layer.receive("carol-inbox"))["last_message_id"] is not None
+    await comm.disconnect()
+
+
+@pytest.mark.asyncio
+@override_settings(
+    CHANNEL_LAYERS={"default": {"BACKEND": "channels.layers.InMemoryChannelLayer"}}
+)
+@pytest.mark.django_db(transaction=True)
+async def test_user_socket_hears_deletion_of_unsubscribed_thread(thread_pair):
+    from messaging.deletion import batched_delete
+    from messaging.services import notify_threads_deleted
+
+    alice, bob, t = thread_pair
+    comm = WebsocketCommunicator(application, "/ws/user/")
+    comm.scope["user"] = alice
+    assert (await comm.connect())[0] is True
+    await comm.receive_json_from()  # ready
+    await comm.send_json_to({"action": "send", "thread": t.id, "body": "no subscribe"})
+    assert (await comm.receive_json_from())["type"] == "message_sent"
+    assert (await comm.receive_json_from())["type"] == "inbox_update"  # alice's own badge feed
+
+    await database_sync_to_async(batched_delete)(
+        MessageThread.objects.filter(id=t.id), before_batch=notify_threads_deleted
+    )
+    assert await comm.receive_json_from() == {"type": "thread_deleted", "thread": t.id}
+    await comm.send_json_to({"action": "send", "thread": t.id, "body": "too late"})
+    assert (await comm.receive_json_from())["detail"] == "You are not a member of this thread"
+    await comm.disconnect()
+
+
+@pytest.mark.django_db
+def test_create_messages_bulk_inserts_once(user):
+    from messaging.services import create_messages
+
+    bob = User.objects.create_user(username="bob_bulk", password="x")
+    t1, t2 = MessageThread.objects.create(), MessageThread.objects.create()
+    items = [(t1.id, user.id, "a"), (t2.id, bob.id, "b"), (t1.id, bob.id, "c"), (t2.id, user.id, "d")]
+
+    with CaptureQueriesContext(connection) as ctx:
+        msgs = create_messages(items)
+    inserts = [q for q in ctx.captured_queries if q["sql"].startswith("INSERT")]
+    assert len(inserts) == 1
+    assert [m.get_plain_body() for m in Message.objects.filter(id__in=[m.id for m in msgs]).order_by("id")] == ["a", "b", "c", "d"]
+    t1.refresh_from_db(), t2.refresh_from_db()
+    assert (t1.last_message_id, t2.last_message_id) == (msgs[2].id, msgs[3].id)
+    assert MessageThread.objects.decrypt_previews([t1, t2]) == {t1.id: "c", t2.id: "d"}
+
+
+@pytest.mark.django_db
+def test_inbox_pointer_only_moves_forward(user):
+    from messaging.services import prepare_message, save_prepared_message
+
+    t = MessageThread.objects.create()
+    older = create_message(t.id, user.id, "older")
+    newer = create_message(t.id, user.id, "newer")
+    Message.objects.filter(pk=older.pk).delete()
+
+    # The older send commits last (same id, as if its transaction was slow)
+    msg, preview, version = prepare_message(t.id, user.id, "older")
+    msg.id = older.id
+    save_prepared_message(msg, preview, version)
+
+    t.refresh_from_db()
+    assert t.last_message_id == newer.id
+    assert MessageThread.objects.decrypt_previews([t]) == {t.id: "newer"}
+
+
+@pytest.mark.asyncio
+@pytest.mark.django_db(transaction=True)
+async def test_write_buffer_batches_concurrent_sends(monkeypatch, thread_pair):
+    import asyncio
+    from messaging import write_buffer
+
+    batches = []
+    original = write_buffer.create_messages
+    monkeypatch.setattr(write_buffer, "create_messages", lambda items, **kw: batches.append(len(items)) or original(items, **kw))
+
+    u, _, t = thread_pair
+    buf = write_buffer.MessageWriteBuffer(max_batch=4, max_delay_ms=50)
+    msgs = await asyncio.gather(*(buf.submit(t.id, u.id, f"burst {i}") for i in range(6)))
+    assert batches == [4, 2]  # size-triggered flush, then the timer
+    assert len({m.id for m in msgs}) == 6
+
+    # a bad row falls back to per-message writes; only that send fails
+    good, bad = await asyncio.gather(
+        buf.submit(t.id, u.id, "fine"), buf.submit(999999, u.id, "no thread"), return_exceptions=True
+    )
+    assert isinstance(bad, Exception) and good.get_plain_body() == "fine"
+
+
+@pytest.mark.django_db
+def test_metrics_endpoint_exposes_stage_histograms(user, settings):
+    settings.METRICS_TOKEN = "scrape-me"
+    thread = MessageThread.objects.create()
+    create_message(thread.id, user.id, "timed")
+
+    c = Client()
+    assert c.get("/metrics").status_code == 401
+    r = c.get("/metrics", HTTP_AUTHORIZATION="Bearer scrape-me")
+    assert r.status_code == 200 and r["Content-Type"].startswith("text/plain")
+    text = r.content.decode()
+    for stage in ("key_derivation", "encrypt", "db_write"):
+        assert f'cloakpost_messaging_stage_seconds_bucket{{stage="{stage}",le="+Inf"}}' in text
+    assert "# TYPE cloakpost_ws_open_connections gauge" in text
+
+
+@pytest.mark.django_db
+def test_metrics_report_expiry_backlog(user, settings):
+    settings.METRICS_TOKEN = "scrape-me"
+    thread = MessageThread.objects.create()
+    msg = create_message(thread.id, user.id, "overdue")
+    Message.objects.filter(id=msg.id).update(delete_after=timezone.now() - timedelta(minutes=10))
+
+    text = Client().get("/metrics", HTTP_AUTHORIZATION="Bearer scrape-me").content.decode()
+    assert "cloakpost_message_expiry_due 1\n" in text
+    lag = float(text.split("\ncloakpost_message_expiry_lag_seconds ")[1].split()[0])
+    assert lag >= 600
+
+    from messaging.expiry import sweep_expired
+
+    sweep_expired()
+    text = Client().get("/metrics", HTTP_AUTHORIZATION="Bearer scrape-me").content.decode()
+    assert "cloakpost_message_expiry_due 0\n" in text
+    assert "cloakpost_message_expiry_lag_seconds 0.0\n" in text
+
+
+@pytest.mark.asyncio
+@override_settings(
+    CHANNEL_LAYERS={"default": {"BACKEND": "channels.layers.InMemoryChannelLayer"}}
+)
+@pytest.mark.django_db(transaction=True)
+async def test_user_socket_multiplexes_threads_and_inbox(thread_pair):
+    alice, bob, t1 = thread_pair
+
+    @database_sync_to_async
+    def more_threads():
+        t2, other = MessageThread.objects.create(), MessageThread.objects.create()
+        t2.participants.add(alice, bob)
+        other.participants.add(bob)
+        return t2, other
+
+    t2, other = await more_threads()
+    a = WebsocketCommunicator(application, "/ws/user/")
+    a.scope["user"] = alice
+    b = WebsocketCommunicator(application, "/ws/user/")
+    b.scope["user"] = bob
+    for comm in (a, b):
+        assert (await comm.connect())[0] is True
+        assert (await comm.receive_json_from())["type"] == "ready"
+
+    await a.send_json_to({"action": "subscribe", "thread": t1.id})
+    assert await a.receive_json_from() == {"type": "subscribed", "thread": t1.id}
+    await a.send_json_to({"action": "subscribe", "thread": other.id})
+    assert (await a.receive_json_from())["type"] == "error"
+
+    # bob posts to both threads without subscribing to either
+    await b.send_json_to({"action": "send", "thread": t1.id, "body": "in t1"})
+    sent = await b.receive_json_from()
+    assert sent["type"] == "message_sent" and sent["thread"] == t1.id
+    assert (await b.receive_json_from())["type"] == "inbox_update"  # bob's own badge feed
+
+    frames = [await a.receive_json_from(), await a.receive_json_from()]
+    by_type = {f.get("event") or f["type"]: f for f in frames}
+    assert by_type["message_new"]["thread"] == t1.id and by_type["message_new"]["body"] == "in t1"
+    assert by_type["inbox_update"]["last_message_id"] == sent["id"]
+
+    await b.send_json_to({"action": "send", "thread": t2.id, "body": "in t2"})
+    await b.receive_json_from(), await b.receive_json_from()
+    # alice isn't subscribed to t2: only the inbox badge arrives
+    update = await a.receive_json_from()
+    assert update["type"] == "inbox_update" and update["thread"] == t2.id
+    assert await a.receive_nothing()
+
+    for comm in (a, b):
+        await comm.disconnect()
+
+
+@pytest.mark.asyncio
+async def test_redis_rate_limit_outage_is_logged_once(caplog):
+    import logging
+    from messaging.flow_control import RedisTokenBucket
+
+    bucket = RedisTokenBucket(5, 10, "redis://127.0.0.1:1/0")
+    with caplog.at_level(logging.WARNING, logger="messaging.flow_control"):
+        for _ in range(5):
+            assert await bucket.allow(1) == (True, 0.0)  # fails open
+        assert len(caplog.records) == 1 and caplog.records[0].levelno == logging.ERROR
+
+        async def healthy(keys, args):
+            return [1, "4"]
+
+        bucket._script = lambda: healthy
+        assert await bucket.allow(1) == (True, 0.0)
+        assert len(caplog.records) == 2 and "5 sends were allowed unchecked" in caplog.records[1].getMessage()
+
+
+@pytest.mark.asyncio
+async def test_outbound_window_drops_or_closes_unacked_readers():
+    from messaging.flow_control import OutboundWindow
+
+    sent, closed = [], []
+
+    async def send(frame):
+        sent.append(frame)
+
+    async def on_close():
+        closed.append(True)
+
+    w = OutboundWindow(send, on_close, size=2, policy="drop")
+    accepted = [await w.send({"n": i}) for i in range(5)]
+    assert accepted == [True, True, False, False, False] and w.unacked == 2
+    await w.ack(1)  # one slot frees up: the client learns what it missed
+    assert sent[-1] == {"type": "frames_dropped", "count": 3}
+    await w.ack(99)  # acks can't run ahead of what was sent
+    assert w.unacked == 0
+    assert await w.send({"n": 5}) is True
+    assert [f.get("n") for f in sent] == [0, 1, None, 5]
+
+    w = OutboundWindow(send, on_close, size=1, policy="close")
+    assert await w.send({"n": 0}) is True
+    assert await w.send({"n": 1}) is False
+    assert closed == [True] and w.closing
+    assert await w.send({"n": 2}) is False
+
+
+@pytest.mark.asyncio
+@override_settings(
+    CHANNEL_LAYERS={"default": {"BACKEND": "channels.layers.InMemoryChannelLayer"}},
+    WS_OUTBOUND_WINDOW=3,
+    WS_OUTBOUND_OVERFLOW="close",
+    MESSAGE_RATE_LIMIT_PER_SECOND=0,
+)
+@pytest.mark.django_db(transaction=True)
+async def test_ws_reader_that_stops_acking_is_closed(thread_pair):
+    alice, bob, t = thread_pair
+
+    async def open_socket(user):
+        comm = WebsocketCommunicator(application, f"/ws/threads/{t.id}/")
+        comm.scope["user"] = user
+        assert (await comm.connect())[0] is True
+        await comm.receive_json_from()  # ready
+        return comm
+
+    a, b = await open_socket(alice), await open_socket(bob)
+    for i in range(4):
+        await a.send_json_to({"action": "send", "body": f"m{i}"})
+        assert (await a.receive_json_from())["type"] == "message_sent"
+        await a.send_json_to({"action": "ack", "count": 2 + i})  # ready + confirmations so far
+
+    # bob had the ready frame plus two messages in flight; the third overflows
+    assert [(await b.receive_json_from())["body"] for _ in range(2)] == ["m0", "m1"]
+    assert (await b.receive_output())["type"] == "websocket.close"
+    await a.disconnect()
+
+
+@pytest.mark.asyncio
+@override_settings(
+    CHANNEL_LAYERS={"default": {"BACKEND": "channels.layers.InMemoryChannelLayer"}},
+    MESSAGE_RATE_LIMIT_BACKEND="memory",
+    MESSAGE_RATE_LIMIT_PER_SECOND=0.01,
+    MESSAGE_RATE_LIMIT_BURST=2,
+)
+@pytest.mark.django_db(transaction=True)
+async def test_ws_send_rate_limited_per_user(thread_pair):
+    u, _, t = thread_pair
+    comm = WebsocketCommunicator(application, f"/ws/threads/{t.id}/")
+    comm.scope["user"] = u
+    assert (await comm.connect())[0] is True
+    await comm.receive_json_from()  # ready
+
+    replies = []
+    for i in range(3):
+        await comm.send_json_to({"action": "send", "body": f"flood {i}"})
+        replies.append(await comm.receive_json_from())
+    assert [r["type"] for r in replies] == ["message_sent", "message_sent", "error"]
+    assert replies[2]["detail"] == "Rate limit exceeded" and replies[2]["retry_after"] > 0
+    assert await database_sync_to_async(Message.objects.filter(thread=t).count)() == 2
+    await comm.disconnect()
+
+
+@pytest.mark.asyncio
+@pytest.mark.django_db(transaction=True)
+async def test_async_create_and_seen_match_sync_path(thread_pair):
+    from messaging.services import acreate_message, amark_seen
+
+    alice, bob, t = thread_pair
+    msg = await acreate_message(t.id, alice.id, "hello async")
+    assert await ThreadMembership.objects.ais_member(t.id, bob.id)
+
+    result = await amark_seen(t.id, bob, up_to_id=msg.id)
+    assert result["count"] == 1 and result["up_to_id"] == msg.id
+
+    @database_sync_to_async
+    def check():
+        saved = Message.objects.get(id=msg.id)
+        assert saved.get_plain_body() == "hello async"
+        assert saved.delete_after == result["delete_after"]
+        t.refresh_from_db()
+        assert t.last_message_id == msg.id
+        assert MessageThread.objects.decrypt_previews([t]) == {t.id: "hello async"}
+        assert ThreadMembership.objects.get(thread=t, user=bob).last_read_message_id == msg.id
+
+    await check()
+
+
+@pytest.mark.asyncio
+@override_settings(
+    CHANNEL_LAYERS={"default": {"BACKEND": "channels.layers.InMemoryChannelLayer"}}
+)
+@pytest.mark.django_db(transaction=True)
+async def test_loadtest_harness_delivers_and_counts():
+    from messaging.loadtest import LoadTest, create_fixtures, percentile
+
+    assert percentile([5, 1, 3, 2, 4], 50) == 3 and percentile([5, 1, 3, 2, 4], 99) == 5
+    assert percentile([], 50) is None
+
+    users, threads = await database_sync_to_async(create_fixtures)(4, 2)
+    result = await LoadTest(users, threads, messages=3, rate=0, seen_ratio=1.0, seed=7).run(application)
+
+    assert (result.sent, result.confirmed, result.errors) == (12, 12, 0)
+    # two users per thread: each message reaches the other member
+    assert result.expected_deliveries == result.delivered == 12
+    assert result.seen_acks == 12
+    assert result.queries > 0 and result.summary()["delivery_ms"]["p99"] is not None
+
+
+@pytest.mark.asyncio
+@override_settings(
+    CHANNEL_LAYERS={"default": {"BACKEND": "channels.layers.InMemoryChannelLayer"}}
+)
+@pytest.mark.django_db(transaction=True)
+async def test_ws_msgpack_subprotocol_short_codes_and_id_only_ack(thread_pair):
+    import msgpack
+    from messaging.wire import MSGPACK_SUBPROTOCOL, decode_frame, encode_frame
+
+    alice, bob, t = thread_pair
+    binary = WebsocketCommunicator(application, f"/ws/threads/{t.id}/", subprotocols=[MSGPACK_SUBPROTOCOL])
+    binary.scope["user"] = alice
+    assert await binary.connect() == (True, MSGPACK_SUBPROTOCOL)
+    assert decode_frame(await binary.receive_from()) == {"type": "ready", "thread": t.id, "user": alice.username}
+
+    text = WebsocketCommunicator(application, f"/ws/threads/{t.id}/")
+    text.scope["user"] = bob
+    assert (await text.connect()) == (True, None)
+    await text.receive_json_from()  # ready
+
+    await binary.send_to(bytes_data=encode_frame({"action": "send", "body": "packed", "ref": 7}))
+    raw = msgpack.unpackb(await binary.receive_from(), raw=False)
+    assert set(raw) == {"t", "i", "th", "r"}
+    assert decode_frame(msgpack.packb(raw)) == {"type": "message_sent", "id": raw["i"], "thread": t.id, "ref": 7}
+
+    # JSON clients are unaffected
+    event = await text.receive_json_from()
+    assert (event["event"], event["body"], event["id"]) == ("message_new", "packed", raw["i"])
+
+    await binary.send_to(bytes_data=b"\xc1")
+    assert decode_frame(await binary.receive_from())["detail"] == "malformed frame"
+    await binary.disconnect()
+    await text.disconnect()
+
+
+def test_recent_messages_buffer_tracks_seeds_and_expires():
+    import pickle
+    from messaging.recent import RecentMessages
+
+    recent = RecentMessages(per_thread=3, ttl=600)
+    now = timezone.now()
+    msg = lambda i, sender="alice": {"id": i, "sender": sender, "body": f"m{i}", "created_at": now.isoformat()}
+
+    recent.seed(1, [(msg(1), None)], has_older=False)
+    assert recent.snapshot(1) is None  # not tracked: no socket here would see new messages
+
+    recent.subscribe(1)
+    recent.add(1, msg(3))  # arrives before the seed lands
+    recent.seed(1, [(msg(1), None), (msg(2), now - timedelta(seconds=1))], has_older=False)
+    messages, cursor = recent.snapshot(1)
+    assert [m["id"] for m in messages] == [1, 3] and cursor is None  # 2 already past delete_after
+
+    recent.add(1, msg(4, "bob"))
+    recent.add(1, msg(5))
+    messages, cursor = recent.snapshot(1)
+    assert [m["id"] for m in messages] == [3, 4, 5] and cursor == 3  # trimmed; older rows in the DB
+
+    recent.expire(1, now - timedelta(seconds=1), "bob", up_to_id=5)  # bob's ack covers alice's messages
+    recent.discard(1, [4])
+    assert recent.snapshot(1) is None  # emptied with older history left: cold again
+
+    with pytest.raises(TypeError):
+        pickle.dumps(recent)
+    recent.unsubscribe(1)
+    recent.seed(1, [(msg(1), None)], has_older=False)
+    assert recent.snapshot(1) is None
+
+
+@pytest.mark.asyncio
+@override_settings(
+    CHANNEL_LAYERS={"default": {"BACKEND": "channels.layers.InMemoryChannelLayer"}}
+)
+@pytest.mark.django_db(transaction=True)
+async def test_ws_ready_replays_recent_messages_from_memory(thread_pair):
+    alice, bob, t = thread_pair
+    first = await database_sync_to_async(create_message)(t.id, bob.id, "before")
+
+    async def open_socket(user):
+        comm = WebsocketCommunicator(application, f"/ws/threads/{t.id}/")
+        comm.scope["user"] = user
+        assert (await comm.connect())[0] is True
+        return comm, await comm.receive_json_from()
+
+    bob_ws, ready = await open_socket(bob)
+    assert "recent" not in ready  # cold: the page falls back to list_messages
+
+    @database_sync_to_async
+    def fetch_latest():
+        client = Client()
+        client.force_login(bob)
+        return client.get(f"/msg/threads/{t.id}/messages/").json()
+
+    assert [m["id"] for m in (await fetch_latest())["messages"]] == [first.id]
+
+    alice_ws, ready = await open_socket(alice)
+    assert [m["body"] for m in ready["recent"]] == ["before"] and ready["next_cursor"] is None
+
+    await alice_ws.send_json_to({"action": "send", "body": "after"})
+    sent = await alice_ws.receive_json_from()
+    await bob_ws.receive_json_from()  # message_new
+
+    tab, ready = await open_socket(bob)
+    assert [(m["id"], m["body"]) for m in ready["recent"]] == [(first.id, "before"), (sent["id"], "after")]
+
+    for comm in (tab, alice_ws, bob_ws):
+        await comm.disconnect()
+    from messaging.recent import get_recent_messages
+    assert get_recent_messages().snapshot(t.id) is None  # last socket gone: forgotten
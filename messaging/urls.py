@@ -15,7 +15,9 @@ urlpatterns = [
     # --- Message APIs ---
     path("threads/<int:thread_id>/messages/", views.list_messages, name="msg-messages-list"),
     path("threads/<int:thread_id>/messages/create/", views.create_message, name="msg-messages-create"),
+    path("threads/<int:thread_id>/export/", views.export_messages, name="msg-messages-export"),
     path("messages/<int:message_id>/seen/", views.mark_seen, name="msg-messages-seen"),
+    path("unread/", views.unread_counts, name="msg-unread"),
 
     # --- Friends API ---
     path("friends/", views.list_friends, name="msg-friends"),
@@ -1,6 +1,15 @@
 # messaging/views.py
+import json
+from datetime import datetime, timedelta, timezone as dt_timezone
+from itertools import islice
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.handlers.asgi import ASGIRequest
 from django.db import transaction
-from django.db.models import Count, Prefetch
+from django.db.models import Q
+from django.http import Http404, HttpResponse, StreamingHttpResponse
+from django.utils.crypto import constant_time_compare
 from django.shortcuts import get_object_or_404, render
 from django.contrib.auth import get_user_model
 from django.contrib.auth.decorators import login_required
@@ -10,11 +19,22 @@ from rest_framework.decorators import api_view, permission_classes
 from rest_framework.permissions import IsAuthenticated
 from rest_framework.response import Response
 from rest_framework import status
+from rest_framework.exceptions import NotFound, PermissionDenied
 
-from .models import Message, MessageThread
+from .metrics import render_metrics
+from .models import Message, MessageThread, ThreadMembership
+from .recent import get_recent_messages
+from .services import add_participants, broadcast_new_message, broadcast_seen, create_message as create_message_service, mark_seen as mark_seen_service
 
 User = get_user_model()
 
+MESSAGE_PAGE_SIZE = 50
+MESSAGE_PAGE_SIZE_MAX = 200
+THREAD_PAGE_SIZE = 50
+THREAD_PAGE_SIZE_MAX = 100
+
+_EPOCH = datetime(1970, 1, 1, tzinfo=dt_timezone.utc)
+
 # If your FriendRequest model is in a different app than 'users', adjust the import.
 try:
     from users.models import FriendRequest
@@ -22,6 +42,18 @@ except Exception:
     FriendRequest = None
 
 
+def _require_membership(user, thread_id: int):
+    """
+    Membership check against the (thread, user) index: 403 for an existing
+    thread the user isn't in, 404 when the thread doesn't exist.
+    """
+    if ThreadMembership.objects.is_member(thread_id, user.id):
+        return
+    if MessageThread.objects.filter(id=thread_id).exists():
+        raise PermissionDenied("You are not a member of this thread")
+    raise NotFound()
+
+
 # ---------------- UI PAGES ----------------
 
 @ensure_csrf_cookie
@@ -48,37 +80,58 @@ def thread_page(request, thread_id: int):
 @api_view(["GET"])
 @permission_classes([IsAuthenticated])
 def list_threads(request):
-    """List user's threads with last message preview."""
+    """
+    List user's threads by recent activity, with last message preview.
+    Paged with an opaque ?cursor= (from `next_cursor`) and ?limit=.
+    """
+    try:
+        limit = max(1, min(int(request.query_params.get("limit") or THREAD_PAGE_SIZE), THREAD_PAGE_SIZE_MAX))
+        cursor = _decode_thread_cursor(request.query_params.get("cursor"))
+    except ValueError:
+        return Response({"detail": "invalid cursor or limit"}, status=status.HTTP_400_BAD_REQUEST)
+
     qs = (
-        MessageThread.objects.filter(participants=request.user)
-        .prefetch_related(
-            Prefetch(
-                "messages",
-                queryset=Message.objects.order_by("-id")[:1],
-                to_attr="last_message_list",
-            ),
-            "participants",
-        )
-        .order_by("-id")
+        MessageThread.objects.filter(memberships__user=request.user)
+        .prefetch_related("participants")
+        .order_by("-last_activity_at", "-id")
     )
+    if cursor:
+        ts, tid = cursor
+        qs = qs.filter(Q(last_activity_at__lt=ts) | Q(last_activity_at=ts, id__lt=tid))
+    threads = list(qs[:limit + 1])
+    has_more = len(threads) > limit
+    threads = threads[:limit]
+    previews = MessageThread.objects.decrypt_previews(threads)
+    unread = ThreadMembership.objects.unread_counts(request.user, [t.id for t in threads])
+
     data = []
-    for t in qs[:50]:
-        last_message = t.last_message_list[0] if getattr(t, "last_message_list", []) else None
-        preview = None
-        if last_message:
-            try:
-                # Correct helper name from model
-                preview = last_message.get_plain_body()
-            except Exception:
-                preview = None
+    for t in threads:
         data.append(
             {
                 "id": t.id,
                 "participants": [u.username for u in t.participants.all()],
-                "last_message": preview,
+                "last_message": previews.get(t.id),
+                "unread": unread.get(t.id, 0),
+                "last_activity_at": t.last_activity_at.isoformat(),
             }
         )
-    return Response(data)
+    return Response({
+        "threads": data,
+        "next_cursor": _encode_thread_cursor(threads[-1]) if has_more else None,
+    })
+
+
+def _encode_thread_cursor(thread) -> str:
+    # (activity, id) keyset position; microseconds since epoch keeps it exact
+    us = (thread.last_activity_at - _EPOCH) // timedelta(microseconds=1)
+    return f"{us}.{thread.id}"
+
+
+def _decode_thread_cursor(raw):
+    if not raw:
+        return None
+    us, _, tid = raw.partition(".")
+    return _EPOCH + timedelta(microseconds=int(us)), int(tid)
 
 
 @api_view(["POST"])
@@ -98,52 +151,18 @@ def create_thread(request):
     if me.id not in participant_ids:
         participant_ids.append(me.id)
 
-    others = [pid for pid in participant_ids if pid != me.id]
+    others = list(dict.fromkeys(pid for pid in participant_ids if pid != me.id))
     if len(others) == 1:
-        other_id = others[0]
-        # First try to find an existing thread with messages
-        existing = (
-            MessageThread.objects
-            .filter(participants=me)
-            .filter(participants__id=other_id)
-            .annotate(pcnt=Count("participants", distinct=True),
-                      msg_count=Count("messages"))
-            .filter(pcnt=2)
-            .filter(msg_count__gt=0)  # With messages
-            .order_by("-id")
-            .first()
-        )
-        if existing:
-            return Response({"id": existing.id}, status=status.HTTP_200_OK)
-
-        # Then look for any thread, prioritize latest
-        existing = (
-            MessageThread.objects
-            .filter(participants=me)
-            .filter(participants__id=other_id)
-            .annotate(pcnt=Count("participants", distinct=True))
-            .filter(pcnt=2)
-            .order_by("-id")
-            .first()
+        other = get_object_or_404(User, id=others[0])
+        thread, created = MessageThread.objects.get_thread_for_participants(me, other)
+        return Response(
+            {"id": thread.id},
+            status=status.HTTP_201_CREATED if created else status.HTTP_200_OK
         )
-        if existing:
-            # Clean up any other empty threads with same participants
-            empty_dupes = (
-                MessageThread.objects
-                .filter(participants=me)
-                .filter(participants__id=other_id)
-                .exclude(id=existing.id)
-                .annotate(pcnt=Count("participants", distinct=True),
-                          msg_count=Count("messages"))
-                .filter(pcnt=2, msg_count=0)
-            )
-            empty_dupes.delete()
-            return Response({"id": existing.id}, status=status.HTTP_200_OK)
 
     with transaction.atomic():
         t = MessageThread.objects.create()
-        users = User.objects.filter(id__in=participant_ids)
-        t.participants.add(*users)
+        add_participants(t.id, User.objects.filter(id__in=participant_ids).values_list("id", flat=True))
 
     return Response({"id": t.id}, status=status.HTTP_201_CREATED)
 
@@ -159,24 +178,13 @@ def dm_thread(request, user_id: int):
     other = get_object_or_404(User, id=user_id)
     logger.info(f"Looking for thread between {me.username} (id={me.id}) and {other.username} (id={other.id})")
 
-    with transaction.atomic():
-        thread, created = MessageThread.objects.get_thread_for_participants(me, other)
-        logger.info(f"{'Created new' if created else 'Found existing'} thread {thread.id}")
-
-        if not created:
-            # Clean up any duplicate threads that might exist
-            (
-                MessageThread.objects
-                .filter(participants=me.id)
-                .filter(participants=other.id)
-                .exclude(id=thread.id)
-                .delete()
-            )
+    thread, created = MessageThread.objects.get_thread_for_participants(me, other)
+    logger.info(f"{'Created new' if created else 'Found existing'} thread {thread.id}")
 
-        return Response(
-            {"id": thread.id},
-            status=status.HTTP_201_CREATED if created else status.HTTP_200_OK
-        )
+    return Response(
+        {"id": thread.id},
+        status=status.HTTP_201_CREATED if created else status.HTTP_200_OK
+    )
 
 
 # ---------------- MESSAGE APIS ----------------
@@ -184,43 +192,151 @@ def dm_thread(request, user_id: int):
 @api_view(["GET"])
 @permission_classes([IsAuthenticated])
 def list_messages(request, thread_id: int):
-    """Return plaintext messages for a thread (server decrypts)."""
-    thread = get_object_or_404(MessageThread, id=thread_id, participants=request.user)
-    msgs = (
-        Message.objects.filter(thread=thread)
+    """
+    Return one page of plaintext messages for a thread (server decrypts).
+
+    Keyset pagination on (thread_id, id); messages come back oldest-first:
+      (no cursor)     newest `limit` messages
+      ?before_id=N    the `limit` messages just older than N
+      ?after_id=N     the `limit` messages just newer than N
+    `next_cursor` is the before_id for the next older page and `prev_cursor`
+    the after_id for newer messages; each is null when there is nothing more.
+    """
+    _require_membership(request.user, thread_id)
+    try:
+        before_id = int(request.query_params["before_id"]) if "before_id" in request.query_params else None
+        after_id = int(request.query_params["after_id"]) if "after_id" in request.query_params else None
+        limit = int(request.query_params.get("limit") or MESSAGE_PAGE_SIZE)
+    except ValueError:
+        return Response({"detail": "before_id, after_id and limit must be integers"}, status=status.HTTP_400_BAD_REQUEST)
+    if before_id is not None and after_id is not None:
+        return Response({"detail": "use either before_id or after_id"}, status=status.HTTP_400_BAD_REQUEST)
+    limit = max(1, min(limit, MESSAGE_PAGE_SIZE_MAX))
+
+    base = Message.objects.filter(thread_id=thread_id)
+    msgs = base.select_related("sender")
+    if after_id is not None:
+        page = list(msgs.filter(id__gt=after_id).order_by("id")[:limit + 1])
+        has_newer = len(page) > limit
+        page = page[:limit]
+        has_older = bool(page) and base.filter(id__lt=page[0].id).exists()
+    else:
+        if before_id is not None:
+            msgs = msgs.filter(id__lt=before_id)
+        page = list(msgs.order_by("-id")[:limit + 1])
+        has_older = len(page) > limit
+        page = page[:limit][::-1]
+        has_newer = before_id is not None and bool(page) and base.filter(id__gt=page[-1].id).exists()
+
+    bodies = Message.objects.decrypt_bodies(page)
+    out, deadlines = [], []
+    for m in page:
+        body = bodies.get(m.id)
+        if body is None:
+            # Skip messages that fail to decrypt; keep rest of the thread
+            continue
+        out.append({
+            "id": m.id,
+            "sender": m.sender.username,
+            "body": body,
+            "created_at": m.created_at.isoformat(),
+        })
+        deadlines.append(m.delete_after)
+
+    recent = get_recent_messages()
+    if recent is not None and before_id is None and after_id is None:
+        # Newest page: warms this process's replay buffer if a socket here is on the thread
+        recent.seed(thread_id, zip(out, deadlines), has_older)
+    # Cursors come from the fetched rows, so skipped rows never stall paging
+    return Response({
+        "messages": out,
+        "next_cursor": page[0].id if has_older else None,
+        "prev_cursor": page[-1].id if has_newer else None,
+    })
+
+
+def _export_ndjson(thread_id: int, since_id: int, chunk_size: int):
+    """
+    Yield the thread history as NDJSON, one bytes chunk per batch of rows.
+    Rows stream from a server-side cursor and are decrypted a batch at a
+    time, so memory stays flat whatever the thread length.
+    """
+    rows = (
+        Message.objects.filter(thread_id=thread_id, id__gt=since_id)
         .select_related("sender")
+        .only("id", "thread_id", "sender_id", "sender__username", "enc_blob", "enc_body", "key_version", "created_at")
         .order_by("id")
+        .iterator(chunk_size=chunk_size)
     )
-    out = []
-    for m in msgs[:200]:
-        try:
-            body = m.get_plain_body()  # correct model helper
-            out.append({
+    while True:
+        batch = list(islice(rows, chunk_size))
+        if not batch:
+            return
+        bodies = Message.objects.decrypt_bodies(batch)
+        lines = []
+        for m in batch:
+            body = bodies.get(m.id)
+            if body is None:
+                continue  # same policy as list_messages: skip undecryptable rows
+            lines.append(json.dumps({
                 "id": m.id,
                 "sender": m.sender.username,
-                "body": body or "",
+                "body": body,
                 "created_at": m.created_at.isoformat(),
-            })
-        except Exception:
-            # Skip messages that fail to decrypt; keep rest of the thread
-            continue
-    return Response(out)
+            }))
+        if lines:
+            yield ("\n".join(lines) + "\n").encode("utf-8")
+
+
+async def _iterate_in_sync_thread(gen):
+    """
+    Under ASGI Django would buffer a sync iterator into a list. Step it one
+    chunk at a time on the thread-sensitive executor instead (same thread,
+    same DB connection as the view).
+    """
+    done = object()
+    while True:
+        chunk = await sync_to_async(next, thread_sensitive=True)(gen, done)
+        if chunk is done:
+            return
+        yield chunk
+
+
+@api_view(["GET"])
+@permission_classes([IsAuthenticated])
+def export_messages(request, thread_id: int):
+    """
+    Stream the decrypted thread history as NDJSON (one message per line).
+    ?since_id=<id> exports only newer messages, for incremental exports.
+    """
+    _require_membership(request.user, thread_id)
+    try:
+        since_id = int(request.query_params.get("since_id") or 0)
+    except ValueError:
+        return Response({"detail": "since_id must be an integer"}, status=status.HTTP_400_BAD_REQUEST)
+
+    chunk_size = getattr(settings, "MESSAGE_EXPORT_CHUNK_SIZE", 500)
+    content = _export_ndjson(thread_id, since_id, chunk_size)
+    if isinstance(request._request, ASGIRequest):
+        content = _iterate_in_sync_thread(content)
+
+    response = StreamingHttpResponse(content, content_type="application/x-ndjson")
+    response["Content-Disposition"] = f'attachment; filename="thread-{thread_id}.ndjson"'
+    return response
 
 
 @api_view(["POST"])
 @permission_classes([IsAuthenticated])
 def create_message(request, thread_id: int):
     """REST message create (WS is primary). Expects: {"body": "..."}"""
-    thread = get_object_or_404(MessageThread, id=thread_id, participants=request.user)
+    _require_membership(request.user, thread_id)
     raw = request.data.get("body") or ""
     body = raw.strip()
     if not body or len(body) > 5000:
         return Response({"detail": "invalid body"}, status=status.HTTP_400_BAD_REQUEST)
 
-    msg = Message.objects.create(thread=thread, sender=request.user)
-    # Use the model's high-level helper; field is enc_body under the hood
-    msg.set_plain_body(body)
-    msg.save(update_fields=["enc_body", "created_at", "updated_at"])
+    msg = create_message_service(thread_id, request.user.id, body)
+    broadcast_new_message(msg, request.user.username, body)
 
     return Response(
         {"id": msg.id, "sender": request.user.username, "body": body, "created_at": msg.created_at.isoformat()},
@@ -231,9 +347,28 @@ def create_message(request, thread_id: int):
 @api_view(["POST"])
 @permission_classes([IsAuthenticated])
 def mark_seen(request, message_id: int):
-    """Stub 'seen' endpoint; adjust to your model if you track reads."""
-    _ = get_object_or_404(Message, id=message_id, thread__participants=request.user)
-    return Response(status=status.HTTP_204_NO_CONTENT)
+    """
+    Mark one message seen (starts its self-destruct timer). Same path as the
+    WebSocket acks: one UPDATE, read cursor advanced, one broadcast.
+    """
+    msg = get_object_or_404(Message.objects.only("id", "thread_id"), id=message_id)
+    _require_membership(request.user, msg.thread_id)
+    result = mark_seen_service(msg.thread_id, request.user, message_ids=[msg.id])
+    newly_seen = bool(result and result["count"])  # None for the caller's own message
+    if newly_seen:
+        broadcast_seen(msg.thread_id, request.user.username, result)
+    return Response({"ok": True, "id": msg.id, "newly_seen": newly_seen})
+
+
+@api_view(["GET"])
+@permission_classes([IsAuthenticated])
+def unread_counts(request):
+    """Inbox badge: {"total": n, "threads": {thread_id: n}} from one aggregate query."""
+    counts = ThreadMembership.objects.unread_counts(request.user)
+    return Response({
+        "total": sum(counts.values()),
+        "threads": {str(tid): n for tid, n in counts.items() if n},
+    })
 
 
 # ---------------- FRIENDS API ----------------
@@ -256,3 +391,21 @@ def list_friends(request):
     users = User.objects.filter(id__in=friend_ids).only("id", "username").order_by("username")
     data = [{"id": u.id, "username": u.username} for u in users]
     return Response(data, status=200)
+
+
+# ---------------- METRICS ----------------
+
+def metrics(request):
+    """
+    Prometheus text exposition of this process's messaging metrics.
+    Requires `Authorization: Bearer <METRICS_TOKEN>`; with no token
+    configured it is only served in DEBUG.
+    """
+    token = getattr(settings, "METRICS_TOKEN", "")
+    if token:
+        supplied = request.headers.get("Authorization", "").removeprefix("Bearer ").strip()
+        if not constant_time_compare(supplied, token):
+            return HttpResponse(status=401)
+    elif not settings.DEBUG:
+        raise Http404
+    return HttpResponse(render_metrics(), content_type="text/plain; version=0.0.4; charset=utf-8")
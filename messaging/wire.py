@@ -0,0 +1,63 @@
+# messaging/wire.py
+"""
+Optional binary framing for the messaging WebSockets.
+
+A client that offers the "cloakpost.msgpack.v1" subprotocol exchanges
+MessagePack binary frames instead of JSON text. Top-level keys are
+replaced by the short codes below in both directions (unknown keys pass
+through unchanged), and the sender's confirmation is an id-only ack
+instead of echoing the message back. JSON stays the default.
+"""
+from typing import Optional
+
+import msgpack
+
+MSGPACK_SUBPROTOCOL = "cloakpost.msgpack.v1"
+
+FIELD_CODES = {
+    "type": "t",
+    "event": "e",
+    "action": "a",
+    "thread": "th",
+    "id": "i",
+    "ref": "r",
+    "sender": "s",
+    "body": "b",
+    "created_at": "c",
+    "message_id": "m",
+    "detail": "d",
+    "user": "u",
+    "user_id": "ui",
+    "retry_after": "ra",
+    "count": "n",
+    "ids": "is",
+    "up_to_id": "ut",
+    "seen_by": "sb",
+    "seen_at": "sa",
+    "delete_after": "da",
+    "recent": "rc",
+    "next_cursor": "nc",
+    "last_message_id": "lm",
+    "last_activity_at": "la",
+}
+FIELD_NAMES = {code: name for name, code in FIELD_CODES.items()}
+
+
+def negotiate(offered) -> Optional[str]:
+    """The subprotocol to accept from the client's offer, or None for JSON."""
+    return MSGPACK_SUBPROTOCOL if MSGPACK_SUBPROTOCOL in (offered or ()) else None
+
+
+def encode_frame(content: dict) -> bytes:
+    return msgpack.packb({FIELD_CODES.get(k, k): v for k, v in content.items()}, use_bin_type=True)
+
+
+def decode_frame(data: bytes) -> dict:
+    """Raises ValueError for anything that isn't a MessagePack map."""
+    try:
+        content = msgpack.unpackb(data, raw=False)
+    except Exception as e:
+        raise ValueError(f"Malformed MessagePack frame: {e}") from e
+    if not isinstance(content, dict):
+        raise ValueError("MessagePack frame must be a map")
+    return {FIELD_NAMES.get(k, k): v for k, v in content.items()}
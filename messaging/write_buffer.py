@@ -0,0 +1,137 @@
+# messaging/write_buffer.py
+"""
+Optional write-behind buffer for messages arriving over WebSockets.
+
+With MESSAGE_WRITE_BUFFER on, ThreadConsumer hands each outgoing message
+to a per-process buffer instead of running its own transaction. The
+buffer collects messages from every connection for up to
+MESSAGE_WRITE_BUFFER_MAX_DELAY_MS, or until MESSAGE_WRITE_BUFFER_MAX_BATCH
+are waiting, and writes them with services.create_messages (one
+bulk_create). Each sender awaits its own future and is only confirmed
+once the batch has committed, with the id it was assigned.
+
+If a batch fails (e.g. one thread was deleted meanwhile) its messages are
+retried one by one, so only the offending sends report an error.
+Connections flush the buffer on disconnect, and anything still queued
+when the process exits is written by an atexit hook.
+"""
+import asyncio
+import atexit
+import logging
+
+from channels.db import database_sync_to_async
+from django.conf import settings
+
+from .services import create_message, create_messages
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MAX_BATCH = 100
+DEFAULT_MAX_DELAY_MS = 5
+
+
+def write_buffer_enabled() -> bool:
+    return bool(getattr(settings, "MESSAGE_WRITE_BUFFER", False))
+
+
+def _durable() -> bool:
+    return getattr(settings, "MESSAGE_WRITE_BUFFER_DURABILITY", "durable") != "relaxed"
+
+
+def _write_batch(items):
+    """Returns one Message or exception per item."""
+    try:
+        return create_messages(items, durable=_durable())
+    except Exception:
+        logger.exception("Batched write of %s messages failed; retrying individually", len(items))
+    results = []
+    for thread_id, sender_id, body in items:
+        try:
+            results.append(create_message(thread_id, sender_id, body))
+        except Exception as e:
+            results.append(e)
+    return results
+
+
+class MessageWriteBuffer:
+    def __init__(self, max_batch: int = DEFAULT_MAX_BATCH, max_delay_ms: float = DEFAULT_MAX_DELAY_MS):
+        self.max_batch = max(1, int(max_batch))
+        self.max_delay = max(0.0, float(max_delay_ms)) / 1000.0
+        self.loop = asyncio.get_running_loop()
+        self._pending = []  # [(thread_id, sender_id, body, future)]
+        self._timer = None
+        self._flush_lock = asyncio.Lock()
+
+    def __len__(self):
+        return len(self._pending)
+
+    async def submit(self, thread_id: int, sender_id: int, body: str):
+        """Queue a message and wait until it is committed; returns the saved Message."""
+        future = self.loop.create_future()
+        self._pending.append((thread_id, sender_id, body, future))
+        if len(self._pending) >= self.max_batch:
+            self._schedule_flush()
+        elif self._timer is None:
+            self._timer = self.loop.call_later(self.max_delay, self._schedule_flush)
+        return await future
+
+    def _schedule_flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        asyncio.ensure_future(self.flush())
+
+    async def flush(self):
+        """Write everything queued so far (in max_batch chunks)."""
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        async with self._flush_lock:
+            while self._pending:
+                batch, self._pending = self._pending[:self.max_batch], self._pending[self.max_batch:]
+                results = await database_sync_to_async(_write_batch)([item[:3] for item in batch])
+                for (*_, future), result in zip(batch, results):
+                    if future.done():
+                        continue  # sender went away; the row is written regardless
+                    if isinstance(result, Exception):
+                        future.set_exception(result)
+                    else:
+                        future.set_result(result)
+
+    def drain_sync(self):
+        """Write whatever is left without the event loop (process exit)."""
+        batch, self._pending = self._pending, []
+        if batch:
+            logger.warning("Writing %s buffered messages at shutdown", len(batch))
+            _write_batch([item[:3] for item in batch])
+
+
+_buffer = None
+
+
+def get_write_buffer() -> MessageWriteBuffer:
+    """The buffer for the running event loop (one per process under Daphne)."""
+    global _buffer
+    if _buffer is None or _buffer.loop is not asyncio.get_running_loop():
+        if _buffer is not None and len(_buffer):
+            # Its loop is gone, so nobody is awaiting these confirmations
+            logger.warning("Dropping write buffer of a closed event loop with %s messages", len(_buffer))
+        _buffer = MessageWriteBuffer(
+            max_batch=getattr(settings, "MESSAGE_WRITE_BUFFER_MAX_BATCH", DEFAULT_MAX_BATCH),
+            max_delay_ms=getattr(settings, "MESSAGE_WRITE_BUFFER_MAX_DELAY_MS", DEFAULT_MAX_DELAY_MS),
+        )
+    return _buffer
+
+
+async def flush_write_buffer():
+    if _buffer is not None and _buffer.loop is asyncio.get_running_loop():
+        await _buffer.flush()
+
+
+@atexit.register
+def _flush_at_exit():
+    if _buffer is not None:
+        try:
+            _buffer.drain_sync()
+        except Exception:
+            logger.exception("Could not write buffered messages at shutdown")
@@ -1,5 +1,6 @@
 // static/js/chat.js
 (function (global) {
+  const ACK_EVERY = 16; // must stay well under the server's WS_OUTBOUND_WINDOW
   const listeners = {};
   function on(event, handler) {
     (listeners[event] ||= []).push(handler);
@@ -19,6 +20,7 @@
     let sock;
     let closed = false;
     let tries = 0;
+    let received = 0; // frames read on this socket, acked for server flow control
 
     const scheme = (window.location.protocol === "https:") ? "wss" : "ws";
     const url = `${scheme}://${window.location.host}/ws/threads/${threadId}/`;
@@ -26,6 +28,7 @@
     function open() {
       if (closed) return;
       sock = new WebSocket(url);
+      received = 0;
 
       sock.onopen = () => { tries = 0; emit("open"); };
       sock.onclose = () => {
@@ -34,6 +37,8 @@
       };
       sock.onerror = (e) => { console.error("ws error", e); };
       sock.onmessage = (ev) => {
+        received += 1;
+        if (received % ACK_EVERY === 0) sock.send(JSON.stringify({ action: "ack", count: received }));
         try {
           const data = JSON.parse(ev.data);
           // Normalize Channels JsonWebsocketConsumer messages
@@ -41,7 +46,12 @@
           if (event) emit(event, data);
           // Also surface common events
           if (event === "message_new") emit("message_new", data.message);
-          if (event === "message_seen") emit("message_seen", { message_id: data.message_id });
+          if (event === "messages_seen") {
+            // One event per acked batch (ids) or range (up_to_id, excluding the reader's own messages)
+            const seen = { up_to_id: data.up_to_id, seen_by: data.seen_by, delete_after: data.delete_after };
+            if (data.ids) data.ids.forEach(id => emit("message_seen", { ...seen, message_id: id }));
+            else emit("message_seen", seen);
+          }
           if (event === "message_deleted") emit("message_deleted", { message_id: data.message_id });
         } catch (err) {
           console.error("bad ws payload", err);